@@ -1,4 +1,11 @@
-from .energy_meter import RpiEnergyMeter
-
 __all__ = ["RpiEnergyMeter", "VERSION"]
 __version__ = "0.1.0"
+
+
+def __getattr__(name):
+    # energy_meter pulls in numpy and the whole measurement, it is only imported once RpiEnergyMeter is used
+    if name == "RpiEnergyMeter":
+        from .energy_meter import RpiEnergyMeter  # noqa: PLC0415
+
+        return RpiEnergyMeter
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
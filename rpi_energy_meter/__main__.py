@@ -2,8 +2,6 @@ import argparse
 import os
 import subprocess
 
-from rpi_energy_meter.energy_meter import RpiEnergyMeter
-
 
 def main():
     """
@@ -36,6 +34,7 @@ def main():
     )
 
     parser.add_argument("command", help="Which mode to run", nargs="?", default=None)
+    parser.add_argument("arguments", help="Additional arguments for the selected mode", nargs="*")
     args = parser.parse_args()
 
     # then run the RpiEnergyMeter
@@ -46,8 +45,10 @@ def main():
         subprocess.run(["ruff", "check", "rpi_energy_meter/"], check=False)
         subprocess.run(["ruff", "format", "--check", "rpi_energy_meter/"], check=False)
     else:
+        from rpi_energy_meter.energy_meter import RpiEnergyMeter  # noqa: PLC0415 — not needed to run the checks
+
         em = RpiEnergyMeter(args.config, args.verbose)
-        em.run(args.command)
+        em.run(args.command, arguments=args.arguments)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,207 @@
+"""
+Module to aggregate the power values of consecutive blocks into windows
+
+Instead of keeping every reading until a window is complete, an Aggregator keeps a running sum, minimum and maximum of
+every POWER_DTYPE field per phase and CT in preallocated arrays. Its memory does not depend on how long a window is,
+be it a number of readings (GENERAL.WINDOW_READINGS) or seconds (GENERAL.WINDOW_SECONDS).
+"""
+
+from typing import NamedTuple
+
+import numpy
+
+from .power import POWER_DTYPE
+
+# Readings averaged into one window unless GENERAL.WINDOW_READINGS or GENERAL.WINDOW_SECONDS say otherwise
+DEFAULT_WINDOW_READINGS = 5
+
+_FIELDS = len(POWER_DTYPE.names)
+
+
+class Window(NamedTuple):
+    """Values of one phase aggregated over a window
+
+    The arrays are views into the Aggregator, valid until the next reading of the phase is added.
+
+    Attributes:
+        mean (numpy.ndarray): (6,) POWER_DTYPE array, mean of every field per CT
+        minimum (numpy.ndarray): (6,) POWER_DTYPE array, smallest value of every field per CT
+        maximum (numpy.ndarray): (6,) POWER_DTYPE array, largest value of every field per CT
+        count (int): Readings in the window
+        time_start (float): Time the window started at, the end of the window before if there was one
+        time_end (float): Time the last reading of the window was finished at
+    """
+
+    mean: numpy.ndarray
+    minimum: numpy.ndarray
+    maximum: numpy.ndarray
+    count: int
+    time_start: float
+    time_end: float
+
+
+class Aggregator:
+    """Running sum, minimum and maximum of the power values of every phase over a window
+
+    A window is complete after {readings} readings or, if {seconds} is given, once it covers that many seconds.
+    Windows of a phase follow each other without gaps: a window starts where the one before ended.
+
+    Args:
+        phases (int): Number of phases
+        readings (int): Readings per window
+        seconds (float): Length of a window in seconds, takes precedence over {readings}
+    """
+
+    def __init__(self, phases: int, readings: int = DEFAULT_WINDOW_READINGS, seconds=None):
+        self.readings = max(1, int(readings))
+        self.seconds = float(seconds) if seconds else None
+        self._sum = numpy.zeros((phases, 6, _FIELDS))
+        self._min = numpy.zeros((phases, 6, _FIELDS))
+        self._max = numpy.zeros((phases, 6, _FIELDS))
+        self._mean = numpy.zeros((phases, 6), dtype=POWER_DTYPE)
+        self._count = numpy.zeros(phases, dtype=numpy.int64)
+        self._start = numpy.full(phases, numpy.nan)
+        self._end = numpy.full(phases, numpy.nan)
+        self.windows = [0 for _ in range(phases)]
+
+    @classmethod
+    def from_config(cls, config, phases: int):
+        """Aggregator with the window set in GENERAL.WINDOW_READINGS / GENERAL.WINDOW_SECONDS of {config}"""
+        return cls(
+            phases,
+            readings=config.GENERAL.get("WINDOW_READINGS", DEFAULT_WINDOW_READINGS),
+            seconds=config.GENERAL.get("WINDOW_SECONDS", None),
+        )
+
+    def add(self, phase: int, power: numpy.ndarray, time_start: float, time_end: float) -> bool:
+        """Adds the (6,) POWER_DTYPE values of a block taken on {phase} (0 based) from {time_start} until {time_end}
+
+        Returns:
+            bool: The window of the phase is complete and should be taken with take()
+        """
+        values = numpy.ascontiguousarray(power).view(numpy.float64).reshape(6, _FIELDS)
+        if self._count[phase] == 0:
+            self._sum[phase] = values
+            self._min[phase] = values
+            self._max[phase] = values
+            if numpy.isnan(self._start[phase]):
+                self._start[phase] = time_start
+        else:
+            self._sum[phase] += values
+            numpy.minimum(self._min[phase], values, out=self._min[phase])
+            numpy.maximum(self._max[phase], values, out=self._max[phase])
+        self._count[phase] += 1
+        self._end[phase] = time_end
+
+        if self.seconds is not None:
+            return self._end[phase] - self._start[phase] >= self.seconds
+        return self._count[phase] >= self.readings
+
+    def take(self, phase: int) -> Window:
+        """Completes the window of {phase} and starts the next one where it ended
+
+        Returns:
+            Window: Mean, minimum and maximum of the readings added since the last take()
+        """
+        count = int(self._count[phase])
+        mean = self._mean[phase]
+        numpy.divide(self._sum[phase], max(count, 1), out=mean.view(numpy.float64).reshape(6, _FIELDS))
+        window = Window(
+            mean=mean,
+            minimum=self._min[phase].view(POWER_DTYPE).reshape(6),
+            maximum=self._max[phase].view(POWER_DTYPE).reshape(6),
+            count=count,
+            time_start=float(self._start[phase]),
+            time_end=float(self._end[phase]),
+        )
+        self._count[phase] = 0
+        self._start[phase] = self._end[phase]
+        self.windows[phase] += 1
+        return window
+
+
+class RollupTier(NamedTuple):
+    """One resolution the readings are rolled up to, see [[ROLLUPS.TIERS]] in the config
+
+    Attributes:
+        name (str): Name of the tier, e.g. "1m"
+        seconds (float): Length of a window, windows are aligned to multiples of it since the epoch
+        bucket (str|None): Bucket the tier is written to, None for INFLUX.bucket
+        suffix (str): Appended to the measurement names of the tier, "_<name>" unless configured
+    """
+
+    name: str
+    seconds: float
+    bucket: object
+    suffix: str
+
+
+def rollup_tiers(config) -> list:
+    """RollupTier of every entry in ROLLUPS.TIERS of {config}"""
+    tiers = []
+    for tier in config.ROLLUPS.get("TIERS", []):
+        name = str(tier["NAME"])
+        tiers.append(
+            RollupTier(
+                name=name,
+                seconds=float(tier["SECONDS"]),
+                bucket=tier.get("BUCKET") or None,
+                suffix=tier.get("SUFFIX", "_" + name),
+            )
+        )
+    return tiers
+
+
+class Rollups:
+    """Aggregates every reading into the windows of all rollup tiers, each tier ending its windows at its own cadence
+
+    Besides the mean, minimum and maximum of the power values, a tier's window holds the energy every CT consumed
+    while it was open. A block counts from the end of the block before, like SAMPLES.integrate_energy() counts it,
+    and its energy is split at the end of the window by time. The energy of windows no block ended in goes to the
+    window before them.
+
+    Args:
+        tiers (list): RollupTier to aggregate into
+        phases (int): Number of phases
+    """
+
+    def __init__(self, tiers: list, phases: int):
+        self.tiers = tiers
+        self._aggregators = [Aggregator(phases) for _ in tiers]
+        # End of the open window and the energy in kWh consumed in it so far, per tier and phase
+        self._boundaries = numpy.full((len(tiers), phases), numpy.nan)
+        self._energy = numpy.zeros((len(tiers), phases, 6))
+        # End of the block before, per phase
+        self._previous = numpy.full(phases, numpy.nan)
+
+    def add(self, phase: int, power: numpy.ndarray, time_start: float, time_end: float) -> list:
+        """Adds the values of a block taken on {phase} (0 based) from {time_start} until {time_end}
+
+        The power values belong to the window the block ends in.
+
+        Returns:
+            list: (RollupTier, Window, energy per CT in kWh) of every window the block completed
+        """
+        previous = time_start if numpy.isnan(self._previous[phase]) else float(self._previous[phase])
+        self._previous[phase] = time_end
+        # kWh per second of the block
+        rate = power["Watts"] / (60 * 60 * 1000)
+        completed = []
+        for tier, aggregator in enumerate(self._aggregators):
+            seconds = self.tiers[tier].seconds
+            if numpy.isnan(self._boundaries[tier, phase]):
+                self._boundaries[tier, phase] = (numpy.floor(time_start / seconds) + 1) * seconds
+            aggregator.add(phase, power, time_start, time_end)
+            if time_end < self._boundaries[tier, phase]:
+                self._energy[tier, phase] += rate * (time_end - previous)
+                continue
+            # The window the block ends in starts at {split}, the part of the block before it completes this one
+            split = numpy.floor(time_end / seconds) * seconds
+            energy = self._energy[tier, phase] + rate * (split - previous)
+            self._energy[tier, phase] = rate * (time_end - split)
+            window = aggregator.take(phase)
+            # Points of a tier are stamped with the start of its window
+            start = self._boundaries[tier, phase] - seconds
+            completed.append((self.tiers[tier], window._replace(time_start=start), energy))
+            self._boundaries[tier, phase] = (numpy.floor(time_end / seconds) + 1) * seconds
+        return completed
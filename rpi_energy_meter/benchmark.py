@@ -0,0 +1,705 @@
+"""
+Module to benchmark the stages of the measurement and to detect performance regressions against a baseline
+
+Every stage is timed at each block size in BENCHMARK.SIZES with data from the simulator, or with the blocks
+in BENCHMARK.CAPTURE when a capture taken with 'record' is given. The results are stored as JSON, so a
+later run can be compared against them. A stage counts as regression when its median got slower than
+BENCHMARK.THRESHOLD (relative) compared to the baseline. Results that are wrong on their own, like memory kept by
+the rounds, fail every run, with or without a baseline, see check().
+"""
+
+import copy
+import ctypes
+import gzip
+import json
+import platform
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy
+from prettytable import PrettyTable
+
+from .aggregate import DEFAULT_WINDOW_READINGS, Aggregator, Rollups, RollupTier
+from .instrumentation import STAGES, Stages
+from .logging import logger
+from .mcp3008 import MCP3008_SPIDEV, parse_binary, parse_text
+from .metrics import MetricsSnapshot
+from .power import POWER_DTYPE, SPECTRAL_TOLERANCE, compute_power
+from .samples import CHANNEL_NAMES, SAMPLES
+from .utils import collect_data2, readings_to_points, rollup_points
+
+DEFAULT_SIZES = [200, 400, 800, 1600]
+DEFAULT_REPEAT = 50
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_MAX_GROWTH = 16384
+# Milliseconds a scrape of the metrics endpoint may take while the database is stalled
+DEFAULT_SCRAPE_LIMIT_MS = 50
+
+
+class _InfluxHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.server.available:
+            self.send_response(503)
+            self.end_headers()
+            return
+        self.server.received += len(body)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.lines += body.count(b"\n") + 1
+        self.send_response(204)
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInInflux:
+    """Local HTTP endpoint accepting InfluxDB v2 writes, so writes can be timed without a database
+
+    Use as context manager, the port it listens on is in {port}. With {available} false, writes are answered
+    with 503 like by a database that is down.
+    """
+
+    def __init__(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _InfluxHandler)
+        self._server.received = 0
+        self._server.lines = 0
+        self._server.available = True
+        self.port = self._server.server_address[1]
+
+    @property
+    def received(self) -> int:
+        """Bytes received so far"""
+        return self._server.received
+
+    @property
+    def lines(self) -> int:
+        """Lines of line protocol received so far"""
+        return self._server.lines
+
+    @property
+    def available(self) -> bool:
+        return self._server.available
+
+    @available.setter
+    def available(self, available: bool):
+        self._server.available = available
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _BlockADC:
+    # Hands out the given blocks in turn, so only the processing gets timed
+    def __init__(self, blocks):
+        self._blocks = blocks
+        self._index = 0
+
+    def read_block(self, samples=200, channels="01234567"):
+        block = self._blocks[self._index % len(self._blocks)]
+        self._index += 1
+        if str(channels) != "01234567":
+            return block[:samples, [int(c) for c in str(channels)]]
+        return block
+
+
+class _FakeSpidev:
+    # Stands in for the spidev module, its SpiDev and fcntl.ioctl. Every frame is answered with the canned bytes the
+    # MCP3008 would send for the next conversion of {block}.
+    def __init__(self, block):
+        answers = numpy.zeros((*block.shape, 3), dtype=numpy.uint8)
+        answers[:, :, 1] = block >> 8
+        answers[:, :, 2] = block & 0xFF
+        self._frames = answers.reshape(-1, 3).tolist()
+        self._bytes = answers.tobytes()
+        self._next = 0
+
+    def SpiDev(self):
+        return self
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def fileno(self):
+        return -1
+
+    def xfer2(self, frame):
+        answer = self._frames[self._next]
+        self._next = (self._next + 1) % len(self._frames)
+        return answer
+
+    def ioctl(self, fd, request, transfers):
+        # The receive buffers of a message follow each other
+        size = 3 * len(transfers)
+        ctypes.memmove(transfers[0].rx_buf, self._bytes[self._next * 3 : self._next * 3 + size], size)
+        self._next = (self._next + len(transfers)) % len(self._frames)
+
+
+def _time(func, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {"median_us": round(timings[len(timings) // 2] * 1e6, 2), "min_us": round(timings[0] * 1e6, 2)}
+
+
+def _simulated_blocks(config, size, count=10):
+    from .simulator import MCP3008_SIMULATOR  # noqa: PLC0415
+
+    config.SIMULATOR.SPEED = 0
+    simulators = [MCP3008_SIMULATOR(config, device=i) for i in range(config.PHASES.COUNT)]
+    return [[simulator.read_block(samples=size) for _ in range(count)] for simulator in simulators]
+
+
+def _window(readings=DEFAULT_WINDOW_READINGS):
+    # A window of {readings} readings of phase 1
+    power = numpy.zeros(6, dtype=POWER_DTYPE)
+    power["Watts"], power["Current"], power["PF"] = 1000.0, 4.5, 0.95
+    aggregator = Aggregator(1, readings=readings)
+    now = time.time()
+    for i in range(readings):
+        power["Voltage"] = 230.0 + i
+        aggregator.add(0, power, now + i, now + i + 1)
+    return aggregator.take(0)
+
+
+def benchmark_size(meter, size: int, repeat: int, blocks=None, influx_port=None) -> dict:
+    """Times every stage at a block size of {size} samples
+
+    Args:
+        meter (RpiEnergyMeter): Meter whose config is used, its ADC_SAMPLES gets set to {size}
+        size (int): Samples per block
+        repeat (int): Repetitions per stage
+        blocks (list): Raw (size, 8) ADC blocks per phase to use instead of simulated ones
+        influx_port (int): Port of a StandInInflux to time the database writes against
+
+    Returns:
+        dict: Timing per stage
+    """
+    from .influxv2_interface import infv2db  # noqa: PLC0415
+
+    config = meter.config
+    config.GENERAL.ADC_SAMPLES = size
+    if blocks is None:
+        blocks = _simulated_blocks(config, size)
+    block = blocks[0][0]
+
+    results = {}
+    text = "".join(",".join(map(str, row)) + "\n" for row in block.tolist()).encode()
+    binary = block.astype("<u2").tobytes()
+    results["adc_parse_text"] = _time(lambda: parse_text(text, size, 8), repeat)
+    results["adc_parse_binary"] = _time(lambda: parse_binary(binary, size, 8), repeat)
+    # The spidev backend against a fake answering with canned bytes, a frame per xfer2 call and batched
+    for name, batch in (("adc_spidev", 1), ("adc_spidev_batched", None)):
+        fake = _FakeSpidev(block)
+        adc = MCP3008_SPIDEV(**({} if batch is None else {"batch": batch}), spidev_module=fake, ioctl=fake.ioctl)
+        results[name] = _time(lambda adc=adc: adc.read_block(samples=size), repeat)
+
+    measurements = SAMPLES(config, 1, totals=[{"Total": 0.0} for _ in range(6)])
+    adc = _BlockADC(blocks[0])
+    results["collect_data2"] = _time(lambda: collect_data2(config, 1, adc, measurements, size), repeat)
+
+    def shift_each():
+        for ct in range(config.CTS["1"].COUNT):
+            measurements.shift_phase(ct=ct)
+
+    # One CT after the other as calibration does it, and all CTs at once with either method
+    results["shift_phase_per_ct"] = _time(shift_each, repeat)
+    for method in ("fft", "fir"):
+        measurements._shift_method = method
+        results["shift_phase_" + method] = _time(measurements.shift_phase, repeat)
+    measurements._shift_method = config.GENERAL.get("SHIFT_METHOD", "fft")
+    results["calculate_power"] = _time(measurements.calculate_power, repeat)
+    # Both together are what calculate_power_spectral replaces
+    results["power_spectral"] = _time(measurements.calculate_power_spectral, repeat)
+
+    # The power engine on all phases at once, as opposed to calculate_power on one phase
+    stacked = numpy.stack([numpy.stack([measurements.samples[name] for name in CHANNEL_NAMES])] * config.PHASES.COUNT)
+    cutoffs = numpy.full((config.PHASES.COUNT, 6), 40.0)
+    results["compute_power_all_phases"] = _time(lambda: compute_power(stacked, cutoffs), repeat)
+    aggregator = Aggregator(1)
+    results["aggregate"] = _time(lambda: aggregator.add(0, measurements.power, 0.0, 1.0), repeat)
+    window = _window()
+    snapshot = MetricsSnapshot([config.CTS["1"].COUNT])
+    results["metrics_update"] = _time(lambda: snapshot.update(0, measurements.power, [0.0] * 6, 50.0, 1.0), repeat)
+    results["metrics_render"] = _time(snapshot.render, repeat)
+    results["to_point"] = _time(lambda: readings_to_points(config, 1, measurements, window), repeat)
+
+    # Points serialized by the client, against lines formatted right away
+    line_protocol = config.INFLUX.get("line_protocol", True)
+    config.INFLUX.line_protocol = False
+    results["serialize_points"] = _time(
+        lambda: "\n".join(point.to_line_protocol() for point in readings_to_points(config, 1, measurements, window)),
+        repeat,
+    )
+    config.INFLUX.line_protocol = True
+    results["serialize_lines"] = _time(lambda: readings_to_points(config, 1, measurements, window), repeat)
+    config.INFLUX.line_protocol = line_protocol
+
+    if influx_port is not None:
+        points = readings_to_points(config, 1, measurements, window)
+        db = infv2db(
+            token="benchmark", organization="benchmark", bucket="benchmark", host="127.0.0.1", port=influx_port
+        )
+        results["db_write"] = _time(lambda: db.write(points), repeat)
+        db.close()
+
+    # A full normal mode round over all phases: 5 readings per phase, averaging, energy integration and points
+    runtime = config.GENERAL.get("RUNTIME", "sequential")
+    for name, rounds_runtime in (("round", "sequential"), ("round_pipeline", "pipeline")):
+        config.GENERAL.RUNTIME = rounds_runtime
+        results[name] = _time(_round(meter, blocks), max(3, repeat // 10))
+    config.GENERAL.RUNTIME = runtime
+
+    # The same round with every stage timed, its difference to round is the cost of the instrumentation
+    stages, meter.stages = meter.stages, Stages(STAGES)
+    results["round_instrumented"] = _time(_round(meter, blocks), max(3, repeat // 10))
+    meter.stages = stages
+    return results
+
+
+def _round(meter, blocks):
+    from .influxv2_interface import NullDB  # noqa: PLC0415
+
+    config = meter.config
+    adcs = [_BlockADC(blocks[i % len(blocks)]) for i in range(config.PHASES.COUNT)]
+    phases = [SAMPLES(config, i + 1, totals=[{"Total": 0.0} for _ in range(6)]) for i in range(config.PHASES.COUNT)]
+    return lambda: meter._measure(adcs, phases, NullDB(), persist=False, rounds=1)
+
+
+def steady_state_memory(meter, blocks, rounds=5) -> dict:
+    """Traces the memory allocated by normal mode rounds once they are warmed up
+
+    In steady state a round must not keep any memory, the sample buffers of SAMPLES are reused.
+
+    Returns:
+        dict: net_bytes still allocated after {rounds} rounds, peak_bytes allocated at once while running them
+    """
+    measure_round = _round(meter, blocks)
+    measure_round()
+
+    tracemalloc.start()
+    try:
+        # Warm up while tracing, so objects replaced every round are traced in both measurements
+        for _ in range(rounds):
+            measure_round()
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _ in range(rounds):
+            measure_round()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"net_bytes": after - before, "peak_bytes": peak - before}
+
+
+def spectral_accuracy(meter, blocks) -> float:
+    """Largest difference of any power value between the spectral and the time domain calculation over {blocks}"""
+    config = meter.config
+    worst = 0.0
+    for phase, phase_blocks in enumerate(blocks[: config.PHASES.COUNT], start=1):
+        measurements = SAMPLES(config, phase, totals=[{"Total": 0.0} for _ in range(6)])
+        adc = _BlockADC(phase_blocks)
+        for _ in phase_blocks:
+            collect_data2(config, phase, adc, measurements, phase_blocks[0].shape[0])
+            spectral = measurements.calculate_power_spectral().copy()
+            measurements.shift_phase()
+            time_domain = measurements.calculate_power()
+            for field in POWER_DTYPE.names:
+                worst = max(worst, float(numpy.abs(spectral[field] - time_domain[field]).max()))
+    return worst
+
+
+def cycle_alignment_accuracy(meter, blocks) -> dict:
+    """Errors of Voltage and Watts over simulated {blocks} with and without cycle-aligned windows
+
+    The simulator's settings are the ground truth: the rms voltage of the phase and, for CTs without load steps,
+    VOLTAGE * CURRENT * cos(LAG) as real power (harmonics carry no real power at a sinusoidal voltage).
+
+    Returns:
+        dict: Relative rms error of "voltage" and "watts" per mode ("full", "aligned"), the share of the samples
+            the aligned windows used and the latency of a block in ms
+    """
+    config = meter.config
+    size = blocks[0][0].shape[0]
+    errors = {"full": {"voltage": [], "watts": []}, "aligned": {"voltage": [], "watts": []}}
+    used = []
+    previous = config.GENERAL.get("CYCLE_ALIGN", False)
+    try:
+        for mode, align in (("full", False), ("aligned", True)):
+            config.GENERAL.CYCLE_ALIGN = align
+            for phase, phase_blocks in enumerate(blocks[: config.PHASES.COUNT], start=1):
+                simulator = config.SIMULATOR.get(str(phase), {})
+                voltage = config.PHASES[str(phase)].VOLTAGE
+                stepped = {int(ct) - 1 for _, ct, _ in simulator.get("STEPS", [])}
+                watts = {
+                    ct: voltage * current * numpy.cos(lag)
+                    for ct, (current, lag) in enumerate(zip(simulator.get("CURRENT", []), simulator.get("LAG", [])))
+                    if current and ct not in stepped and ct < config.CTS[str(phase)].COUNT
+                }
+                measurements = SAMPLES(config, phase, totals=[{"Total": 0.0} for _ in range(6)])
+                adc = _BlockADC(phase_blocks)
+                for _ in phase_blocks:
+                    collect_data2(config, phase, adc, measurements, size)
+                    power = measurements.correct_and_calculate_power()
+                    errors[mode]["voltage"].append(power[0]["Voltage"] / voltage - 1)
+                    errors[mode]["watts"] += [power[ct]["Watts"] / value - 1 for ct, value in watts.items()]
+                    if align:
+                        used.append(len(range(size)[measurements.window]) / size)
+    finally:
+        config.GENERAL.CYCLE_ALIGN = previous
+
+    result = {
+        mode: {name: round(float(numpy.sqrt(numpy.mean(numpy.square(values)))), 6) for name, values in errors.items()}
+        for mode, errors in errors.items()
+    }
+    result["used"] = round(float(numpy.mean(used)), 4)
+    result["latency_ms"] = round(size / config.GENERAL.ADC_SAMPLERATE * 1000, 1)
+    return result
+
+
+def line_protocol_mismatches(meter, blocks) -> int:
+    """Compares the lines formatted by to_line with the line protocol of the Points built by to_point
+
+    Windows of {blocks} are turned into points both ways, in the legacy and the continuous mode and as rollup tier.
+
+    Returns:
+        int: Lines that differ, 0 if the payloads are byte for byte the same
+    """
+    config = meter.config
+    size = blocks[0][0].shape[0]
+    tier = RollupTier(name="1s", seconds=1.0, bucket=None, suffix="_1s")
+    previous = (config.GENERAL.get("CONTINUOUS", False), config.INFLUX.get("line_protocol", True))
+    mismatches = 0
+
+    def differing(points_of, *args) -> int:
+        # Every way gets its own copy, turning a window into points takes the duty cycle
+        payloads = []
+        for line_protocol in (False, True):
+            config.INFLUX.line_protocol = line_protocol
+            points = points_of(config, *copy.deepcopy(args))
+            payloads.append((points if line_protocol else "\n".join(p.to_line_protocol() for p in points)).split("\n"))
+        points, lines = payloads
+        return sum(a != b for a, b in zip(points, lines)) + abs(len(points) - len(lines))
+
+    try:
+        for continuous in (False, True):
+            config.GENERAL.CONTINUOUS = continuous
+            for phase, phase_blocks in enumerate(blocks[: config.PHASES.COUNT], start=1):
+                measurements = SAMPLES(config, phase, totals=[{"Total": 0.0} for _ in range(6)])
+                adc = _BlockADC(phase_blocks)
+                aggregator = Aggregator(1, readings=2)
+                rollups = Rollups([tier], 1)
+                for index in range(len(phase_blocks)):
+                    collect_data2(config, phase, adc, measurements, size)
+                    power = measurements.correct_and_calculate_power()
+                    # One block a second, so every block completes a window of the tier
+                    time_start = 1.7e9 + index
+                    time_end = time_start + size / config.GENERAL.ADC_SAMPLERATE
+                    if continuous:
+                        measurements.integrate_energy(power, time_start, time_end)
+                    if aggregator.add(0, power, time_start, time_end):
+                        window = aggregator.take(0)
+                        if not continuous:
+                            measurements.integrate_window(window)
+                        mismatches += differing(readings_to_points, phase, measurements, window)
+                    for _, window, energy in rollups.add(0, power, time_start, time_end):
+                        mismatches += differing(rollup_points, phase, tier, window, energy)
+    finally:
+        config.GENERAL.CONTINUOUS, config.INFLUX.line_protocol = previous
+    return mismatches
+
+
+def spool_backfill(meter, influx, outage=2.0, lines=100000) -> dict:
+    """Spools {lines} lines of points while {influx} is down for {outage} seconds and times the backfill afterwards
+
+    Returns:
+        dict: Lines written and received, seconds the backfill took, its lines per second and the bytes the
+            spool took on disk
+    """
+    from .influxv2_interface import infv2db  # noqa: PLC0415
+    from .spool import Spool  # noqa: PLC0415
+
+    config = meter.config
+    measurements = SAMPLES(config, 1, totals=[{"Total": 0.0} for _ in range(6)])
+    payload = readings_to_points(config, 1, measurements, _window())
+    if not isinstance(payload, str):
+        payload = "\n".join(point.to_line_protocol() for point in payload)
+    per_payload = payload.count("\n") + 1
+    received = influx.lines
+    influx.available = False
+    with tempfile.TemporaryDirectory() as directory:
+        spool = Spool(f"{directory}/spool.sqlite")
+        # A batch the client gave up on starts the spooling, the writes after it go to the spool as well
+        spool.append("benchmark", "ms", payload)
+        db = infv2db(
+            token="benchmark",
+            organization="benchmark",
+            bucket="benchmark",
+            host="127.0.0.1",
+            port=influx.port,
+            spool=spool,
+            backfill_rate=10**9,
+        )
+        written = per_payload
+        while written < lines:
+            db.write(payload, bucket="benchmark")
+            written += per_payload
+        size = spool.bytes
+        time.sleep(outage)
+        influx.available = True
+        start = time.perf_counter()
+        # The backfill notices at its next retry
+        while influx.lines == received and time.perf_counter() - start < 60:
+            time.sleep(0.001)
+        backfill_start = time.perf_counter()
+        while len(spool) and time.perf_counter() - start < 60:
+            time.sleep(0.001)
+        end = time.perf_counter()
+        db.close()
+    return {
+        "lines": written,
+        "received": influx.lines - received,
+        "seconds": round(end - start, 3),
+        "lines_per_s": round(written / max(end - backfill_start, 1e-6)),
+        "spool_bytes": size,
+    }
+
+
+class _StalledDB:
+    # Database whose writes hang for {stall} seconds, like a client waiting for an unreachable server
+    def __init__(self, stall):
+        self.stall = stall
+        self.writes = 0
+
+    def write(self, points, bucket=None):
+        self.writes += 1
+        time.sleep(self.stall)
+
+    def close(self):
+        pass
+
+
+def metrics_scrape(meter, blocks, stall=0.5, scrapes=20) -> dict:
+    """Scrapes the metrics endpoint while the measurement loop hangs in writes to a stalled database
+
+    The loop runs on a copy of {meter}, so the metrics of {meter} are left alone.
+
+    Returns:
+        dict: Median and largest time a scrape took in ms
+    """
+    from urllib.request import urlopen  # noqa: PLC0415
+
+    from .metrics import MetricsServer  # noqa: PLC0415
+
+    config = meter.config
+    db = _StalledDB(stall)
+    meter = copy.copy(meter)
+    meter.metrics = MetricsSnapshot([config.CTS[str(i + 1)].COUNT for i in range(config.PHASES.COUNT)], db=db)
+    server = MetricsServer(meter.metrics, 0, "127.0.0.1")
+    adcs = [_BlockADC(blocks[i % len(blocks)]) for i in range(config.PHASES.COUNT)]
+    phases = [SAMPLES(config, i + 1, totals=[{"Total": 0.0} for _ in range(6)]) for i in range(config.PHASES.COUNT)]
+    loop = threading.Thread(target=meter._measure, args=(adcs, phases, db), kwargs={"persist": False, "rounds": 2})
+    loop.start()
+    timings = []
+    try:
+        while not db.writes:
+            time.sleep(0.001)
+        for _ in range(scrapes):
+            start = time.perf_counter()
+            with urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+                response.read()
+            timings.append(time.perf_counter() - start)
+    finally:
+        loop.join()
+        server.close()
+    timings.sort()
+    return {
+        "median_ms": round(timings[len(timings) // 2] * 1000, 3),
+        "max_ms": round(timings[-1] * 1000, 3),
+        "stalled_writes": db.writes,
+    }
+
+
+def _capture_blocks(path, phases):
+    from .capture import CaptureReader  # noqa: PLC0415
+
+    capture = CaptureReader(path)
+    blocks = []
+    for phase in range(1, phases + 1):
+        indices = numpy.flatnonzero(capture.records["phase"] == phase)[:50]
+        if len(indices):
+            blocks.append([numpy.array(capture.records[index]["data"]) for index in indices])
+    if not blocks:
+        raise ValueError(f"{path} holds no blocks")
+    return capture.samples, blocks
+
+
+def check(results: dict, max_growth: int) -> list:
+    """Checks the {results} that have a limit of their own, no baseline needed
+
+    Returns:
+        list: (check, size, limit, now) of every block size whose rounds kept more than {max_growth} bytes,
+            whose spectral power values differ by more than SPECTRAL_TOLERANCE and whose lines differ from the Points,
+            the lines the spool lost, and scrapes slower than DEFAULT_SCRAPE_LIMIT_MS
+    """
+    failures = [
+        ("memory", size, max_growth, memory["net_bytes"])
+        for size, memory in results["memory"].items()
+        if memory["net_bytes"] > max_growth
+    ]
+    failures += [
+        ("power_spectral_accuracy", size, SPECTRAL_TOLERANCE, difference)
+        for size, difference in results["accuracy"].items()
+        if difference > SPECTRAL_TOLERANCE
+    ]
+    failures += [
+        ("line_protocol", size, 0, mismatches) for size, mismatches in results["line_protocol"].items() if mismatches
+    ]
+    spool = results["spool"]
+    if spool["received"] != spool["lines"]:
+        failures.append(("spool", "-", spool["lines"], spool["received"]))
+    scrape = results["metrics"]
+    if scrape["max_ms"] > DEFAULT_SCRAPE_LIMIT_MS:
+        failures.append(("metrics_scrape", "-", DEFAULT_SCRAPE_LIMIT_MS, scrape["max_ms"]))
+    return failures
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Compares the medians of {results} with {baseline}
+
+    Returns:
+        list: (stage, size, baseline, now) of every stage that got slower than {threshold}
+    """
+    regressions = []
+    table = PrettyTable(["Stage", "Samples", "Baseline [us]", "Now [us]", "Change"])
+    for stage, sizes in results["results"].items():
+        for size, timing in sizes.items():
+            before = baseline.get("results", {}).get(stage, {}).get(size)
+            if before is None:
+                continue
+            change = timing["median_us"] / before["median_us"] - 1 if before["median_us"] else 0.0
+            table.add_row([stage, size, before["median_us"], timing["median_us"], f"{change:+.1%}"])
+            if change > threshold:
+                regressions.append((stage, size, before["median_us"], timing["median_us"]))
+    logger.info("\n" + table.get_string())
+    return regressions
+
+
+def run_benchmark(config_path, output="benchmark.json", baseline=None) -> list:
+    """Runs the benchmark, stores the results to {output} and compares them with {baseline}
+
+    Args:
+        config_path (str): Path to config.toml
+        output (str): File the JSON results are written to
+        baseline (str): JSON results of an earlier run to compare with
+
+    Returns:
+        list: Failures and regressions found, see check() and compare()
+    """
+    from .energy_meter import RpiEnergyMeter  # noqa: PLC0415 — energy_meter imports this module lazily
+
+    meter = RpiEnergyMeter(config_path, False)
+    settings = meter.config.BENCHMARK
+    sizes = list(settings.get("SIZES", DEFAULT_SIZES))
+    repeat = int(settings.get("REPEAT", DEFAULT_REPEAT))
+    threshold = float(settings.get("THRESHOLD", DEFAULT_THRESHOLD))
+    max_growth = int(settings.get("MAX_GROWTH", DEFAULT_MAX_GROWTH))
+    blocks = None
+    if settings.get("CAPTURE"):
+        size, blocks = _capture_blocks(settings.CAPTURE, meter.config.PHASES.COUNT)
+        sizes = [size]
+
+    results = {
+        "created": time.time(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "data": settings.get("CAPTURE") or "simulator",
+        "results": {},
+        "memory": {},
+        "accuracy": {},
+        "cycle_alignment": {},
+        "line_protocol": {},
+        "spool": {},
+        "metrics": {},
+    }
+    with StandInInflux() as influx:
+        for size in sizes:
+            logger.info(f"... Benchmarking blocks of {size} samples")
+            meter = RpiEnergyMeter(config_path, False)
+            timings = benchmark_size(meter, size, repeat, blocks=blocks, influx_port=influx.port)
+            for stage, timing in timings.items():
+                results["results"].setdefault(stage, {})[str(size)] = timing
+            size_blocks = blocks or _simulated_blocks(meter.config, size)
+            results["memory"][str(size)] = steady_state_memory(meter, size_blocks)
+            results["accuracy"][str(size)] = spectral_accuracy(meter, size_blocks)
+            results["line_protocol"][str(size)] = line_protocol_mismatches(meter, size_blocks)
+            # A capture has no ground truth to compare with
+            if blocks is None:
+                results["cycle_alignment"][str(size)] = cycle_alignment_accuracy(meter, size_blocks)
+        results["spool"] = spool_backfill(meter, influx)
+        results["metrics"] = metrics_scrape(meter, size_blocks)
+
+    table = PrettyTable(["Stage", *[str(size) for size in sizes]])
+    for stage, timings in results["results"].items():
+        table.add_row([stage, *[timings.get(str(size), {}).get("median_us", "") for size in sizes]])
+    logger.info("Median duration in us per block size\n" + table.get_string())
+    for size, memory in results["memory"].items():
+        logger.info(f"... Rounds of {size} samples kept {memory['net_bytes']} bytes, peak {memory['peak_bytes']} bytes")
+    for size, difference in results["accuracy"].items():
+        logger.info(f"... Spectral power values of {size} samples differ by up to {difference} from the time domain")
+    for size, mismatches in results["line_protocol"].items():
+        logger.info(f"... {mismatches} lines of {size} samples differ between the line protocol and the Points")
+
+    spool = results["spool"]
+    logger.info(
+        f"... Spooled {spool['lines']} lines in {spool['spool_bytes']} bytes, {spool['received']} arrived "
+        f"within {spool['seconds']} seconds of the database being back, at {spool['lines_per_s']} lines/s"
+    )
+
+    scrape = results["metrics"]
+    logger.info(
+        f"... Scrapes of the metrics took {scrape['median_ms']} ms, at most {scrape['max_ms']} ms, "
+        f"while {scrape['stalled_writes']} writes to the database hung"
+    )
+
+    for size, alignment in results["cycle_alignment"].items():
+        logger.info(
+            f"... Blocks of {size} samples ({alignment['latency_ms']} ms): rms error of Watts "
+            f"{alignment['full']['watts']:.4%} full, {alignment['aligned']['watts']:.4%} aligned to cycles "
+            f"using {alignment['used']:.0%} of the samples"
+        )
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Results written to {output}")
+
+    failures = check(results, max_growth)
+    for name, size, limit, now in failures:
+        logger.error(f"Failed {name} at {size} samples: {now}, the limit is {limit}")
+    if baseline is None:
+        return failures
+    with open(baseline) as f:
+        regressions = compare(results, json.load(f), threshold)
+    for stage, size, before, now in regressions:
+        logger.error(f"Regression in {stage} at {size} samples: {before} -> {now}")
+    return failures + regressions
@@ -0,0 +1,211 @@
+"""
+Module to record raw ADC frames to a capture file and to replay them
+
+A capture file starts with a header describing the recording, followed by fixed size records which are only ever
+appended. That allows reading them back through numpy.memmap, no matter how long the recording is.
+
+    magic        8 bytes  b"RPEMCAP1"
+    length       uint32   length of the JSON document, little-endian
+    header       JSON     version, samples per block, channel count and channel layout per phase
+    padding               zero bytes up to the next multiple of 8
+    records               record_dtype(samples, channels), one per block and phase
+"""
+
+import json
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Union
+
+import numpy
+
+from .mcp3008 import ALL_CHANNELS
+
+MAGIC = b"RPEMCAP1"
+VERSION = 1
+
+
+def record_dtype(samples: int, channels: int = len(ALL_CHANNELS)) -> numpy.dtype:
+    """Layout of one record: timestamps of the block, phase it was taken on and the raw ADC frames"""
+    return numpy.dtype(
+        [
+            ("t_start", "<f8"),
+            ("t_end", "<f8"),
+            ("phase", "<u4"),
+            ("reserved", "<u4"),
+            ("data", "<u2", (samples, channels)),
+        ]
+    )
+
+
+def read_header(path: Union[str, Path]) -> tuple:
+    """Reads the header of a capture file
+
+    Returns:
+        tuple: (header dict, offset of the first record)
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        (length,) = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(length).decode())
+    if header.get("version") != VERSION:
+        raise ValueError(f"Unsupported capture file version {header.get('version')} in {path}")
+    offset = len(MAGIC) + 4 + length
+    return header, offset + (-offset % 8)
+
+
+class CaptureWriter:
+    """Appends blocks of raw ADC frames to a capture file
+
+    An existing file is appended to, as long as it was recorded with the same block size.
+
+    Args:
+        path (str|Path): Capture file
+        samples (int): Samples per block
+        layout (dict): Channel layout per phase, stored in the header for reference
+    """
+
+    def __init__(self, path: Union[str, Path], samples: int, layout: dict):
+        self.path = Path(path)
+        self.samples = samples
+        self._dtype = record_dtype(samples)
+        self._record = numpy.zeros(1, dtype=self._dtype)
+
+        if self.path.is_file() and self.path.stat().st_size > 0:
+            header, offset = read_header(self.path)
+            if header["samples"] != samples or header["channels"] != len(ALL_CHANNELS):
+                raise ValueError(f"{self.path} was recorded with {header['samples']} samples per block")
+            # Cut off a record that was only partially written when the last recording got interrupted
+            size = self.path.stat().st_size
+            os.truncate(self.path, size - (size - offset) % self._dtype.itemsize)
+            self._file = open(self.path, "ab")  # noqa: SIM115 — stays open until close()
+        else:
+            header = json.dumps(
+                {
+                    "version": VERSION,
+                    "samples": samples,
+                    "channels": len(ALL_CHANNELS),
+                    "layout": layout,
+                    "created": time.time(),
+                }
+            ).encode()
+            self._file = open(self.path, "wb")  # noqa: SIM115 — stays open until close()
+            self._file.write(MAGIC + struct.pack("<I", len(header)) + header)
+            self._file.write(b"\0" * (-(len(MAGIC) + 4 + len(header)) % 8))
+
+    def write(self, phase: int, t_start: float, t_end: float, data: numpy.ndarray) -> None:
+        """Appends a (samples, 8) block of raw ADC frames taken on {phase} between {t_start} and {t_end}"""
+        self._record["t_start"] = t_start
+        self._record["t_end"] = t_end
+        self._record["phase"] = phase
+        self._record["data"] = data
+        self._file.write(self._record.tobytes())
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class CaptureReader:
+    """Memory maps the records of a capture file
+
+    Args:
+        path (str|Path): Capture file
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.header, offset = read_header(self.path)
+        self.samples = self.header["samples"]
+        dtype = record_dtype(self.samples, self.header["channels"])
+        count = (self.path.stat().st_size - offset) // dtype.itemsize
+        if count > 0:
+            self.records = numpy.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+        else:
+            self.records = numpy.zeros(0, dtype=dtype)
+
+    @property
+    def phases(self) -> list:
+        """Phases that have records in the capture"""
+        return sorted(int(phase) for phase in numpy.unique(self.records["phase"]))
+
+    def duration(self) -> float:
+        """Time span covered by the capture in seconds"""
+        if len(self.records) == 0:
+            return 0.0
+        return float(self.records["t_end"].max() - self.records["t_start"].min())
+
+
+class MCP3008_REPLAY:
+    """Drop-in replacement for MCP3008_2 handing out the recorded blocks of one phase, as fast as they are read
+
+    Raises EOFError once all blocks of the phase have been handed out. The recorded times of the last block are in
+    {block_times}, the effective samples per second derived from them in {sample_rate}.
+
+    Args:
+        reader (CaptureReader): Capture to replay
+        phase (int): Phase whose blocks are replayed
+    """
+
+    def __init__(self, reader: CaptureReader, phase: int):
+        self.device = phase - 1
+        self._path = reader.path
+        self._records = reader.records
+        self._indices = numpy.flatnonzero(reader.records["phase"] == phase)
+        self._samples = reader.samples
+        self._index = 0
+        self._time = float(self._records["t_start"][self._indices[0]]) if len(self._indices) else 0.0
+        self.block_times = (self._time, self._time)
+        self.sample_rate = None
+        self._last = numpy.zeros((self._samples, reader.header["channels"]), dtype=numpy.uint16)
+
+    def __getstate__(self):
+        # The capture gets memory mapped again when unpickling, e.g. in a phase process
+        state = self.__dict__.copy()
+        del state["_records"], state["_last"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        reader = CaptureReader(self._path)
+        self._records = reader.records
+        self._last = numpy.zeros((self._samples, reader.header["channels"]), dtype=numpy.uint16)
+
+    def open(self):
+        """Nothing to open, present for compatibility with the other ADC backends"""
+
+    def close(self):
+        """Nothing to close, present for compatibility with the other ADC backends"""
+
+    def now(self) -> float:
+        """Recorded time after the last block handed out"""
+        return self._time
+
+    def read(self, channels=ALL_CHANNELS, samples=200):
+        """Reads {samples} samples of {channels} as a list of lists, one list of channel values per sample"""
+        return self.read_block(samples=samples, channels=channels).tolist()
+
+    def read_block(self, samples=200, channels=ALL_CHANNELS) -> numpy.ndarray:
+        """Hands out the next recorded block
+
+        Reads of single channels (the bias voltage) are answered from the last block instead of consuming one.
+
+        Returns:
+            numpy.ndarray: uint16 array of shape (samples, len(channels))
+        """
+        channels = str(channels)
+        if channels != ALL_CHANNELS:
+            return self._last[:samples, [int(c) for c in channels]]
+        if samples != self._samples:
+            raise ValueError(f"Capture holds blocks of {self._samples} samples, {samples} were requested")
+        if self._index >= len(self._indices):
+            raise EOFError(f"All {len(self._indices)} blocks of phase {self.device + 1} replayed")
+        record = self._records[self._indices[self._index]]
+        self._index += 1
+        self._time = float(record["t_end"])
+        self._last = record["data"]
+        self.block_times = (float(record["t_start"]), self._time)
+        duration = self.block_times[1] - self.block_times[0]
+        self.sample_rate = self._samples / duration if duration > 0 else None
+        return self._last
@@ -1,13 +1,22 @@
-import os
-import tempfile
-from datetime import datetime, timezone
 from pathlib import Path
-from typing import Union
+from typing import NamedTuple, Union
 
+import numpy
 import tomli
-import tomli_w
 from box import Box
 
+from .mcp3008 import ALL_CHANNELS
+from .power import POWER_METHODS
+
+# Settings the measurement loop was set up with, a reload that changes them is refused
+RESTART_SETTINGS = (
+    ("PHASES", "COUNT"),
+    ("GENERAL", "ADC_SAMPLES"),
+    ("GENERAL", "ADC_BACKEND"),
+    ("GENERAL", "RUNTIME"),
+    ("GENERAL", "CONTINUOUS"),
+)
+
 
 def load_config(path: Union[str, Path]) -> Box:
     """
@@ -29,37 +38,213 @@ def load_config(path: Union[str, Path]) -> Box:
     return Box(data, default_box=True, frozen_box=False)
 
 
-def write_config(path: Union[str, Path], config: Box) -> None:
-    path = Path(path)
-    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
-    try:
-        with os.fdopen(fd, "wb") as f:
-            tomli_w.dump(config.to_dict(), f)
-        os.replace(tmp, path)
-    except Exception:
-        os.unlink(tmp)
-        raise
-
-
-def read_total_kwh(config) -> list:
-    totals = [[{"Total": 0.00} for ct in range(6)] for phase in range(config.PHASES.COUNT)]
-
-    for phase in range(config.PHASES.COUNT):
-        for ct in range(config.CTS.get(str(phase + 1)).COUNT):
-            totals[phase][ct]["Total"] = config.CTS.get(str(phase + 1)).get(str(ct + 1)).KWH
-
-    return totals
-
-
-def save_total_kwh(config, measurements):
-    for phase in range(config.PHASES.COUNT):
-        for ct in range(config.CTS.get(str(phase + 1)).COUNT):
-            if (
-                config.CTS.get(str(phase + 1)).get(str(ct + 1)).get("RESET_UTC") == "1970-1-1 00:00:00.000000"
-                or float(config.CTS.get(str(phase + 1)).get(str(ct + 1)).KWH) > measurements[phase]._energy[ct]["Total"]
-            ):
-                # config.CTS.get(str(phase + 1)).get(str(ct + 1)).set("RESET_UTC", str(datetime.now(timezone.utc)))
-                config.CTS[str(phase + 1)][str(ct + 1)].RESET_UTC = str(datetime.now(timezone.utc))
-
-            # config.CTS.get(str(phase + 1)).get(str(ct + 1)).set("KWH", float(measurements[phase]._energy[ct]['Total']))
-            config.CTS[str(phase + 1)][str(ct + 1)].KWH = float(measurements[phase]._energy[ct]["Total"])
+class PhaseConfig(NamedTuple):
+    """Settings of one phase the measurement uses for every block, arrays are read-only
+
+    Attributes:
+        ct_count (int): CTs connected to the phase
+        channels (numpy.ndarray): ADC channel of the voltage and of ct1 - ct6
+        bias (int): ADC channel of the bias voltage
+        scale (numpy.ndarray): Factor turning bias corrected ADC values of the voltage and ct1 - ct6 into volts and
+            amperes, without the correction factors
+        vac_factor (float): Correction factor of the voltage
+        bias_factor (float): Correction factor of the bias voltage
+        ct_factors (numpy.ndarray): Correction factor of ct1 - ct6
+        shifts (numpy.ndarray): Phase shift of ct1 - ct6 in radians
+        cutoffs (numpy.ndarray): Power of ct1 - ct6 in W below which it is reported as 0
+    """
+
+    ct_count: int
+    channels: numpy.ndarray
+    bias: int
+    scale: numpy.ndarray
+    vac_factor: float
+    bias_factor: float
+    ct_factors: numpy.ndarray
+    shifts: numpy.ndarray
+    cutoffs: numpy.ndarray
+
+
+class RuntimeConfig(NamedTuple):
+    """Settings the measurement loop uses for every block, resolved and validated once by compile_config()
+
+    Attributes:
+        phases (tuple): PhaseConfig per phase
+        samples (int): GENERAL.ADC_SAMPLES
+        sample_rate (float): GENERAL.ADC_SAMPLERATE
+        frequency (float): PHASES.FREQUENCY
+        shift_method (str): GENERAL.SHIFT_METHOD
+        fir_max_samples (int): GENERAL.SHIFT_FIR_MAX_SAMPLES
+        power_method (str): GENERAL.POWER_METHOD
+        cycle_align (bool): GENERAL.CYCLE_ALIGN
+        frequency_tracking (bool): GENERAL.FREQUENCY_TRACKING
+        continuous (bool): GENERAL.CONTINUOUS
+    """
+
+    phases: tuple
+    samples: int
+    sample_rate: float
+    frequency: float
+    shift_method: str
+    fir_max_samples: int
+    power_method: str
+    cycle_align: bool
+    frequency_tracking: bool
+    continuous: bool
+
+
+def compile_config(config: Box) -> RuntimeConfig:
+    """Resolves the settings of {config} the measurement loop uses for every block into a RuntimeConfig
+
+    The CTs beyond CTS.<phase>.COUNT may be left out of the config, they get channel 0 and neutral values.
+
+    Raises:
+        ValueError: Listing every setting that is missing or invalid
+    """
+    from .samples import DEFAULT_FIR_MAX_SAMPLES, SHIFT_METHODS  # noqa: PLC0415 — samples imports this module
+
+    errors = []
+
+    def number(value, name: str, positive: bool = False) -> float:
+        if isinstance(value, Box) and not value:
+            errors.append(f"{name} is missing")
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            errors.append(f"{name} must be a number, not {value!r}")
+        elif positive and value <= 0:
+            errors.append(f"{name} must be positive, not {value!r}")
+        else:
+            return float(value)
+        return 1.0
+
+    def integer(value, name: str, low: int, high=None) -> int:
+        if isinstance(value, Box) and not value:
+            errors.append(f"{name} is missing")
+        elif (
+            isinstance(value, bool) or not isinstance(value, int) or value < low or (high is not None and value > high)
+        ):
+            limits = f"from {low} to {high}" if high is not None else f"of at least {low}"
+            errors.append(f"{name} must be a whole number {limits}, not {value!r}")
+        else:
+            return value
+        return low
+
+    def read_only(values, dtype=numpy.float64) -> numpy.ndarray:
+        array = numpy.array(values, dtype=dtype)
+        array.flags.writeable = False
+        return array
+
+    general = config.GENERAL
+    shift_method = general.get("SHIFT_METHOD", "fft")
+    if shift_method not in SHIFT_METHODS:
+        errors.append(f"Unknown SHIFT_METHOD {shift_method!r}, expected one of {', '.join(SHIFT_METHODS)}")
+    power_method = general.get("POWER_METHOD", "time")
+    if power_method not in POWER_METHODS:
+        errors.append(f"Unknown POWER_METHOD {power_method!r}, expected one of {', '.join(POWER_METHODS)}")
+
+    vref = number(general.VREF, "GENERAL.VREF", positive=True)
+    resolution = number(general.ADC_RESOLUTION, "GENERAL.ADC_RESOLUTION", positive=True)
+    adc_factor_ct = (vref / resolution) / (
+        number(config.CTS.BURDEN_RESISTANCE, "CTS.BURDEN_RESISTANCE", positive=True)
+        / number(config.CTS.WINDING_RATIO, "CTS.WINDING_RATIO", positive=True)
+    )
+    vdivider = number(config.PHASES.TRANSFORMER_VDIVIDER, "PHASES.TRANSFORMER_VDIVIDER", positive=True)
+    last_channel = len(ALL_CHANNELS) - 1
+
+    phases = []
+    for phase in range(1, integer(config.PHASES.COUNT, "PHASES.COUNT", 1, 3) + 1):
+        cts = config.CTS[str(phase)]
+        voltmeter = config.VOLTMETER[str(phase)]
+        settings = config.PHASES[str(phase)]
+        ct_count = integer(cts.COUNT, f"CTS.{phase}.COUNT", 1, 6)
+        adc_factor_vac = (vref / resolution) * (
+            number(settings.VOLTAGE, f"PHASES.{phase}.VOLTAGE", positive=True)
+            / (
+                number(settings.TRANSFORMER_OUTPUT_VOLTAGE, f"PHASES.{phase}.TRANSFORMER_OUTPUT_VOLTAGE", positive=True)
+                / vdivider
+            )
+        )
+
+        channels = [integer(voltmeter.VAC.CHANNEL, f"VOLTMETER.{phase}.VAC.CHANNEL", 0, last_channel)]
+        factors, shifts, cutoffs = [], [], []
+        for ct in range(1, 7):
+            name = f"CTS.{phase}.{ct}"
+            if ct <= ct_count:
+                ct_config = cts[str(ct)]
+            else:
+                # CTs that aren't connected only fill the fixed layout of the buffers
+                ct_config = Box({"CHANNEL": 0, "FACTOR": 1.0, "SHIFT": 0.0, "CUTOFF": 0.0, **cts.get(str(ct), {})})
+            channels.append(integer(ct_config.CHANNEL, f"{name}.CHANNEL", 0, last_channel))
+            factors.append(number(ct_config.FACTOR, f"{name}.FACTOR"))
+            shifts.append(number(ct_config.SHIFT, f"{name}.SHIFT"))
+            cutoffs.append(number(ct_config.CUTOFF, f"{name}.CUTOFF"))
+            if cutoffs[-1] < 0:
+                errors.append(f"{name}.CUTOFF must not be negative, not {cutoffs[-1]!r}")
+
+        phases.append(
+            PhaseConfig(
+                ct_count=ct_count,
+                channels=read_only(channels, dtype=numpy.intp),
+                bias=integer(voltmeter.BIAS.CHANNEL, f"VOLTMETER.{phase}.BIAS.CHANNEL", 0, last_channel),
+                scale=read_only([adc_factor_vac] + [adc_factor_ct] * 6),
+                vac_factor=number(voltmeter.VAC.FACTOR, f"VOLTMETER.{phase}.VAC.FACTOR"),
+                bias_factor=number(voltmeter.BIAS.FACTOR, f"VOLTMETER.{phase}.BIAS.FACTOR"),
+                ct_factors=read_only(factors),
+                shifts=read_only(shifts),
+                cutoffs=read_only(cutoffs),
+            )
+        )
+
+    runtime = RuntimeConfig(
+        phases=tuple(phases),
+        samples=integer(general.ADC_SAMPLES, "GENERAL.ADC_SAMPLES", 2),
+        sample_rate=number(general.ADC_SAMPLERATE, "GENERAL.ADC_SAMPLERATE", positive=True),
+        frequency=number(config.PHASES.FREQUENCY, "PHASES.FREQUENCY", positive=True),
+        shift_method=shift_method,
+        fir_max_samples=integer(
+            general.get("SHIFT_FIR_MAX_SAMPLES", DEFAULT_FIR_MAX_SAMPLES), "GENERAL.SHIFT_FIR_MAX_SAMPLES", 0
+        ),
+        power_method=power_method,
+        cycle_align=bool(general.get("CYCLE_ALIGN", False)),
+        frequency_tracking=bool(general.get("FREQUENCY_TRACKING", True)),
+        continuous=bool(general.get("CONTINUOUS", False)),
+    )
+    if errors:
+        raise ValueError("Invalid config: " + "; ".join(errors))
+    return runtime
+
+
+def restart_settings(old: Box, new: Box) -> list:
+    """Settings of RESTART_SETTINGS and CTS.<phase>.COUNT that differ between {old} and {new}, as SECTION.KEY
+
+    The CTs per phase size the metrics and the state file, so they can't change while running either.
+    """
+    settings = [*RESTART_SETTINGS, *((f"CTS.{phase + 1}", "COUNT") for phase in range(old.PHASES.COUNT))]
+    return [
+        f"{section}.{key}"
+        for section, key in settings
+        if _section(old, section).get(key) != _section(new, section).get(key)
+    ]
+
+
+def _section(config: Box, section: str) -> Box:
+    for name in section.split("."):
+        config = config.get(name, {})
+    return config
+
+
+def reload_config(path: Union[str, Path], config: Box) -> tuple:
+    """Loads {path} again for a meter running with {config}
+
+    Returns:
+        tuple: The new config and its RuntimeConfig
+
+    Raises:
+        OSError: The file can't be read
+        ValueError: The file is invalid or changes settings that need a restart, see restart_settings()
+    """
+    new = load_config(path)
+    runtime = compile_config(new)
+    changed = restart_settings(config, new)
+    if changed:
+        raise ValueError(f"{', '.join(changed)} can only be changed by a restart")
+    return new, runtime
@@ -2,28 +2,46 @@
 module that acts as the main
 """
 
+import contextlib
 import logging
 import pickle
+import signal
 import sys
+import threading
 import time
 import timeit
-from copy import copy
+from pathlib import Path
 from textwrap import dedent
 from typing import Any, Union
 
-from .config import load_config, read_total_kwh, save_total_kwh, write_config
-from .influxv2_interface import infv2db
+from .config import compile_config, load_config, reload_config
+from .instrumentation import Stages
 from .logging import logger
+from .pipeline import RUNTIMES, Pipeline, Readings
 from .plotting import plot_data
-from .samples import SAMPLES
-from .utils import collect_data2, dump_data, get_ip, print_results, to_point
+from .samples import CHANNEL_NAMES, SAMPLES, clear_shift_cache
+from .stream import DEFAULT_STREAM_SLOTS, BlockStream
+from .utils import collect_data2, dump_data, get_ip, print_results
+
+# Modes that stop before the measurement loop, any other command runs the normal mode
+MODES = ("startup-profile", "speedtest", "benchmark", "debug", "calibration", "record", "replay")
 
 
 class RpiEnergyMeter:
     def __init__(self, config: Any, verbose: bool) -> None:
         self.config = load_config(config)
+        # Validated right away, so a broken config stops the meter before it touches the hardware
+        self.runtime = compile_config(self.config)
         self.config_path = config
+        # Set by SIGHUP in normal mode, the measurement loop then reloads the config between two blocks
+        self.reload_requested = threading.Event()
         self.verbose = verbose
+        # Snapshot of the latest readings served by the metrics endpoint, normal mode only
+        self.metrics = None
+        # Energy totals saved by the measurement loop, normal mode only
+        self.state = None
+        # Latency histograms of the stages in INSTRUMENTATION.STAGES
+        self.stages = Stages.from_config(self.config)
 
     def run(self, command: Union[Any, None], **kwargs):
 
@@ -36,25 +54,81 @@ class RpiEnergyMeter:
             logger.debug("No command provided. Running normal mode")
             command = ""
 
-        from rpi_energy_meter.mcp3008 import MCP3008_2  # noqa: PLC0415
+        arguments = kwargs.get("arguments") or []
+
+        if command.lower() == "startup-profile":
+            # This mode starts the normal mode in a fresh interpreter up to its first sample and reports the time every step and import took.
+            from rpi_energy_meter.startup import run_startup_profile  # noqa: PLC0415
+
+            over_budget = run_startup_profile(self.config_path, output=arguments[0] if arguments else None)
+            sys.exit(1 if over_budget else 0)
 
         logger.debug(f"... Initializing ADC instances for {self.config.PHASES.COUNT} Phases")
-        ADC = [MCP3008_2(device=i) for i in range(self.config.PHASES.COUNT)]
+        if command.lower() == "replay":
+            from rpi_energy_meter.capture import MCP3008_REPLAY, CaptureReader  # noqa: PLC0415
+
+            capture = CaptureReader(arguments[0] if arguments else "capture.bin")
+            # Blocks are replayed as recorded, the config only provides the scaling
+            self.config.GENERAL.ADC_SAMPLES = capture.samples
+            self.runtime = compile_config(self.config)
+            ADC = [MCP3008_REPLAY(capture, i + 1) for i in range(self.config.PHASES.COUNT)]
+        else:
+            from rpi_energy_meter.mcp3008 import create_adc  # noqa: PLC0415
+
+            ADC = [create_adc(self.config, device=i) for i in range(self.config.PHASES.COUNT)]
+
+        totals = [[{"Total": 0.00} for ct in range(6)] for phase in range(self.config.PHASES.COUNT)]
+        if command.lower() not in MODES:
+            from rpi_energy_meter.state import DEFAULT_FLUSH_SECONDS, StateStore  # noqa: PLC0415
+
+            # The totals live in a state file next to the config, which is only ever read
+            self.state = StateStore(
+                self.config.STATE.get("PATH") or Path(self.config_path).with_name("energy.state"),
+                self.config,
+                flush=float(self.config.STATE.get("FLUSH_SECONDS", DEFAULT_FLUSH_SECONDS)),
+            )
+            totals = self.state.totals()
 
         logger.debug(f"... Initializing Measurement instances for {self.config.PHASES.COUNT} Phases")
         MEASUREMENTS = [
-            SAMPLES(self.config, i + 1, totals=read_total_kwh(self.config)[i]) for i in range(self.config.PHASES.COUNT)
+            SAMPLES(self.config, i + 1, totals=totals[i], runtime=self.runtime) for i in range(self.config.PHASES.COUNT)
         ]
 
         if command.lower() == "speedtest":
             # This mode is intended to measure the performance of the measurement process
+            # Use 'benchmark' for timings of the individual stages.
+            blocks = 0
+            interval_start = timeit.default_timer()
             while True:
                 try:
                     for i in range(self.config.PHASES.COUNT):
                         collect_data2(self.config, i + 1, ADC[i], MEASUREMENTS[i], self.config.GENERAL.ADC_SAMPLES)
+                    blocks += self.config.PHASES.COUNT
+
+                    took = timeit.default_timer() - interval_start
+                    if took >= 10:
+                        logger.info(
+                            f"{round(blocks / took, 1)} blocks / second, "
+                            f"{round(8 * self.config.GENERAL.ADC_SAMPLES * blocks / took / 1000, 2)} KSPS"
+                        )
+                        blocks = 0
+                        interval_start = timeit.default_timer()
                 except KeyboardInterrupt:
+                    for adc in ADC:
+                        adc.close()
                     sys.exit()
 
+        if command.lower() == "benchmark":
+            # This mode times every stage of the measurement on synthetic or recorded data and compares the results to a baseline.
+            from rpi_energy_meter.benchmark import run_benchmark  # noqa: PLC0415
+
+            regressions = run_benchmark(
+                self.config_path,
+                output=arguments[0] if arguments else "benchmark.json",
+                baseline=arguments[1] if len(arguments) > 1 else None,
+            )
+            sys.exit(1 if regressions else 0)
+
         if command.lower() == "debug":
             # This mode is intended to take a look at the raw CT sensor data.  It will take ADC_SAMPLES samples from each CT sensor, plot them to a single chart, write the chart to an HTML file located in /var/www/html/, and then terminate.
             # It also stores the samples to a file located in ./data/samples/last-debug.pkl so that the sample data can be read when this program is started in 'phase' mode.
@@ -74,7 +148,7 @@ class RpiEnergyMeter:
                 logger.debug(f"Finished Collecting Samples for Phase {i + 1}. Sample Rate: {sample_rate} KSPS")
                 logger.debug(f"Calculating Values for Phase {i + 1}.")
 
-                MEASUREMENTS[i].calculate_power(i + 1, self.config)
+                MEASUREMENTS[i].calculate_power()
 
                 logger.debug(f"Writing debug files to disk for Phase {i + 1}.")
                 with open("./last-debug-phase" + str(i + 1) + ".pkl", "wb") as f:
@@ -141,7 +215,7 @@ class RpiEnergyMeter:
                 self.config.GENERAL.ADC_SAMPLES,
             )
 
-            results = MEASUREMENTS[phase_selection].calculate_power(phase_selection + 1, self.config)
+            results = MEASUREMENTS[phase_selection].calculate_power()
 
             # Get the current power factor and check to make sure it is not negative. If it is, the CT is installed opposite to how it should be.
             pf = results[ct_selection]["PF"]
@@ -161,7 +235,7 @@ class RpiEnergyMeter:
                     MEASUREMENTS[phase_selection],
                     self.config.GENERAL.ADC_SAMPLES,
                 )
-                results = MEASUREMENTS[phase_selection].calculate_power(phase_selection + 1, self.config)
+                results = MEASUREMENTS[phase_selection].calculate_power()
                 pf = results[ct_selection]["PF"]
                 if pf < 0:
                     logger.info(
@@ -170,7 +244,8 @@ class RpiEnergyMeter:
                     )
                     sys.exit()
 
-            old_wave = copy(MEASUREMENTS[phase_selection].samples)
+            # The samples are views into the buffer that shift_phase modifies, so they have to be copied
+            old_wave = {name: values.copy() for name, values in MEASUREMENTS[phase_selection].samples.items()}
             phaseshift = MEASUREMENTS[phase_selection].calculate_phaseshift(ct=ct_selection)
             print(f"Alt {phaseshift}")
 
@@ -183,7 +258,77 @@ class RpiEnergyMeter:
             logger.info(f"file written to {report_title}.html")
             sys.exit()
 
+        if command.lower() == "record":
+            # This mode streams the raw ADC frames of all phases into a capture file, until the given amount of seconds passed or Ctrl-c is pressed.
+            # The capture can be fed back through the measurement with 'replay'.
+            from rpi_energy_meter.capture import CaptureWriter  # noqa: PLC0415
+
+            layout = {
+                str(i + 1): {
+                    "bias": MEASUREMENTS[i].channel_map.bias,
+                    **dict(zip(CHANNEL_NAMES, MEASUREMENTS[i].channel_map.channels.tolist())),
+                }
+                for i in range(self.config.PHASES.COUNT)
+            }
+            writer = CaptureWriter(
+                arguments[0] if arguments else "capture.bin", self.config.GENERAL.ADC_SAMPLES, layout
+            )
+            duration = float(arguments[1]) if len(arguments) > 1 else None
+            clocks = [getattr(adc, "now", time.time) for adc in ADC]
+
+            logger.info(f"Recording to {writer.path}. Press Ctrl-c to stop")
+            record_start = time.time()
+            blocks = 0
+            try:
+                while duration is None or time.time() - record_start < duration:
+                    for i in range(self.config.PHASES.COUNT):
+                        t_start = clocks[i]()
+                        data = ADC[i].read_block(samples=self.config.GENERAL.ADC_SAMPLES)
+                        writer.write(i + 1, *getattr(ADC[i], "block_times", (t_start, clocks[i]())), data)
+                        blocks += 1
+            except KeyboardInterrupt:
+                pass
+            finally:
+                writer.close()
+                for adc in ADC:
+                    adc.close()
+            logger.info(f"Recorded {blocks} blocks in {round(time.time() - record_start, 2)} seconds to {writer.path}")
+            sys.exit()
+
+        if command.lower() == "replay":
+            # This mode feeds a capture taken with 'record' through the normal measurement loop as fast as the CPU allows.
+            # Nothing gets written to InfluxDB or the config.
+            from rpi_energy_meter.influxv2_interface import NullDB  # noqa: PLC0415
+
+            replay_start = timeit.default_timer()
+            DB = NullDB()
+            with contextlib.suppress(EOFError):
+                self._measure(ADC, MEASUREMENTS, DB, persist=False)
+            took = timeit.default_timer() - replay_start
+
+            logger.info(
+                f"Replayed {len(capture.records)} blocks covering {round(capture.duration(), 2)} seconds in {round(took, 2)} seconds "
+                f"({round(capture.duration() / took, 1)} x real time). {DB.points} points would have been written."
+            )
+            for i in range(self.config.PHASES.COUNT):
+                kwh = [
+                    round(float(MEASUREMENTS[i]._energy[ct]["Total"]), 6)
+                    for ct in range(self.config.CTS[str(i + 1)].COUNT)
+                ]
+                logger.info(f"... Energy of Phase {i + 1} in kWh: {kwh}")
+            sys.exit()
+
         # Normal mode from here
+        spool = None
+        if self.config.SPOOL.get("PATH"):
+            from rpi_energy_meter.spool import DEFAULT_SPOOL_MAX_BYTES, Spool  # noqa: PLC0415
+
+            spool = Spool(self.config.SPOOL.PATH, self.config.SPOOL.get("MAX_BYTES", DEFAULT_SPOOL_MAX_BYTES))
+            if len(spool):
+                logger.info(f"... {len(spool)} lines in {spool.path} are waiting to be written")
+
+        from rpi_energy_meter.influxv2_interface import BACKFILL_RATE, infv2db  # noqa: PLC0415
+
         logger.debug("Initializing InfluxDBv2 instance")
         DB = infv2db(
             token=self.config.INFLUX.token,
@@ -191,103 +336,138 @@ class RpiEnergyMeter:
             bucket=self.config.INFLUX.bucket,
             host=self.config.INFLUX.host,
             port=self.config.INFLUX.port,
+            gzip=self.config.INFLUX.get("gzip", False),
+            spool=spool,
+            backfill_rate=self.config.SPOOL.get("BACKFILL_RATE", BACKFILL_RATE),
         )
 
-        logger.info("Starting Raspberry Pi Power Monitor")
-        logger.info("... Press Ctrl-c to quit...")
+        if self.config.METRICS.get("PORT"):
+            from rpi_energy_meter.metrics import DEFAULT_METRICS_HOST, MetricsServer, MetricsSnapshot  # noqa: PLC0415
 
-        # The following empty dictionaries will hold the respective calculated values at the end of each polling cycle, which are then averaged prior to storing the value to the DB.
-        rms_voltages = [[] for _ in range(self.config.PHASES.COUNT)]
-        ct_currents = [
-            [{"power": [], "pf": [], "current": []} for ct in range(6)] for phase in range(self.config.PHASES.COUNT)
-        ]
-        averages = [0 for _ in range(self.config.PHASES.COUNT)]  # Counter for aggregate function
-        time_energy = [0.00 for _ in range(self.config.PHASES.COUNT)]
-        timestamp = [0 for _ in range(self.config.PHASES.COUNT)]
-        round_start = 0.0
+            self.metrics = MetricsSnapshot(
+                [self.config.CTS[str(i + 1)].COUNT for i in range(self.config.PHASES.COUNT)], db=DB
+            )
+            server = MetricsServer(
+                self.metrics, int(self.config.METRICS.PORT), self.config.METRICS.get("HOST", DEFAULT_METRICS_HOST)
+            )
+            logger.info(f"... Serving metrics on port {server.port}")
+
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_requested.set())
+
+        logger.info("Starting Raspberry Pi Power Monitor")
+        logger.info("... Press Ctrl-c to quit, send SIGHUP to reload the config...")
+        self._measure(ADC, MEASUREMENTS, DB)
+
+    def apply_reload(self, MEASUREMENTS, readings) -> bool:
+        """Loads the config again after a SIGHUP and swaps it in, called by the measurement loop between two blocks
+
+        The SAMPLES instances take over the new factors, shifts, cutoffs and methods together with the channel maps,
+        and the cached correction factors and kernels are dropped, so no block is calculated with a mix of both
+        configs. The energy totals stay. Settings only read when the loop starts, like the InfluxDB connection, the
+        spool, the metrics endpoint, the state file, windows and rollups, keep their values until a restart.
+
+        Args:
+            MEASUREMENTS (list): SAMPLES instance per phase
+            readings (Readings): Readings of the loop, they write the points with the new config
+
+        Returns:
+            bool: The new config is in use, the old one stays if the file is invalid or changes RESTART_SETTINGS
+        """
+        self.reload_requested.clear()
+        try:
+            config, runtime = reload_config(self.config_path, self.config)
+        except (OSError, ValueError) as error:
+            logger.error(f"... Keeping the running config, {self.config_path} can't be reloaded: {error}")
+            return False
+        clear_shift_cache()
+        for measurements in MEASUREMENTS:
+            measurements.reconfigure(config, runtime)
+        readings.reconfigure(config)
+        self.config, self.runtime = config, runtime
+        logger.info(f"... Reloaded {self.config_path}")
+        return True
+
+    def _measure(self, ADC, MEASUREMENTS, DB, persist=True, rounds=None):
+        """Runs the measurement loop: averages readings of every phase, integrates the energy and writes them to {DB}
+
+        Args:
+            ADC (list): ADC instance per phase
+            MEASUREMENTS (list): SAMPLES instance per phase
+            DB (infv2db): Database to write the points to
+            persist (bool): Save the energy totals to the state file after every round and on exit
+            rounds (int): Return after this many rounds (including their writes) instead of running forever
+        """
+        runtime = self.config.GENERAL.get("RUNTIME", "sequential")
+        if runtime not in RUNTIMES:
+            raise ValueError(f"Unknown RUNTIME {runtime!r}, expected one of {', '.join(RUNTIMES)}")
+        self.stages.attach(ADC, MEASUREMENTS)
+        if runtime == "pipeline":
+            return Pipeline(self, ADC, MEASUREMENTS, DB, persist=persist, rounds=rounds).run()
+        if runtime == "multiprocess":
+            from rpi_energy_meter.processes import PhaseProcesses  # noqa: PLC0415 — deferred: only used in this runtime
+
+            return PhaseProcesses(self, ADC, MEASUREMENTS, DB, persist=persist, rounds=rounds).run()
+
+        # In continuous mode the ADCs sample back-to-back while the blocks before are calculated, and every block is
+        # integrated into the energy totals on its own
+        continuous = self.config.GENERAL.get("CONTINUOUS", False)
+        streams = []
+        if continuous:
+            slots = int(self.config.GENERAL.get("STREAM_SLOTS", DEFAULT_STREAM_SLOTS))
+            streams = [BlockStream(adc, self.config.GENERAL.ADC_SAMPLES, slots) for adc in ADC]
+            ADC = streams
+
+        # Round logging would only slow down replays
+        log_round = logger.info if persist else logger.debug
+
+        # The readings of every phase are aggregated into windows, each of them gets written to the DB as points
+        readings = Readings(self.config, MEASUREMENTS, metrics=self.metrics, stages=self.stages)
+        db_timer = self.stages.get("db_write")
+        persist_timer = self.stages.get("persist")
+        rounds_done = 0
+        round_start = time.time()
+        # Neither changes while the loop runs, a reload that would change them is refused
+        phases = len(MEASUREMENTS)
+        samples = self.config.GENERAL.ADC_SAMPLES
+        log_round("Starting new round")
 
         while True:
             try:
-                if averages[0] == 0:
-                    logger.info("Starting new round")
+                if self.reload_requested.is_set():
+                    self.apply_reload(MEASUREMENTS, readings)
+                for phase in range(phases):
+                    collect_data2(self.config, phase + 1, ADC[phase], MEASUREMENTS[phase], samples, stages=self.stages)
+                    results = MEASUREMENTS[phase].correct_and_calculate_power()
+                    times = MEASUREMENTS[phase].t
+                    writes = readings.add(phase, results, float(times[0]), float(times[-1]))
+                    for bucket, points in writes:
+                        start = time.perf_counter()
+                        DB.write(points, bucket=bucket)
+                        if db_timer is not None:
+                            db_timer.add(time.perf_counter() - start)
+                    if writes and logger.level == logging.DEBUG:
+                        print_results(self.config, phase + 1, ADC[phase], results)
+
+                if readings.rounds > rounds_done:
+                    rounds_done += 1
+                    log_round(f"Stopped the Round. Took {time.time() - round_start} seconds to do the Round :)")
+                    if persist:
+                        start = time.perf_counter()
+                        # Rounds the totals aren't saved in don't count
+                        if self.state.save(MEASUREMENTS) and persist_timer is not None:
+                            persist_timer.add(time.perf_counter() - start)
+                    if rounds is not None and rounds_done == rounds:
+                        for stream in streams:
+                            stream.stop()
+                        return
                     round_start = time.time()
-
-                for phase in range(self.config.PHASES.COUNT):
-                    if averages[phase] == 0:
-                        time_energy[phase] = time.time()
-                        timestamp[phase] = int(time.time() * 1000)  # Miliseconds timestamp as integer
-
-                    # Average 5 readings before sending to db (0 to 4)
-                    if averages[phase] < 5:
-                        collect_data2(
-                            self.config, phase + 1, ADC[phase], MEASUREMENTS[phase], self.config.GENERAL.ADC_SAMPLES
-                        )
-
-                        for y in range(self.config.CTS.get(str(phase + 1)).COUNT):
-                            MEASUREMENTS[phase].shift_phase(ct=y)
-                        results = MEASUREMENTS[phase].calculate_power(phase + 1, self.config)
-
-                        rms_voltages[phase].append(results[0]["Voltage"])
-                        for ct in range(self.config.CTS.get(str(phase + 1)).COUNT):
-                            ct_currents[phase][ct]["current"].append(results[ct]["Current"])
-                            ct_currents[phase][ct]["power"].append(results[ct]["Watts"])
-                            ct_currents[phase][ct]["pf"].append(results[ct]["PF"])
-
-                        averages[phase] += 1
-
-                    else:  # Calculate the average, send the result to InfluxDB, and reset the dictionaries for the next sets of data.
-                        time_energy_end = time.time()
-                        timestamp[phase] = int(timestamp[phase] + ((time.time() * 1000 - timestamp[phase]) / 2))
-                        points = []
-                        points.append(
-                            to_point(phase + 1, rms_voltages[phase], averages[phase], "voltage", timestamp[phase])
-                        )
-                        for ct in range(self.config.CTS.get(str(phase + 1)).COUNT):
-                            energy = (
-                                (sum(ct_currents[phase][ct]["power"]) / averages[phase])
-                                * (time_energy_end - time_energy[phase])
-                            ) / (60 * 60 * 1000)
-                            MEASUREMENTS[phase]._energy[ct]["Total"] += energy
-                            points.append(
-                                to_point(
-                                    phase + 1,
-                                    MEASUREMENTS[phase]._energy[ct]["Total"],
-                                    1,
-                                    "total_" + str(ct + 1),
-                                    timestamp[phase],
-                                )
-                            )
-                            points.append(
-                                to_point(
-                                    phase + 1,
-                                    ct_currents[phase][ct],
-                                    averages[phase],
-                                    "current_" + str(ct + 1),
-                                    timestamp[phase],
-                                )
-                            )
-
-                        DB.write(points)
-
-                        #  Reset instances to empty
-                        rms_voltages[phase] = []
-                        ct_currents[phase] = [
-                            {"power": [], "pf": [], "current": []}
-                            for ct in range(self.config.CTS.get(str(phase + 1)).COUNT)
-                        ]
-                        averages[phase] = 0
-
-                        if logger.level == logging.DEBUG:
-                            print_results(self.config, phase + 1, ADC[phase], MEASUREMENTS[phase].power)
-
-                if averages[self.config.PHASES.COUNT - 1] == 5:
-                    round_took = time.time() - round_start
-                    logger.info(f"Stopped the Round. Took {round_took} seconds to do the Round :)")
-                    save_total_kwh(self.config, MEASUREMENTS)
-                    write_config(self.config_path, self.config)
+                    log_round("Starting new round")
 
             except KeyboardInterrupt:
+                for adc in ADC:
+                    adc.close()
                 DB.close()
-                save_total_kwh(self.config, MEASUREMENTS)
-                write_config(self.config_path, self.config)
+                if persist:
+                    self.state.save(MEASUREMENTS, force=True)
+                    self.state.close()
                 sys.exit()
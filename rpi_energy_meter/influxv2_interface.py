@@ -1,38 +1,192 @@
 """
 Module to write POINTS to an InfluxV2 Database
+
+With a Spool, batches the client gave up on are kept on disk instead of being lost. From then on every write goes to
+the spool, until a backfill thread got all of it written to the database in large gzip compressed batches, no more
+lines per second than BACKFILL_RATE.
+
+influxdb_client takes a third of a second to import on a Raspberry Pi, it is only imported once an infv2db is opened.
 """
 
-from influxdb_client import InfluxDBClient, Point, WriteOptions
+import threading
+import time
+from typing import Union
+
+from .logging import logger
 
-# from influxdb_client.client.write_api import SYNCHRONOUS
 INFLUX_SIZE_BATCH: int = 500
 INFLUX_INTERVAL_FLUSH: int = 10000
 INFLUX_INTERVAL_JITTER: int = 2000
 INFLUX_INTERVAL_RETRY: int = 5000
+INFLUX_MAX_RETRIES: int = 5
+
+# Uncompressed bytes per backfill request, lines per second the backfill writes at most
+BACKFILL_BATCH_BYTES: int = 1024 * 1024
+BACKFILL_RATE: int = 50000
 
 
 class infv2db:
-    def __init__(self, token: str, organization: str, bucket: str, host="localhost", port=8086):
+    def __init__(
+        self,
+        token: str,
+        organization: str,
+        bucket: str,
+        host="localhost",
+        port=8086,
+        gzip=False,
+        spool=None,
+        backfill_rate=BACKFILL_RATE,
+        max_retries=INFLUX_MAX_RETRIES,
+    ):
         self._db_host = "http://" + host + ":" + str(port)
         self._token = token
         self._org = organization
         self._bucket = bucket
+        self._gzip = gzip
+        self._spool = spool
+        self._backfill_rate = backfill_rate
+        self._max_retries = max_retries
+        # Writes go to the spool while it holds anything, so the database gets the points in order
+        self._spooling = spool is not None and len(spool) > 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.backfilled = 0
+        self.backfill_rate = 0.0
+        self.rejected = 0
         self.open()
 
     def open(self):
-        self._db = InfluxDBClient(url=self._db_host, token=self._token, org=self._org, debug=False)
+        from influxdb_client import InfluxDBClient, WriteOptions, WritePrecision  # noqa: PLC0415
+        from influxdb_client.client.write_api import SYNCHRONOUS  # noqa: PLC0415
+
+        self._precision = WritePrecision.MS
+        self._db = InfluxDBClient(
+            url=self._db_host, token=self._token, org=self._org, debug=False, enable_gzip=self._gzip
+        )
         self._db_write = self._db.write_api(
             write_options=WriteOptions(
                 batch_size=INFLUX_SIZE_BATCH,
                 flush_interval=INFLUX_INTERVAL_FLUSH,
                 jitter_interval=INFLUX_INTERVAL_JITTER,
                 retry_interval=INFLUX_INTERVAL_RETRY,
-            )
+                max_retries=self._max_retries,
+            ),
+            error_callback=self._spool_batch if self._spool is not None else None,
         )
         # self._db_write = self._db.write_api(write_options=SYNCHRONOUS)
+        if self._spool is not None:
+            self._backfill_db = InfluxDBClient(
+                url=self._db_host, token=self._token, org=self._org, debug=False, enable_gzip=True
+            )
+            self._backfill_write = self._backfill_db.write_api(write_options=SYNCHRONOUS)
+            self._stop.clear()
+            self._backfill_thread = threading.Thread(target=self._backfill, name="backfill", daemon=True)
+            self._backfill_thread.start()
+
+    def write(self, points: Union[str, list], bucket=None):
+        """Writes {points} to {bucket}, the bucket the instance was created with if None
+
+        {points} is either a list of Point or line protocol with ms precision, lines separated by newlines.
+        """
+        with self._lock:
+            if self._spooling:
+                if not isinstance(points, str):
+                    points = "\n".join(point.to_line_protocol() for point in points)
+                self._spool.append(bucket or self._bucket, self._precision, points)
+                return
+        self._db_write.write(bucket or self._bucket, self._org, points, write_precision=self._precision)
 
-    def write(self, points: list[Point]):
-        self._db_write.write(self._bucket, self._org, points)
+    def _spool_batch(self, conf, data, exception):
+        # Called by the client for a batch it gave up on
+        bucket, _, precision = conf
+        with self._lock:
+            if not self._spooling:
+                logger.warning(
+                    f"... InfluxDB can't be reached ({getattr(exception, 'reason', exception)}), "
+                    f"spooling to {self._spool.path}"
+                )
+            self._spooling = True
+            self._spool.append(bucket, precision, data)
+
+    def _backfill(self):
+        from influxdb_client.rest import ApiException  # noqa: PLC0415
+
+        while not self._stop.wait(0 if self._spooling and len(self._spool) else INFLUX_INTERVAL_RETRY / 1000):
+            with self._lock:
+                if not len(self._spool):
+                    self._spooling = False
+                    continue
+            batch = self._spool.peek(BACKFILL_BATCH_BYTES)
+            if batch is None:
+                continue
+            last, bucket, precision, lines, payload = batch
+            start = time.perf_counter()
+            try:
+                self._backfill_write.write(bucket, self._org, payload, write_precision=precision)
+            except ApiException as error:
+                # The database answered, but won't ever take these lines
+                if 400 <= (error.status or 0) < 500 and error.status != 429:
+                    logger.error(f"... InfluxDB rejected {lines} spooled lines: {error.reason}")
+                    self._spool.remove(last)
+                    self.rejected += lines
+                    continue
+                self._stop.wait(INFLUX_INTERVAL_RETRY / 1000)
+                continue
+            except Exception:
+                # Still unreachable
+                self._stop.wait(INFLUX_INTERVAL_RETRY / 1000)
+                continue
+            with self._lock:
+                self._spool.remove(last)
+                # Writes go to the database again, the lines spooled meanwhile are already in the spool
+                drained = not len(self._spool)
+                if drained:
+                    self._spooling = False
+            took = time.perf_counter() - start
+            self.backfilled += lines
+            # Waiting out the rest of the time the lines may take at the rate limit
+            self._stop.wait(max(0.0, lines / self._backfill_rate - took))
+            self.backfill_rate = lines / (time.perf_counter() - start)
+            logger.debug(
+                f"... Backfilled {lines} lines at {round(self.backfill_rate)} lines/s, {len(self._spool)} left"
+            )
+            if drained:
+                logger.info(f"... Backfilled the spool, {self.backfilled} lines so far")
+
+    def stats(self) -> dict:
+        """Lines and bytes in the spool and the lines per second of the last backfill request"""
+        if self._spool is None:
+            return {}
+        return {
+            "spool_lines": self._spool.lines,
+            "spool_bytes": self._spool.bytes,
+            "spool_dropped": self._spool.dropped,
+            "backfilled": self.backfilled,
+            "backfill_rate": round(self.backfill_rate, 1),
+            "rejected": self.rejected,
+        }
 
     def close(self):
+        if self._spool is not None:
+            self._stop.set()
+            self._backfill_thread.join()
+            self._backfill_write.close()
+            self._backfill_db.close()
+        # Closing the write API flushes the points still waiting in its batches, into the spool if it has to
+        self._db_write.close()
         self._db.close()
+        if self._spool is not None:
+            self._spool.close()
+
+
+class NullDB:
+    """Stand-in for infv2db that only counts the points it gets, used when replaying captures"""
+
+    def __init__(self):
+        self.points = 0
+
+    def write(self, points: Union[str, list], bucket=None):
+        self.points += points.count("\n") + 1 if isinstance(points, str) else len(points)
+
+    def close(self):
+        pass
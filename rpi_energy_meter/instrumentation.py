@@ -0,0 +1,135 @@
+"""
+Module to time the stages of the measurement loop in latency histograms
+
+Every stage in INSTRUMENTATION.STAGES gets a histogram of its durations with logarithmic buckets, 8 per decade from
+1 us to 10 s, so adding a duration is a bisect and two increments. Stages left out get no histogram, their call
+sites only pay for the check that there is none. The histograms of all stages live in one array:
+
+    counts       float64  per stage: durations per bucket, the last one for those slower than 10 s
+    seconds      float64  per stage: sum of the durations
+
+The phase processes of the multiprocess runtime copy their array to their ResultRing after every block, the
+coordinator adds those up with its own. Readings turns what was added since the last time into points every
+INSTRUMENTATION.WRITE_SECONDS, see stage_points().
+"""
+
+from bisect import bisect_right
+
+import numpy
+
+# Stages that can be timed, in the order a block passes them. adc_read includes parse
+STAGES = ("adc_read", "parse", "scale", "shift", "power", "points", "db_write", "persist")
+# Upper bounds of the histogram buckets in seconds
+BUCKET_BOUNDS = tuple(10 ** (exponent / 8) for exponent in range(-48, 9))
+PERCENTILES = (50, 95, 99)
+# Seconds between two writes of the stage points, unless INSTRUMENTATION.WRITE_SECONDS says otherwise
+DEFAULT_WRITE_SECONDS = 60.0
+
+SHAPE = (len(STAGES), len(BUCKET_BOUNDS) + 2)
+
+
+class Histogram:
+    """Durations of one stage, a row of the array of Stages
+
+    Args:
+        row (numpy.ndarray): Counts per bucket followed by the sum of the durations
+    """
+
+    __slots__ = ("_row",)
+
+    def __init__(self, row: numpy.ndarray):
+        self._row = row
+
+    def add(self, seconds: float) -> None:
+        """Counts a duration of {seconds}"""
+        row = self._row
+        row[bisect_right(BUCKET_BOUNDS, seconds)] += 1
+        row[-1] += seconds
+
+
+class Stages:
+    """Latency histograms of the stages of the measurement loop, see the module docstring
+
+    Threads of the pipeline runtime may add to the same histogram at once, the odd count lost that way is of no
+    interest for percentiles.
+
+    Args:
+        enabled (tuple): Names of the stages to time, out of STAGES
+    """
+
+    def __init__(self, enabled=()):
+        unknown = [name for name in enabled if name not in STAGES]
+        if unknown:
+            raise ValueError(
+                f"Unknown INSTRUMENTATION.STAGES {', '.join(unknown)}, expected some of {', '.join(STAGES)}"
+            )
+        self.enabled = tuple(name for name in STAGES if name in enabled)
+        self.counts = numpy.zeros(SHAPE)
+        self._histograms = {name: Histogram(self.counts[STAGES.index(name)]) for name in self.enabled}
+        self._sources = []
+        self._taken = numpy.zeros(SHAPE)
+
+    @classmethod
+    def from_config(cls, config):
+        """Stages of INSTRUMENTATION.STAGES, none if the section is missing"""
+        return cls(tuple(config.INSTRUMENTATION.get("STAGES", [])))
+
+    def get(self, name: str):
+        """Histogram of the stage {name}, None if it isn't timed"""
+        return self._histograms.get(name)
+
+    def attach(self, adcs, measurements) -> None:
+        """Lets {adcs} time the parsing of their blocks and {measurements} the phase correction and the power"""
+        for adc in adcs:
+            if hasattr(adc, "parse_timer"):
+                adc.parse_timer = self.get("parse")
+        for samples in measurements:
+            samples.set_timers(self.get("shift"), self.get("power"))
+
+    def merge(self, source) -> None:
+        """Adds the array {source} returns, e.g. the copy a phase process keeps in its ResultRing, to take()"""
+        self._sources.append(source)
+
+    def release(self) -> None:
+        """Adds the last arrays of the merged sources to the own ones and forgets the sources, before they go away"""
+        for source in self._sources:
+            self.counts += source()
+        self._sources = []
+
+    def take(self) -> dict:
+        """Count, mean and PERCENTILES in us of the durations per stage added since the last call
+
+        Returns:
+            dict: Values per stage timed, stages without durations are left out
+        """
+        counts = self.counts.copy()
+        for source in self._sources:
+            counts += source()
+        interval, self._taken = counts - self._taken, counts
+        summary = {}
+        for name in self.enabled:
+            row = interval[STAGES.index(name)]
+            count = int(row[:-1].sum())
+            if count:
+                summary[name] = {
+                    "count": count,
+                    "mean_us": round(float(row[-1]) / count * 1e6, 1),
+                    **{f"p{q}_us": round(float(percentile(row[:-1], q)) * 1e6, 1) for q in PERCENTILES},
+                }
+        return summary
+
+
+def percentile(buckets: numpy.ndarray, q: float) -> float:
+    """Duration in seconds below which {q} percent of the counts in {buckets} lie
+
+    The position inside the bucket is interpolated logarithmically, like the bucket bounds are spaced.
+    """
+    cumulative = numpy.cumsum(buckets)
+    rank = q / 100 * cumulative[-1]
+    index = min(int(numpy.searchsorted(cumulative, rank)), len(buckets) - 1)
+    before = cumulative[index - 1] if index else 0.0
+    fraction = (rank - before) / buckets[index] if buckets[index] else 1.0
+    ratio = BUCKET_BOUNDS[1] / BUCKET_BOUNDS[0]
+    upper = BUCKET_BOUNDS[min(index, len(BUCKET_BOUNDS) - 1)]
+    lower = BUCKET_BOUNDS[index - 1] if 0 < index < len(BUCKET_BOUNDS) else upper / ratio
+    return lower * (upper / lower) ** fraction
@@ -1,41 +1,352 @@
 """Module to interact with a MCP3008 ADC via SPI bus"""
 
+import ctypes
 import subprocess
+import time
 from pathlib import Path
 
+import numpy
+
+from .logging import logger
+
 base_path = Path(__file__).parent.resolve()
 exec_path = base_path / "helper" / "mcp3008hwspi"
 
+ALL_CHANNELS = "01234567"
+SPI_CLOCK = 1250000
+
+# Output formats of the helper (-f): CSV lines or little-endian uint16 frames, one value per channel and sample
+FORMAT_TEXT = 0
+FORMAT_BINARY = 1
+SAMPLE_DTYPE = numpy.dtype("<u2")
+
+
+def parse_text(data: bytes, samples: int, channels: int) -> numpy.ndarray:
+    """Parses the CSV output of the helper into a (samples, channels) array in one go
+
+    Missing trailing samples are left at 0, like the helper never delivered them.
+    """
+    _block = numpy.zeros((samples, channels), dtype=numpy.uint16)
+    _values = numpy.fromstring(data.strip().replace(b"\n", b",").decode(), dtype=numpy.uint16, sep=",")
+    _rows = min(len(_values) // channels, samples)
+    _block[:_rows] = _values[: _rows * channels].reshape(_rows, channels)
+    return _block
+
+
+def parse_binary(data: bytes, samples: int, channels: int) -> numpy.ndarray:
+    """Parses binary helper frames into a (samples, channels) array without copying them
+
+    Missing trailing samples are left at 0, like the helper never delivered them.
+    """
+    if len(data) == samples * channels * SAMPLE_DTYPE.itemsize:
+        return numpy.frombuffer(data, dtype=SAMPLE_DTYPE).reshape(samples, channels)
+    _block = numpy.zeros((samples, channels), dtype=SAMPLE_DTYPE)
+    _rows = min(len(data) // (channels * SAMPLE_DTYPE.itemsize), samples)
+    _block[:_rows] = numpy.frombuffer(data, dtype=SAMPLE_DTYPE, count=_rows * channels).reshape(_rows, channels)
+    return _block
+
+
+def _effective_rate(samples: int, time_start: float, time_end: float):
+    # Samples per second of a block read from {time_start} until {time_end}, None if the clock did not advance
+    return samples / (time_end - time_start) if time_end > time_start else None
+
 
 class MCP3008_2:
-    def __init__(self, device=0):
+    """Reads blocks of samples from a MCP3008 through the mcp3008hwspi helper
+
+    In one-shot mode the helper gets started for every single block. In persistent mode one helper per SPI
+    device is kept running in request mode (-s): every line written to its stdin holds a sample count, which
+    gets answered with that many samples for all 8 channels on its stdout.
+
+    After reading a block, {block_times} holds the times it was requested and received, and {sample_rate} the
+    effective samples per second derived from them. Starting the helper takes longer than sampling, so in one-shot
+    mode {sample_rate} is None (unknown). With a Histogram in {parse_timer}, the parsing of every block is timed.
+
+    Args:
+        device (int): SPI chip select the MCP3008 is attached to
+        persistent (bool): Keep one helper process open instead of spawning one per read
+        binary (bool): Let the helper write binary frames instead of CSV lines
+    """
+
+    def __init__(self, device=0, persistent=False, binary=False):
         self.device = device
+        self.persistent = persistent
+        self.binary = binary
+        self._process = None
+        now = time.time()
+        self.block_times = (now, now)
+        self.sample_rate = None
+        self.parse_timer = None
+
+    def _command(self, channels):
+        return [
+            str(exec_path),
+            "-r",
+            str(SPI_CLOCK),
+            "-c",
+            str(channels),
+            "-f",
+            str(FORMAT_BINARY if self.binary else FORMAT_TEXT),
+            "-b",
+            "1",
+            "-d",
+            str(self.device),
+        ]
+
+    def _parse(self, data, samples, channels):
+        start = time.perf_counter()
+        _block = parse_binary(data, samples, channels) if self.binary else parse_text(data, samples, channels)
+        if self.parse_timer is not None:
+            self.parse_timer.add(time.perf_counter() - start)
+        return _block
+
+    def open(self):
+        """Starts the persistent helper process for this device"""
+        logger.debug(f"... Starting persistent ADC helper for device {self.device}")
+        self._process = subprocess.Popen(
+            [*self._command(ALL_CHANNELS), "-s"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
 
-    def read(self, channels="01234567", samples=200):
+    def close(self):
+        """Stops the persistent helper process, if there is one"""
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        try:
+            process.stdin.close()
+            process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+        finally:
+            process.stdout.close()
+
+    def read(self, channels=ALL_CHANNELS, samples=200):
+        """Reads {samples} samples of {channels} as a list of lists, one list of channel values per sample"""
+        return self.read_block(samples=samples, channels=channels).tolist()
+
+    def read_block(self, samples=200, channels=ALL_CHANNELS) -> numpy.ndarray:
+        """Reads {samples} samples of {channels}
+
+        Returns:
+            numpy.ndarray: uint16 array of shape (samples, len(channels))
+        """
+        channels = str(channels)
+        time_start = time.time()
+        if self.persistent:
+            _block = self._read_persistent(samples)
+            if channels != ALL_CHANNELS:
+                _block = _block[:, [int(c) for c in channels]]
+        else:
+            _block = self._read_oneshot(channels, samples)
+        if channels == ALL_CHANNELS:
+            self.block_times = (time_start, time.time())
+            self.sample_rate = _effective_rate(samples, *self.block_times) if self.persistent else None
+        return _block
+
+    def _read_oneshot(self, channels, samples):
         result = subprocess.run(
-            [
-                str(exec_path),
-                "-r",
-                "1250000",
-                "-c",
-                str(channels),
-                "-f",
-                "0",
-                "-n",
-                str(samples),
-                "-b",
-                "1",
-                "-d",
-                str(self.device),
-            ],
+            [*self._command(channels), "-n", str(samples)],
             capture_output=True,
-            text=True,
             check=False,
         )
-        _data_out = result.stdout
-        _samples = [[0] * 8 for _ in range(samples)]
-        for i, line in enumerate(_data_out.split("\n")):
-            if line == "":
-                break
-            _samples[i] = list(map(int, line.split(",")))
-        return _samples
+        return self._parse(result.stdout, samples, len(channels))
+
+    def _read_persistent(self, samples):
+        # A helper that died or answered garbage is restarted once, as the stream is out of sync afterwards
+        for attempt in range(2):
+            try:
+                if self._process is None or self._process.poll() is not None:
+                    self.close()
+                    self.open()
+                self._process.stdin.write(b"%d\n" % samples)
+                self._process.stdin.flush()
+                if self.binary:
+                    _size = samples * len(ALL_CHANNELS) * SAMPLE_DTYPE.itemsize
+                    _data = self._process.stdout.read(_size)
+                    if len(_data) < _size:
+                        raise EOFError("helper closed its output")
+                else:
+                    _lines = [self._process.stdout.readline() for _ in range(samples)]
+                    # readline() returns b"" once the helper is gone, and the line it was writing without "\n"
+                    _complete = sum(1 for _line in _lines if _line.endswith(b"\n") and _line.strip())
+                    if _complete < samples:
+                        raise EOFError(f"helper closed its output after {_complete} of {samples} samples")
+                    _data = b"".join(_lines)
+                return self._parse(_data, samples, len(ALL_CHANNELS))
+            except (OSError, EOFError, ValueError) as e:
+                logger.warning(
+                    f"ADC helper for device {self.device} failed ({e}), restarting it (attempt {attempt + 1})"
+                )
+                self.close()
+        raise RuntimeError(f"ADC helper for device {self.device} keeps failing")
+
+
+class _SpiIocTransfer(ctypes.Structure):
+    # struct spi_ioc_transfer of linux/spi/spidev.h
+    _fields_ = [
+        ("tx_buf", ctypes.c_uint64),
+        ("rx_buf", ctypes.c_uint64),
+        ("len", ctypes.c_uint32),
+        ("speed_hz", ctypes.c_uint32),
+        ("delay_usecs", ctypes.c_uint16),
+        ("bits_per_word", ctypes.c_uint8),
+        ("cs_change", ctypes.c_uint8),
+        ("tx_nbits", ctypes.c_uint8),
+        ("rx_nbits", ctypes.c_uint8),
+        ("word_delay_usecs", ctypes.c_uint8),
+        ("pad", ctypes.c_uint8),
+    ]
+
+
+# The size of an SPI_IOC_MESSAGE has to fit the 14 bits of an ioctl number
+SPIDEV_MAX_BATCH = ((1 << 14) - 1) // ctypes.sizeof(_SpiIocTransfer)
+
+
+def spi_ioc_message(transfers: int) -> int:
+    """ioctl request number of SPI_IOC_MESSAGE({transfers})"""
+    return (1 << 30) | (transfers * ctypes.sizeof(_SpiIocTransfer) << 16) | (ord("k") << 8)
+
+
+class MCP3008_SPIDEV:
+    """Reads blocks of samples from a MCP3008 in-process through the spidev module
+
+    Every conversion is a 3 byte frame (start bit, single ended channel select, 10 bit result). The frames of a
+    whole block are prepared once and decoded with numpy. The MCP3008 only starts a new conversion after its chip
+    select went high, while xfer2 keeps it asserted for the whole of a transfer. So with a {batch} of 1 every frame
+    is an xfer2 call of its own, larger batches are sent as one SPI_IOC_MESSAGE of {batch} transfers of a frame
+    each, with cs_change releasing the chip select in between.
+
+    After reading a block, {block_times} holds the times the transfers started and ended, and {sample_rate} the
+    effective samples per second derived from them. With a Histogram in {parse_timer}, the decoding of every block
+    is timed.
+
+    Args:
+        device (int): SPI chip select the MCP3008 is attached to
+        bus (int): SPI bus
+        batch (int): Number of conversions sent per transfer, at most SPIDEV_MAX_BATCH
+        spidev_module (module): Module providing SpiDev, defaults to spidev. Allows running with a fake
+        ioctl (callable): Takes (fd, request, transfers) like fcntl.ioctl, defaults to it. Allows running with a fake
+    """
+
+    def __init__(self, device=0, bus=0, batch=SPIDEV_MAX_BATCH, spidev_module=None, ioctl=None):
+        self.device = device
+        self.bus = bus
+        self.batch = min(max(1, int(batch)), SPIDEV_MAX_BATCH)
+        self._spidev_module = spidev_module
+        self._ioctl = ioctl
+        self._spi = None
+        self._frames = {}
+        now = time.time()
+        self.block_times = (now, now)
+        self.sample_rate = None
+        self.parse_timer = None
+
+    def open(self):
+        """Opens the SPI device"""
+        if self._spidev_module is None:
+            import spidev  # noqa: PLC0415 — deferred: only needed with the spidev backend
+
+            self._spidev_module = spidev
+        if self._ioctl is None and self.batch > 1:
+            import fcntl  # noqa: PLC0415 — deferred: not available on every platform
+
+            self._ioctl = fcntl.ioctl
+        self._spi = self._spidev_module.SpiDev()
+        self._spi.open(self.bus, self.device)
+        self._spi.max_speed_hz = SPI_CLOCK
+        self._spi.mode = 0
+
+    def close(self):
+        """Closes the SPI device, if it is open"""
+        if self._spi is not None:
+            self._spi.close()
+            self._spi = None
+
+    def _request(self, samples, channels):
+        # Command frames for a whole block and the buffer the answers go to. Cached, as the layout rarely changes.
+        # Batches are SPI_IOC_MESSAGE requests pointing into both buffers, single frames lists for xfer2.
+        key = (samples, channels)
+        if key not in self._frames:
+            _tx = numpy.zeros((samples, len(channels), 3), dtype=numpy.uint8)
+            _tx[:, :, 0] = 0x01
+            _tx[:, :, 1] = [(0x08 | int(c)) << 4 for c in channels]
+            _tx = _tx.reshape(-1, 3)
+            _rx = numpy.zeros_like(_tx)
+            if self.batch == 1:
+                _chunks = _tx.tolist()
+            else:
+                _chunks = []
+                for first in range(0, len(_tx), self.batch):
+                    count = min(self.batch, len(_tx) - first)
+                    transfers = (_SpiIocTransfer * count)()
+                    for i in range(count):
+                        transfers[i].tx_buf = _tx[first + i].ctypes.data
+                        transfers[i].rx_buf = _rx[first + i].ctypes.data
+                        transfers[i].len = 3
+                        # On the last transfer cs_change would keep the chip select asserted after the message
+                        transfers[i].cs_change = i < count - 1
+                    _chunks.append((spi_ioc_message(count), transfers))
+            self._frames[key] = (_tx, _rx, _chunks)
+        return self._frames[key]
+
+    def read(self, channels=ALL_CHANNELS, samples=200):
+        """Reads {samples} samples of {channels} as a list of lists, one list of channel values per sample"""
+        return self.read_block(samples=samples, channels=channels).tolist()
+
+    def read_block(self, samples=200, channels=ALL_CHANNELS) -> numpy.ndarray:
+        """Reads {samples} samples of {channels}
+
+        Returns:
+            numpy.ndarray: uint16 array of shape (samples, len(channels))
+        """
+        channels = str(channels)
+        if self._spi is None:
+            self.open()
+        _, _rx, _chunks = self._request(samples, channels)
+        time_start = time.time()
+        if self.batch == 1:
+            for i, frame in enumerate(_chunks):
+                _rx[i] = self._spi.xfer2(frame)
+        else:
+            fd = self._spi.fileno()
+            for request, transfers in _chunks:
+                self._ioctl(fd, request, transfers)
+        if channels == ALL_CHANNELS:
+            self.block_times = (time_start, time.time())
+            self.sample_rate = _effective_rate(samples, *self.block_times)
+        start = time.perf_counter()
+        _rx = _rx.reshape(samples, len(channels), 3)
+        _block = ((_rx[:, :, 1] & 0x03).astype(numpy.uint16) << 8) | _rx[:, :, 2]
+        if self.parse_timer is not None:
+            self.parse_timer.add(time.perf_counter() - start)
+        return _block
+
+
+def create_adc(config, device):
+    """Creates the ADC instance for {device} with the backend selected by GENERAL.ADC_BACKEND
+
+    Args:
+        config (Box): Configuration
+        device (int): SPI chip select of the phase's MCP3008
+
+    Returns:
+        MCP3008_2 | MCP3008_SPIDEV | MCP3008_SIMULATOR: ADC instance
+    """
+    backend = config.GENERAL.get("ADC_BACKEND", "helper")
+    if backend == "helper":
+        return MCP3008_2(
+            device=device,
+            persistent=bool(config.GENERAL.get("ADC_PERSISTENT", False)),
+            binary=bool(config.GENERAL.get("ADC_BINARY", False)),
+        )
+    if backend == "spidev":
+        return MCP3008_SPIDEV(device=device, batch=config.GENERAL.get("ADC_SPIDEV_BATCH", SPIDEV_MAX_BATCH))
+    if backend == "simulator":
+        from .simulator import MCP3008_SIMULATOR  # noqa: PLC0415 — deferred: imports mcp3008 itself
+
+        return MCP3008_SIMULATOR(config, device=device)
+    raise ValueError(f"Unknown ADC backend '{backend}' in GENERAL.ADC_BACKEND")
@@ -0,0 +1,147 @@
+"""
+Module to serve the latest readings in the Prometheus text format
+
+The measurement loop publishes every reading of a phase to a MetricsSnapshot as a new tuple, replacing the one before
+in a single assignment. A scrape only picks up the tuples that are there at the time, so it neither takes a lock the
+loop could wait for nor waits for the database. MetricsServer answers GET /metrics from its own thread.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .power import POWER_DTYPE
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Only local scrapers by default, the endpoint has no authentication
+DEFAULT_METRICS_HOST = "127.0.0.1"
+
+# Name, type, help and the POWER_DTYPE field of the metrics per CT
+_CT_METRICS = (
+    ("rpi_energy_meter_current_amperes", "gauge", "Rms current of the CT", "Current"),
+    ("rpi_energy_meter_power_watts", "gauge", "Real power of the CT", "Watts"),
+    ("rpi_energy_meter_power_factor", "gauge", "Power factor of the CT", "PF"),
+)
+_INDEX = {name: index for index, name in enumerate(POWER_DTYPE.names)}
+
+
+class MetricsSnapshot:
+    """Latest reading of every phase, written by the measurement loop and read by scrapes
+
+    Args:
+        cts (list): Number of CTs per phase
+        db: Database whose stats() are served as well, e.g. the spool depth of infv2db
+    """
+
+    def __init__(self, cts: list, db=None):
+        self.cts = cts
+        self.db = db
+        self._phases = [None for _ in cts]
+
+    def update(self, phase: int, power, totals: list, frequency, time_end: float) -> None:
+        """Publishes the (6,) POWER_DTYPE values, totals and {frequency} (None if unknown) of a reading of {phase}"""
+        self._phases[phase] = (power.tolist(), list(totals), None if frequency is None else float(frequency), time_end)
+
+    def render(self) -> str:
+        """Metrics of the latest readings in the Prometheus text format"""
+        phases = list(self._phases)
+        lines = []
+
+        def family(name, kind, description, samples):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(
+                f"{name}{{{labels}}} {_format(value)}" if labels else f"{name} {_format(value)}"
+                for labels, value in samples
+            )
+
+        readings = [(phase + 1, reading) for phase, reading in enumerate(phases) if reading is not None]
+        family(
+            "rpi_energy_meter_voltage_volts",
+            "gauge",
+            "Rms voltage of the phase",
+            [(f'phase="{phase}"', reading[0][0][_INDEX["Voltage"]]) for phase, reading in readings],
+        )
+        family(
+            "rpi_energy_meter_frequency_hertz",
+            "gauge",
+            "Grid frequency of the phase",
+            [(f'phase="{phase}"', reading[2]) for phase, reading in readings if reading[2] is not None],
+        )
+        for name, kind, description, field in _CT_METRICS:
+            family(
+                name,
+                kind,
+                description,
+                [
+                    (f'phase="{phase}",ct="{ct + 1}"', reading[0][ct][_INDEX[field]])
+                    for phase, reading in readings
+                    for ct in range(self.cts[phase - 1])
+                ],
+            )
+        family(
+            "rpi_energy_meter_energy_kwh_total",
+            "counter",
+            "Energy the CT measured in total",
+            [
+                (f'phase="{phase}",ct="{ct + 1}"', float(reading[1][ct]))
+                for phase, reading in readings
+                for ct in range(self.cts[phase - 1])
+            ],
+        )
+        family(
+            "rpi_energy_meter_reading_timestamp_seconds",
+            "gauge",
+            "Time the latest reading of the phase ended at",
+            [(f'phase="{phase}"', reading[3]) for phase, reading in readings],
+        )
+        stats = self.db.stats() if self.db is not None and hasattr(self.db, "stats") else {}
+        for name, value in stats.items():
+            family(f"rpi_energy_meter_{name}", "gauge", name.replace("_", " ").capitalize(), [("", float(value))])
+        return "\n".join(lines) + "\n"
+
+
+def _format(value: float) -> str:
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.server.snapshot.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    """HTTP server answering GET /metrics with the metrics of {snapshot}, in a thread of its own
+
+    Args:
+        snapshot (MetricsSnapshot): Readings to serve
+        port (int): Port to listen on, 0 for any free one
+        host (str): Address to listen on
+    """
+
+    def __init__(self, snapshot: MetricsSnapshot, port: int, host: str = DEFAULT_METRICS_HOST):
+        self._server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.snapshot = snapshot
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
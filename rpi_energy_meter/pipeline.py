@@ -0,0 +1,308 @@
+"""
+Module to run the measurement loop as a pipeline of threads
+
+Every phase gets an acquisition thread reading blocks from its own ADC, so the phases are sampled concurrently.
+The blocks go through a bounded queue to the compute stage, which turns them into power values, aggregates them into
+windows per phase and integrates the energy just like RpiEnergyMeter._measure does. The points and the saving of the
+totals are handed to the writer stage through a second bounded queue, so neither a slow database nor a slow SD card
+holds up the sampling. The writer saves snapshots of the totals, taken by the compute stage, never the totals it keeps
+adding to. When the writer falls that far behind, the oldest points waiting for it are dropped, the snapshots are
+kept.
+"""
+
+import contextlib
+import logging
+import queue
+import sys
+import threading
+import time
+
+from .aggregate import Aggregator, Rollups, rollup_tiers
+from .instrumentation import DEFAULT_WRITE_SECONDS
+from .logging import logger
+from .state import energy_totals
+from .utils import bias_voltage, fill_samples, print_results, readings_to_points, rollup_points, stage_points
+
+# Ways the measurement loop can be run, see GENERAL.RUNTIME
+RUNTIMES = ("sequential", "pipeline", "multiprocess")
+
+# Blocks per phase waiting for the compute stage, and writes waiting for the writer stage
+DEFAULT_QUEUE_SIZE = 8
+# Seconds the stages wait on a queue before looking whether they should stop
+POLL_INTERVAL = 0.25
+
+_DONE = object()
+
+
+class Readings:
+    """Aggregates the power values of every phase until a window of them is turned into points
+
+    Every reading also goes into the rollup tiers of ROLLUPS.TIERS. With ROLLUPS.RAW false only the tiers are
+    written, the windows still complete the rounds and add the energy. With {stages} timing anything, the points
+    of the stages are written every INSTRUMENTATION.WRITE_SECONDS as well, to INSTRUMENTATION.BUCKET if set.
+
+    Args:
+        config (Box): Configuration
+        MEASUREMENTS (list): SAMPLES instance per phase, holding the energy totals
+        metrics (MetricsSnapshot): Gets every reading published to, if given
+        stages (Stages): Times the points stage and gets its points written, if given
+    """
+
+    def __init__(self, config, MEASUREMENTS, metrics=None, stages=None):
+        self._config = config
+        self._measurements = MEASUREMENTS
+        self._metrics = metrics
+        self._stages = stages if stages is not None and stages.enabled else None
+        self._points_timer = stages.get("points") if stages is not None else None
+        self._stages_interval = float(config.INSTRUMENTATION.get("WRITE_SECONDS", DEFAULT_WRITE_SECONDS))
+        self._stages_bucket = config.INSTRUMENTATION.get("BUCKET") or None
+        self._stages_written = None
+        self._aggregator = Aggregator.from_config(config, len(MEASUREMENTS))
+        self._continuous = config.GENERAL.get("CONTINUOUS", False)
+        self._raw = config.ROLLUPS.get("RAW", True)
+        tiers = rollup_tiers(config)
+        self._rollups = Rollups(tiers, len(MEASUREMENTS)) if tiers else None
+
+    def reconfigure(self, config) -> None:
+        """Writes the points with {config} from now on, the windows and rollups stay as they were set up"""
+        self._config = config
+
+    @property
+    def rounds(self) -> int:
+        """Rounds completed, a round being done once every phase completed a window"""
+        return min(self._aggregator.windows)
+
+    def add(self, phase: int, results, time_start: float, time_end: float):
+        """Adds the power values of a block taken on {phase} (0 based) from {time_start} until {time_end}
+
+        Returns:
+            list: (bucket, points) to write, bucket None for INFLUX.bucket. Empty while no window is complete
+        """
+        measurements = self._measurements[phase]
+        if self._continuous:
+            measurements.integrate_energy(results, time_start, time_end)
+        writes = []
+        start = time.perf_counter()
+        if self._aggregator.add(phase, results, time_start, time_end):
+            window = self._aggregator.take(phase)
+            if not self._continuous:
+                measurements.integrate_window(window)
+            if self._raw:
+                writes.append((None, readings_to_points(self._config, phase + 1, measurements, window)))
+        if self._rollups is not None:
+            for tier, window, energy in self._rollups.add(phase, results, time_start, time_end):
+                writes.append((tier.bucket, rollup_points(self._config, phase + 1, tier, window, energy)))
+        if writes and self._points_timer is not None:
+            self._points_timer.add(time.perf_counter() - start)
+        if self._metrics is not None:
+            totals = [energy["Total"] for energy in measurements._energy]
+            self._metrics.update(phase, results, totals, measurements.measured_frequency, time_end)
+        if self._stages is not None:
+            if self._stages_written is None:
+                self._stages_written = time_end
+            elif time_end - self._stages_written >= self._stages_interval:
+                self._stages_written = time_end
+                summary = self._stages.take()
+                if summary:
+                    writes.append((self._stages_bucket, stage_points(self._config, summary, int(time_end * 1000))))
+        return writes
+
+
+class Pipeline:
+    """Acquisition, compute and writer stages of the measurement loop, each running in its own thread
+
+    Args:
+        meter (RpiEnergyMeter): Meter whose config and config path are used
+        ADC (list): ADC instance per phase
+        MEASUREMENTS (list): SAMPLES instance per phase
+        DB (infv2db): Database to write the points to
+        persist (bool): Save the energy totals to the state file after every round and on exit
+        rounds (int): Return after this many rounds (including their writes) instead of running forever
+    """
+
+    def __init__(self, meter, ADC, MEASUREMENTS, DB, persist=True, rounds=None):
+        self._meter = meter
+        self._config = meter.config
+        self._adc = ADC
+        self._measurements = MEASUREMENTS
+        self._db = DB
+        self._persist = persist
+        self._rounds = rounds
+
+        size = int(self._config.GENERAL.get("PIPELINE_QUEUE", DEFAULT_QUEUE_SIZE))
+        self._blocks = queue.Queue(maxsize=size * len(ADC))
+        self._writes = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._errors = []
+        self.dropped = 0
+
+    def run(self) -> None:
+        """Runs the stages until {rounds} are done, every ADC ran out of blocks or Ctrl-c is pressed"""
+        acquisition = [
+            threading.Thread(target=self._acquire, args=(phase,), name=f"acquire-{phase + 1}", daemon=True)
+            for phase in range(len(self._adc))
+        ]
+        compute = threading.Thread(target=self._compute, name="compute", daemon=True)
+        writer = threading.Thread(target=self._write, name="writer", daemon=True)
+        for thread in (*acquisition, compute, writer):
+            thread.start()
+
+        interrupted = False
+        try:
+            # Joining in steps keeps the main thread responsive to Ctrl-c
+            while compute.is_alive():
+                compute.join(POLL_INTERVAL)
+        except KeyboardInterrupt:
+            interrupted = True
+        finally:
+            self._stop.set()
+            compute.join()
+            self._writes.put(_DONE)
+            writer.join()
+            # Acquisition threads waiting for room in the queue get it, so they notice the stop right away
+            while any(thread.is_alive() for thread in acquisition):
+                with contextlib.suppress(queue.Empty):
+                    self._blocks.get(timeout=0.01)
+
+        if self.dropped:
+            logger.warning(f"... The writer stage fell behind, {self.dropped} writes were dropped")
+        if interrupted:
+            for adc in self._adc:
+                adc.close()
+            self._db.close()
+            if self._persist:
+                self._meter.state.save(self._measurements, force=True)
+                self._meter.state.close()
+            sys.exit()
+        if self._errors:
+            raise self._errors[0]
+
+    def _fail(self, error: Exception) -> None:
+        # Errors while shutting down, e.g. of a helper killed by Ctrl-c, are of no interest
+        if not self._stop.is_set():
+            self._errors.append(error)
+            self._stop.set()
+
+    def _acquire(self, phase: int) -> None:
+        adc = self._adc[phase]
+        clock = getattr(adc, "now", time.time)
+        samples = self._config.GENERAL.ADC_SAMPLES
+        timer = self._meter.stages.get("adc_read")
+        try:
+            while not self._stop.is_set():
+                time_start = clock()
+                read_start = time.perf_counter()
+                data = adc.read_block(samples=samples)
+                if timer is not None:
+                    timer.add(time.perf_counter() - read_start)
+                time_start, time_end = getattr(adc, "block_times", (time_start, clock()))
+                self._put(self._blocks, (phase, data, time_start, time_end, getattr(adc, "sample_rate", None)))
+        except EOFError:
+            # A replay ran out of blocks
+            pass
+        except Exception as error:
+            self._fail(error)
+        finally:
+            self._put(self._blocks, (phase, None, 0.0, 0.0, None))
+
+    def _put(self, target: queue.Queue, item) -> None:
+        while not self._stop.is_set():
+            with contextlib.suppress(queue.Full):
+                target.put(item, timeout=POLL_INTERVAL)
+                return
+
+    def _hand_over(self, item) -> None:
+        # The compute stage must never wait for the writer. Rather the oldest points waiting are dropped, the snapshots
+        # of the totals taken out on the way go back in. A queue of nothing but snapshots loses the oldest one instead,
+        # the newer ones hold its energy as well.
+        while True:
+            try:
+                self._writes.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            snapshots = []
+            dropped = None
+            with contextlib.suppress(queue.Empty):
+                while dropped is None:
+                    waiting = self._writes.get_nowait()
+                    if waiting[0] == "points":
+                        dropped = waiting
+                    else:
+                        snapshots.append(waiting)
+            if dropped is None:
+                snapshots = snapshots[1:]
+            else:
+                self.dropped += 1
+                logger.warning(
+                    f"... The writer stage fell behind, dropped points for {dropped[1][0] or 'INFLUX.bucket'}"
+                )
+            for snapshot in snapshots:
+                self._writes.put_nowait(snapshot)
+
+    def _compute(self) -> None:
+        stages = self._meter.stages
+        readings = Readings(self._config, self._measurements, metrics=self._meter.metrics, stages=stages)
+        scale_timer = stages.get("scale")
+        running = len(self._adc)
+        rounds_done = 0
+        round_start = time.time()
+        # Round logging would only slow down replays
+        log_round = logger.info if self._persist else logger.debug
+        log_round("Starting new round")
+
+        try:
+            while running and not self._stop.is_set():
+                if self._meter.reload_requested.is_set() and self._meter.apply_reload(self._measurements, readings):
+                    self._config = self._meter.config
+                try:
+                    phase, data, time_start, time_end, sample_rate = self._blocks.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if data is None:
+                    running -= 1
+                    continue
+
+                fill_samples(self._measurements[phase], data, time_start, time_end, sample_rate, timer=scale_timer)
+                results = self._measurements[phase].correct_and_calculate_power()
+                writes = readings.add(phase, results, time_start, time_end)
+                for write in writes:
+                    self._hand_over(("points", write))
+                if writes and logger.level == logging.DEBUG:
+                    # The ADC is busy in its acquisition thread, the bias voltage is taken from the block
+                    bias = bias_voltage(self._config, data[:, self._measurements[phase].channel_map.bias])
+                    print_results(self._config, phase + 1, None, results, bias=bias)
+
+                if readings.rounds > rounds_done:
+                    rounds_done += 1
+                    log_round(f"Stopped the Round. Took {time.time() - round_start} seconds to do the Round :)")
+                    if self._persist:
+                        self._hand_over(("persist", energy_totals(self._measurements)))
+                    if self._rounds is not None and rounds_done == self._rounds:
+                        return
+                    round_start = time.time()
+                    log_round("Starting new round")
+        except Exception as error:
+            self._fail(error)
+
+    def _write(self) -> None:
+        timers = {"points": self._meter.stages.get("db_write"), "persist": self._meter.stages.get("persist")}
+        while True:
+            item = self._writes.get()
+            if item is _DONE:
+                return
+            kind, write = item
+            start = time.perf_counter()
+            try:
+                if kind == "points":
+                    bucket, points = write
+                    self._db.write(points, bucket=bucket)
+                    done = True
+                else:
+                    # Rounds the totals aren't saved in don't count
+                    done = self._meter.state.save_totals(write)
+            except Exception as error:
+                self._fail(error)
+                continue
+            if done and timers[kind] is not None:
+                timers[kind].add(time.perf_counter() - start)
@@ -0,0 +1,124 @@
+"""
+Module to calculate power values for any number of phases and CTs in a few vectorized reductions
+"""
+
+import numpy
+
+# Result of every CT: rms voltage of its phase, rms current, real power, apparent power and power factor
+POWER_DTYPE = numpy.dtype(
+    [
+        ("Voltage", numpy.float64),
+        ("Current", numpy.float64),
+        ("Watts", numpy.float64),
+        ("VA", numpy.float64),
+        ("PF", numpy.float64),
+    ]
+)
+
+# Currents below 100 mA are swinging around 0 and are reported as 0
+CURRENT_NOISE_FLOOR = 0.10
+
+# Ways SAMPLES can calculate the power: dot products of the shifted samples, or straight from their spectra
+POWER_METHODS = ("time", "spectral")
+
+# Largest difference of a value rounded to 2 decimals between both methods, one unit in the last decimal
+SPECTRAL_TOLERANCE = 0.01
+
+# Parseval weights of the rfft bins per block size
+_WEIGHTS = {}
+
+
+def compute_power(samples: numpy.ndarray, cutoffs: numpy.ndarray, decimals=2) -> numpy.ndarray:
+    """Calculates the power values of every CT on every phase
+
+    Args:
+        samples (numpy.ndarray): (phases, 7, samples) array. Row 0 holds the voltage, rows 1 - 6 the CT currents
+        cutoffs (numpy.ndarray): (phases, 6) real power in W below which a CT reads 0 W and PF 0, 0 disables it
+        decimals (int): Decimals the results are rounded to
+
+    Returns:
+        numpy.ndarray: (phases, 6) array of POWER_DTYPE
+    """
+    num_samples = samples.shape[-1]
+    voltage = samples[:, 0]
+    currents = samples[:, 1:]
+
+    averages = samples.mean(axis=-1)
+    avg_voltage = averages[:, :1]
+    avg_current = averages[:, 1:]
+
+    mean_inst_power = numpy.matmul(currents, voltage[:, :, None])[:, :, 0] / num_samples
+    mean_square_voltage = numpy.einsum("pn,pn->p", voltage, voltage)[:, None] / num_samples
+    mean_square_current = numpy.einsum("pcn,pcn->pc", currents, currents) / num_samples
+
+    real_power = mean_inst_power - avg_current * avg_voltage
+    rms_voltage = numpy.sqrt(numpy.abs(mean_square_voltage - avg_voltage**2))
+    rms_current = numpy.sqrt(numpy.abs(mean_square_current - avg_current**2))
+    return _power_values(real_power, rms_voltage, rms_current, cutoffs, decimals)
+
+
+def _bin_weights(samples: int) -> numpy.ndarray:
+    # Weight of the real and imaginary part of every rfft bin in Parseval's theorem, divided by samples**2 to get
+    # mean values. DC is left out as it is the mean that gets removed
+    weights = _WEIGHTS.get(samples)
+    if weights is None:
+        bins = numpy.full(samples // 2 + 1, 2.0)
+        bins[0] = 0.0
+        if samples % 2 == 0:
+            bins[-1] = 1.0
+        weights = numpy.repeat(bins, 2) / samples**2
+        _WEIGHTS[samples] = weights
+    return weights
+
+
+def compute_power_spectral(spectra: numpy.ndarray, samples: int, cutoffs: numpy.ndarray, decimals=2) -> numpy.ndarray:
+    """Calculates the power values of every CT on every phase from the rfft of the samples
+
+    Real power comes from the cross-spectrum of voltage and current, the RMS values from Parseval's theorem. Phase
+    corrections have to be applied to the current spectra beforehand, see SAMPLES.calculate_power_spectral(). The
+    results equal those of compute_power() on the same samples up to float rounding, so at most one unit in the
+    last of {decimals} differs (SPECTRAL_TOLERANCE).
+
+    Args:
+        spectra (numpy.ndarray): (phases, 7, samples // 2 + 1) rfft of the samples, rows as in compute_power()
+        samples (int): Samples the spectra were taken from
+        cutoffs (numpy.ndarray): (phases, 6) real power in W below which a CT reads 0 W and PF 0, 0 disables it
+        decimals (int): Decimals the results are rounded to
+
+    Returns:
+        numpy.ndarray: (phases, 6) array of POWER_DTYPE
+    """
+    # As floats every bin is a (real, imaginary) pair, which turns the cross-spectrum into plain dot products
+    weights = _bin_weights(samples)
+    values = spectra.view(numpy.float64)
+    voltage = values[:, 0]
+    currents = values[:, 1:]
+    weighted_voltage = voltage * weights
+
+    real_power = numpy.matmul(currents, weighted_voltage[:, :, None])[:, :, 0]
+    mean_square_voltage = numpy.einsum("pk,pk->p", voltage, weighted_voltage)[:, None]
+    mean_square_current = numpy.einsum("pck,pck,k->pc", currents, currents, weights)
+
+    rms_voltage = numpy.sqrt(numpy.abs(mean_square_voltage))
+    rms_current = numpy.sqrt(numpy.abs(mean_square_current))
+    return _power_values(real_power, rms_voltage, rms_current, cutoffs, decimals)
+
+
+def _power_values(real_power, rms_voltage, rms_current, cutoffs, decimals):
+    # Noise floor, cutoffs, power factor and rounding shared by both ways of calculating
+    rms_current[rms_current < CURRENT_NOISE_FLOOR] = 0.00
+
+    apparent_power = rms_voltage * rms_current
+    power_factor = numpy.divide(real_power, apparent_power, out=numpy.zeros_like(real_power), where=apparent_power != 0)
+
+    cut = (cutoffs != 0) & (numpy.abs(real_power) < cutoffs)
+    real_power[cut] = 0.00
+    power_factor[cut] = 0.00
+
+    result = numpy.empty(real_power.shape, dtype=POWER_DTYPE)
+    result["Voltage"] = numpy.round(numpy.broadcast_to(rms_voltage, real_power.shape), decimals)
+    result["Current"] = numpy.round(rms_current, decimals)
+    result["Watts"] = numpy.round(real_power, decimals)
+    result["VA"] = numpy.round(apparent_power, decimals)
+    result["PF"] = numpy.round(power_factor, decimals)
+    return result
@@ -0,0 +1,412 @@
+"""
+Module to run the measurement loop with one process per phase
+
+Every phase process owns the ADC and the SAMPLES instance of its phase, takes the blocks and calculates their power
+values, so the phases use separate cores instead of sharing one under the GIL. The results are passed to the
+coordinator, the main process, through a ring buffer in shared memory per phase. A semaphore shared by all phases
+tells the coordinator that new results are waiting. The coordinator averages the readings, integrates the energy,
+writes to InfluxDB and saves the totals, so those stay in one place just like in the sequential loop.
+
+A ring holds a header followed by {slots} records and the stage histograms of the phase process:
+
+    written      uint64   number of records written so far, the next one goes to slot written % slots
+    read         uint64   number of records the coordinator got to so far
+    done         uint32   set once the phase process stopped
+    records               RESULT_DTYPE, one per block
+    stages       float64  copy of Stages.counts, see instrumentation
+
+A record:
+
+    seq          uint64   2 * n + 2 for the n-th record once it is complete, 2 * n + 1 while it gets written
+    t_start      float64  time the block was started at
+    t_end        float64  time the block was finished at
+    frequency    float64  grid frequency estimated over the block, NaN without a measured sample rate
+    bias         float64  mean Bias_V voltage of the block, so the coordinator never reads from the ADC
+    power                 POWER_DTYPE of the 6 CTs
+
+The seq of a slot works like a seqlock: the coordinator reads it before and after copying the record and only takes
+the copy if both are the complete seq it expects. A record the phase process overwrote meanwhile counts as dropped.
+Plain stores to shared memory may become visible to the other process in any order, e.g. on the ARM cores of the Pi,
+so the odd seq, the publishing of the record and the reads of the seq around the copy each take the lock of the ring.
+Its semaphore orders the memory accesses before and after it, the lock is only ever held for those few accesses.
+
+The phase processes start sampling once the coordinator is ready to read. Replays never drop a record, their phase
+processes wait while the ring is full, so they give the same energy totals as the other runtimes.
+"""
+
+import contextlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy
+
+from .capture import MCP3008_REPLAY
+from .config import reload_config
+from .instrumentation import SHAPE, Stages
+from .logging import logger
+from .pipeline import POLL_INTERVAL, Readings
+from .power import POWER_DTYPE
+from .samples import clear_shift_cache
+from .stream import DEFAULT_STREAM_SLOTS, BlockStream
+from .utils import bias_voltage, fill_samples, print_results
+
+# Results per phase the ring holds before the oldest get overwritten
+DEFAULT_RING_SLOTS = 64
+# Seconds a replay waits for the coordinator to free a slot of the full ring
+WAIT_INTERVAL = 0.001
+
+RING_HEADER_DTYPE = numpy.dtype([("written", "<u8"), ("read", "<u8"), ("done", "<u4"), ("reserved", "<u4")])
+RESULT_DTYPE = numpy.dtype(
+    [
+        ("seq", "<u8"),
+        ("t_start", "<f8"),
+        ("t_end", "<f8"),
+        ("frequency", "<f8"),
+        ("bias", "<f8"),
+        ("power", POWER_DTYPE, (6,)),
+    ],
+    align=True,
+)
+
+
+class ResultRing:
+    """Single producer, single consumer ring buffer of RESULT_DTYPE records in shared memory
+
+    The producer doesn't wait unless it wants to, see {full}: once the consumer is {slots} records behind, the
+    oldest ones get overwritten and are counted in {dropped} when the consumer gets to them.
+
+    Args:
+        slots (int): Number of records the ring holds
+        lock (multiprocessing.Lock): Lock shared by producer and consumer, a barrier for the seqlock
+        name (str): Name of the shared memory block to attach to, a new one gets created without
+    """
+
+    def __init__(self, slots: int, lock, name=None):
+        self.slots = slots
+        self._lock = lock
+        records_size = slots * RESULT_DTYPE.itemsize
+        size = RING_HEADER_DTYPE.itemsize + records_size + int(numpy.prod(SHAPE)) * 8
+        self._shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self._header = numpy.ndarray((), dtype=RING_HEADER_DTYPE, buffer=self._shm.buf)
+        self._records = numpy.ndarray(
+            (slots,), dtype=RESULT_DTYPE, buffer=self._shm.buf, offset=RING_HEADER_DTYPE.itemsize
+        )
+        self._stages = numpy.ndarray(
+            SHAPE, dtype=numpy.float64, buffer=self._shm.buf, offset=RING_HEADER_DTYPE.itemsize + records_size
+        )
+        if name is None:
+            self._header[...] = 0
+            self._stages[...] = 0
+        self._read = 0
+        self.dropped = 0
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def full(self) -> bool:
+        """The next record the producer writes overwrites one the consumer didn't get to yet"""
+        return int(self._header["written"]) - int(self._header["read"]) >= self.slots
+
+    @property
+    def done(self) -> bool:
+        """The producer stopped and every record it wrote was read"""
+        with self._lock:
+            return bool(self._header["done"]) and self._read >= int(self._header["written"])
+
+    def push(self, t_start: float, t_end: float, power: numpy.ndarray, frequency: float, bias: float) -> None:
+        """Writes the power values, grid frequency and bias voltage of a block taken from {t_start} until {t_end}"""
+        seq = int(self._header["written"])
+        record = self._records[seq % self.slots]
+        # Odd while the slot gets written, a consumer copying it meanwhile throws the copy away
+        with self._lock:
+            record["seq"] = 2 * seq + 1
+        record["t_start"] = t_start
+        record["t_end"] = t_end
+        record["frequency"] = frequency
+        record["bias"] = bias
+        record["power"] = power
+        # Publishing the record last, the consumer doesn't look at it before it is complete
+        with self._lock:
+            record["seq"] = 2 * seq + 2
+            self._header["written"] = seq + 1
+
+    def store_stages(self, counts: numpy.ndarray) -> None:
+        """Copies the stage histograms of the producer"""
+        self._stages[...] = counts
+
+    def stages(self) -> numpy.ndarray:
+        """Copy of the stage histograms the producer stored last"""
+        return self._stages.copy()
+
+    def finish(self) -> None:
+        """Marks the producer as stopped"""
+        with self._lock:
+            self._header["done"] = 1
+
+    def pop(self):
+        """Reads the oldest record not read yet
+
+        Returns:
+            numpy.void|None: Copy of the record, None if there is nothing new
+        """
+        while True:
+            with self._lock:
+                written = int(self._header["written"])
+                if self._read >= written:
+                    return None
+                if written - self._read > self.slots:
+                    self.dropped += written - self.slots - self._read
+                    self._read = written - self.slots
+                slot = self._records[self._read % self.slots]
+                before = int(slot["seq"])
+            complete = 2 * self._read + 2
+            record = slot.copy()
+            with self._lock:
+                after = int(slot["seq"])
+                self._read += 1
+                self._header["read"] = self._read
+            if before == after == complete:
+                return record
+            # The producer lapped the ring and started writing the slot again before or while it got copied
+            self.dropped += 1
+
+    def close(self) -> None:
+        """Detaches from the shared memory, the views into it have to go first"""
+        del self._header, self._records, self._stages
+        self._shm.close()
+
+    def unlink(self) -> None:
+        """Frees the shared memory, done by the coordinator that created it"""
+        self._shm.unlink()
+
+
+def _phase_process(
+    adc, measurements, samples, ring_name, lock, slots, stream_slots, ready, started, stop, config_path, stages
+):
+    # Ctrl-c is handled by the coordinator, which then asks the phase processes to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    # The coordinator forwards SIGHUP, every phase process reloads the config on its own
+    reload_requested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+    ring = ResultRing(slots, lock, name=ring_name)
+    # A replay has all the time in the world, rather than dropping results it waits for the coordinator
+    lossless = isinstance(adc, MCP3008_REPLAY)
+    # The stages of a block are timed here and passed on through the ring
+    stages = Stages(stages)
+    stages.attach([adc], [measurements])
+    read_timer = stages.get("adc_read")
+    scale_timer = stages.get("scale")
+    if stream_slots:
+        adc = BlockStream(adc, samples, stream_slots)
+    clock = getattr(adc, "now", time.time)
+    try:
+        # Blocks taken before the coordinator reads would overwrite each other in the ring
+        while not started.wait(POLL_INTERVAL):
+            if stop.is_set():
+                return
+        while not stop.is_set():
+            if reload_requested.is_set():
+                reload_requested.clear()
+                # Whether the config could be reloaded is reported by the coordinator
+                with contextlib.suppress(OSError, ValueError):
+                    measurements.reconfigure(*reload_config(config_path, measurements._config))
+                    clear_shift_cache()
+            time_start = clock()
+            read_start = time.perf_counter()
+            data = adc.read_block(samples=samples)
+            time_end = clock()
+            if read_timer is not None:
+                read_timer.add(time.perf_counter() - read_start)
+            # The ADC knows when the block was actually sampled
+            time_start, time_end = getattr(adc, "block_times", (time_start, time_end))
+            fill_samples(measurements, data, time_start, time_end, getattr(adc, "sample_rate", None), timer=scale_timer)
+            power = measurements.correct_and_calculate_power()
+            if stages.enabled:
+                ring.store_stages(stages.counts)
+            bias = bias_voltage(measurements._config, data[:, measurements.channel_map.bias])
+            frequency = measurements.measured_frequency
+            while lossless and ring.full and not stop.is_set():
+                time.sleep(WAIT_INTERVAL)
+            ring.push(time_start, time_end, power, numpy.nan if frequency is None else frequency, bias)
+            ready.release()
+    except EOFError:
+        # A replay ran out of blocks
+        pass
+    finally:
+        ring.finish()
+        ready.release()
+        adc.close()
+        ring.close()
+
+
+def _terminate(signum, frame):
+    # SIGTERM takes the same way out as Ctrl-c
+    raise KeyboardInterrupt
+
+
+class PhaseProcesses:
+    """Phase processes and the coordinator collecting their results
+
+    Args:
+        meter (RpiEnergyMeter): Meter whose config and config path are used
+        ADC (list): ADC instance per phase, handed to the phase processes
+        MEASUREMENTS (list): SAMPLES instance per phase. Copies calculate in the phase processes, these hold the
+            energy totals
+        DB (infv2db): Database to write the points to
+        persist (bool): Save the energy totals to the state file after every round and on exit
+        rounds (int): Return after this many rounds (including their writes) instead of running forever
+    """
+
+    def __init__(self, meter, ADC, MEASUREMENTS, DB, persist=True, rounds=None):
+        self._meter = meter
+        self._config = meter.config
+        self._adc = ADC
+        self._measurements = MEASUREMENTS
+        self._db = DB
+        self._persist = persist
+        self._rounds = rounds
+        self._slots = int(self._config.GENERAL.get("RING_SLOTS", DEFAULT_RING_SLOTS))
+
+    def run(self) -> None:
+        """Runs the phase processes until {rounds} are done, every ADC ran out of blocks or Ctrl-c / SIGTERM"""
+        # Spawned processes start from a clean interpreter, without the threads of the InfluxDB client
+        context = multiprocessing.get_context("spawn")
+        ready = context.Semaphore(0)
+        started = context.Event()
+        stop = context.Event()
+        locks = [context.Lock() for _ in self._adc]
+        rings = [ResultRing(self._slots, lock) for lock in locks]
+        # In continuous mode the phase processes sample back-to-back while calculating
+        stream_slots = (
+            int(self._config.GENERAL.get("STREAM_SLOTS", DEFAULT_STREAM_SLOTS))
+            if self._config.GENERAL.get("CONTINUOUS", False)
+            else 0
+        )
+        processes = []
+        for phase, adc in enumerate(self._adc):
+            # The ADC is opened again inside its process
+            adc.close()
+            processes.append(
+                context.Process(
+                    target=_phase_process,
+                    args=(
+                        adc,
+                        self._measurements[phase],
+                        self._config.GENERAL.ADC_SAMPLES,
+                        rings[phase].name,
+                        locks[phase],
+                        self._slots,
+                        stream_slots,
+                        ready,
+                        started,
+                        stop,
+                        self._meter.config_path,
+                        self._meter.stages.enabled,
+                    ),
+                    name=f"phase-{phase + 1}",
+                    daemon=True,
+                )
+            )
+
+        def hang_up(signum, frame):
+            self._meter.reload_requested.set()
+            for process in processes:
+                if process.pid is not None and process.is_alive():
+                    os.kill(process.pid, signal.SIGHUP)
+
+        previous = signal.signal(signal.SIGTERM, _terminate)
+        previous_hang_up = signal.signal(signal.SIGHUP, hang_up)
+        interrupted = False
+        for ring in rings:
+            self._meter.stages.merge(ring.stages)
+        try:
+            for process in processes:
+                process.start()
+            # The phase processes sample from here on, all of them together
+            started.set()
+            self._coordinate(rings, processes, ready)
+        except KeyboardInterrupt:
+            interrupted = True
+        finally:
+            stop.set()
+            for process in processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            dropped = sum(ring.dropped for ring in rings)
+            self._meter.stages.release()
+            for ring in rings:
+                ring.close()
+                ring.unlink()
+            signal.signal(signal.SIGTERM, previous)
+            signal.signal(signal.SIGHUP, previous_hang_up)
+
+        if dropped:
+            logger.warning(f"... The coordinator fell behind, {dropped} results of the phase processes were dropped")
+        if interrupted:
+            self._db.close()
+            if self._persist:
+                self._meter.state.save(self._measurements, force=True)
+                self._meter.state.close()
+            sys.exit()
+
+    def _coordinate(self, rings, processes, ready) -> None:
+        stages = self._meter.stages
+        readings = Readings(self._config, self._measurements, metrics=self._meter.metrics, stages=stages)
+        db_timer = stages.get("db_write")
+        persist_timer = stages.get("persist")
+        rounds_done = 0
+        round_start = time.time()
+        # Round logging would only slow down replays
+        log_round = logger.info if self._persist else logger.debug
+        log_round("Starting new round")
+
+        while not all(ring.done for ring in rings):
+            if self._meter.reload_requested.is_set() and self._meter.apply_reload(self._measurements, readings):
+                self._config = self._meter.config
+            ready.acquire(timeout=POLL_INTERVAL)
+            for phase, ring in enumerate(rings):
+                while True:
+                    record = ring.pop()
+                    if record is None:
+                        break
+                    results = record["power"]
+                    # The frequency is estimated by the phase process, the points are written from here
+                    if not numpy.isnan(record["frequency"]):
+                        self._measurements[phase].frequency = record["frequency"]
+                    writes = readings.add(phase, results, float(record["t_start"]), float(record["t_end"]))
+                    for bucket, points in writes:
+                        start = time.perf_counter()
+                        self._db.write(points, bucket=bucket)
+                        if db_timer is not None:
+                            db_timer.add(time.perf_counter() - start)
+                    if writes and logger.level == logging.DEBUG:
+                        # The ADC belongs to the phase process, the bias voltage comes with the results
+                        print_results(self._config, phase + 1, None, results, bias=float(record["bias"]))
+
+                    if readings.rounds > rounds_done:
+                        rounds_done += 1
+                        log_round(f"Stopped the Round. Took {time.time() - round_start} seconds to do the Round :)")
+                        if self._persist:
+                            start = time.perf_counter()
+                            # Rounds the totals aren't saved in don't count
+                            if self._meter.state.save(self._measurements) and persist_timer is not None:
+                                persist_timer.add(time.perf_counter() - start)
+                        if self._rounds is not None and rounds_done == self._rounds:
+                            return
+                        round_start = time.time()
+                        log_round("Starting new round")
+
+            for phase, process in enumerate(processes):
+                if process.exitcode not in (None, 0):
+                    raise RuntimeError(f"Process of phase {phase + 1} failed with exit code {process.exitcode}")
@@ -3,55 +3,219 @@ Module to represent and interact with samples taken by raspi power monitor
 """
 
 import cmath
-from math import sqrt
+from time import perf_counter
+from typing import NamedTuple
 
 import numpy
 from box import Box
 
+from .config import PhaseConfig, RuntimeConfig, compile_config
+from .power import POWER_DTYPE, compute_power, compute_power_spectral
+
+# Order of the channels inside a ChannelMap and of the first rows of the SAMPLES buffer
+CHANNEL_NAMES = ("vac", "ct1", "ct2", "ct3", "ct4", "ct5", "ct6")
+# All rows of the SAMPLES buffer
+ROW_NAMES = (*CHANNEL_NAMES, "bias", "t")
+
+# Ways shift_phase can correct the CTs: rotation of the spectrum, fractional delay FIR, or FIR up to a block size
+SHIFT_METHODS = ("fft", "fir", "auto")
+DEFAULT_FIR_MAX_SAMPLES = 256
+# Taps on either side of the centre of a fractional delay kernel, on top of the whole samples of the delay
+FIR_HALF_TAPS = 8
+
+# Frequency estimates further than this (relative) from PHASES.FREQUENCY are taken as measurement errors
+FREQUENCY_RANGE = 0.1
+# Decimals the estimated frequency (Hz) is rounded to, and the sample rate to whole samples per second, so the FIR
+# kernels cached for them are reused
+FREQUENCY_DECIMALS = 2
+
+# numpy >= 2.0 lets the FFTs write into preallocated arrays
+_FFT_OUT = numpy.lib.NumpyVersion(numpy.__version__) >= "2.0.0"
+
+# Correction factors by shifts and FIR kernels by (shifts, sample rate, frequency), shared by all phases
+_ROTATIONS = {}
+_KERNELS = {}
+# Entries a cache holds before it is emptied, estimated frequencies add new keys over time
+_CACHE_LIMIT = 64
+
+
+class ChannelMap(NamedTuple):
+    """ADC channel layout of one phase, resolved once from the config
+
+    Attributes:
+        channels (numpy.ndarray): ADC channel of every entry in CHANNEL_NAMES
+        bias (int): ADC channel of the bias voltage
+        scale (numpy.ndarray): Factor turning bias corrected ADC values into volts/amperes, including the
+            correction factor of the channel
+    """
+
+    channels: numpy.ndarray
+    bias: int
+    scale: numpy.ndarray
+
+
+def build_channel_map(settings: PhaseConfig, correction_factors: dict) -> ChannelMap:
+    """Resolves the ChannelMap of a phase
+
+    Args:
+        settings (PhaseConfig): Compiled settings of the phase, see compile_config()
+        correction_factors (dict): Correction factor per entry in CHANNEL_NAMES
+
+    Returns:
+        ChannelMap: Channel layout and scale factors of the phase
+    """
+    return ChannelMap(
+        channels=settings.channels,
+        bias=settings.bias,
+        scale=settings.scale * numpy.array([correction_factors[name] for name in CHANNEL_NAMES]),
+    )
+
+
+def rotation_factors(shifts: tuple) -> numpy.ndarray:
+    """Cached (len(shifts), 1) array rotating every bin of an rfft by the shift of its CT, it broadcasts over the bins
+
+    Args:
+        shifts (tuple): Phase shift in radians per CT
+
+    Returns:
+        numpy.ndarray: Complex correction factor per CT
+    """
+    factors = _ROTATIONS.get(shifts)
+    if factors is None:
+        if len(_ROTATIONS) >= _CACHE_LIMIT:
+            _ROTATIONS.clear()
+        factors = numpy.exp(1j * numpy.array(shifts, dtype=numpy.float64))[:, None]
+        _ROTATIONS[shifts] = factors
+    return factors
+
+
+def fir_kernels(shifts: tuple, sample_rate: float, frequency: float) -> numpy.ndarray:
+    """Cached Blackman windowed sinc kernels advancing the signal of every CT by its shift in radians of {frequency}
+
+    At {frequency} a kernel does the same as the rotation in the spectrum, at the harmonics it is a true time
+    shift. The taps are meant to be correlated with the signal, see SAMPLES.shift_phase().
+
+    Args:
+        shifts (tuple): Phase shift in radians per CT
+        sample_rate (float): Samples per second
+        frequency (float): Grid frequency in Hz
+
+    Returns:
+        numpy.ndarray: (len(shifts), 2 * half + 1) taps, the same number for every CT
+    """
+    key = (shifts, sample_rate, frequency)
+    kernels = _KERNELS.get(key)
+    if kernels is None:
+        if len(_KERNELS) >= _CACHE_LIMIT:
+            _KERNELS.clear()
+        delays = numpy.array(shifts, dtype=numpy.float64) / (2 * numpy.pi * frequency) * sample_rate
+        half = FIR_HALF_TAPS + int(numpy.ceil(numpy.abs(delays).max(initial=0.0)))
+        taps = numpy.arange(2 * half + 1)
+        kernels = numpy.sinc(half - taps + delays[:, None]) * numpy.blackman(2 * half + 3)[1:-1]
+        kernels /= kernels.sum(axis=1, keepdims=True)
+        _KERNELS[key] = kernels
+    return kernels
+
+
+def rising_crossings(values: numpy.ndarray) -> numpy.ndarray:
+    """Positions where {values} rise through their mean, interpolated linearly between the samples around them
+
+    Args:
+        values (numpy.ndarray): Samples of one channel
+
+    Returns:
+        numpy.ndarray: Fractional sample positions, a crossing between sample i and i + 1 lies in (i, i + 1]
+    """
+    centred = values - values.mean()
+    below = numpy.flatnonzero((centred[:-1] < 0) & (centred[1:] >= 0))
+    return below + centred[below] / (centred[below] - centred[below + 1])
+
+
+def estimate_frequency(crossings: numpy.ndarray, sample_rate: float, frequency: float):
+    """Estimates the frequency of a signal from its rising crossings
+
+    Crossings less than half a period of the expected {frequency} after the one before are noise around a single
+    crossing and dropped, the cycles between the first and the last one left are counted.
+
+    Args:
+        crossings (numpy.ndarray): Positions of the rising crossings, see rising_crossings()
+        sample_rate (float): Samples per second
+        frequency (float): Expected frequency in Hz
+
+    Returns:
+        float|None: Frequency in Hz, None if the crossings do not span a whole cycle
+    """
+    if len(crossings) < 2:
+        return None
+    kept = numpy.diff(crossings) > sample_rate / frequency / 2
+    cycles = int(numpy.count_nonzero(kept))
+    if cycles == 0:
+        return None
+    last = crossings[1:][kept][-1]
+    return cycles * sample_rate / float(last - crossings[0])
+
+
+def clear_shift_cache() -> None:
+    """Drops the cached correction factors and FIR kernels, e.g. after the config changed"""
+    _ROTATIONS.clear()
+    _KERNELS.clear()
 
-class SAMPLES:
-    def __init__(self, config: Box, phase: int, totals):
-        self._samples = {
-            "t": numpy.zeros(config.GENERAL.ADC_SAMPLES),
-            "vac": numpy.zeros(config.GENERAL.ADC_SAMPLES),
-            "ct1": numpy.zeros(config.GENERAL.ADC_SAMPLES),
-            "ct2": numpy.zeros(config.GENERAL.ADC_SAMPLES),
-            "ct3": numpy.zeros(config.GENERAL.ADC_SAMPLES),
-            "ct4": numpy.zeros(config.GENERAL.ADC_SAMPLES),
-            "ct5": numpy.zeros(config.GENERAL.ADC_SAMPLES),
-            "ct6": numpy.zeros(config.GENERAL.ADC_SAMPLES),
-            "bias": numpy.zeros(config.GENERAL.ADC_SAMPLES),
-        }
-
-        self._correction_factors = {
-            "vac": config.VOLTMETER.get(str(phase)).VAC.FACTOR,
-            "ct1": config.CTS.get(str(phase))["1"].FACTOR,
-            "ct2": config.CTS.get(str(phase))["2"].FACTOR,
-            "ct3": config.CTS.get(str(phase))["3"].FACTOR,
-            "ct4": config.CTS.get(str(phase))["4"].FACTOR,
-            "ct5": config.CTS.get(str(phase))["5"].FACTOR,
-            "ct6": config.CTS.get(str(phase))["6"].FACTOR,
-            "bias": config.VOLTMETER.get(str(phase)).BIAS.FACTOR,
-        }
-
-        self._phaseshifts = {
-            "ct1": config.CTS.get(str(phase))["1"].SHIFT,
-            "ct2": config.CTS.get(str(phase))["2"].SHIFT,
-            "ct3": config.CTS.get(str(phase))["3"].SHIFT,
-            "ct4": config.CTS.get(str(phase))["4"].SHIFT,
-            "ct5": config.CTS.get(str(phase))["5"].SHIFT,
-            "ct6": config.CTS.get(str(phase))["6"].SHIFT,
-        }
 
-        self._power = [
-            {
-                "Voltage": 0.00,
-                "Current": 0.00,
-                "Watts": 0.00,
-                "PF": 0.00,
-            }
-            for _ in range(6)
-        ]
+class SAMPLES:
+    """Samples of one phase and the values calculated from them
+
+    All channels live in one preallocated (9, samples) buffer, rows ordered like ROW_NAMES. Everything
+    handed out (samples, samples_ct1, channels, ...) are views into that buffer, and everything stored is
+    copied into it, so taking new readings does not allocate new sample arrays.
+    """
+
+    __slots__ = (
+        "_config",
+        "_phase_config",
+        "_phase",
+        "_buffer",
+        "_samples",
+        "_ramp",
+        "_correction_factors",
+        "_phaseshifts",
+        "_ct_count",
+        "_shifts",
+        "_shift_method",
+        "_fir_max_samples",
+        "_sample_rate",
+        "_nominal_rate",
+        "_frequency",
+        "_nominal_frequency",
+        "_block_rate",
+        "_frequency_measured",
+        "_track_frequency",
+        "_spectrum",
+        "_spectra",
+        "_power_method",
+        "_padded",
+        "_window",
+        "_cycle_align",
+        "_channel_map",
+        "_cutoffs",
+        "_power",
+        "_energy",
+        "_energy_time",
+        "_sampled_time",
+        "_covered_time",
+        "_timers",
+    )
+
+    def __init__(self, config: Box, phase: int, totals, runtime=None):
+        runtime = runtime or compile_config(config)
+        self._phase = phase
+        self.resize(runtime.samples)
+        self._configure(config, runtime)
+        self._frequency = self._nominal_frequency
+        self._frequency_measured = False
+        self._sample_rate = self._nominal_rate
+        self._block_rate = None
+
+        self._power = numpy.zeros(6, dtype=POWER_DTYPE)
 
         self._energy = [
             {
@@ -59,13 +223,92 @@ class SAMPLES:
             }
             for i in range(6)
         ]
+        # End of the last block integrated, and the time sampled / covered since the last duty cycle was taken
+        self._energy_time = None
+        self._sampled_time = 0.0
+        self._covered_time = 0.0
+        # Histograms of the phase correction and the power calculation, see set_timers()
+        self._timers = None
+
+    def _configure(self, config: Box, runtime: RuntimeConfig) -> None:
+        # Takes over everything the phase needs from the compiled config
+        settings = runtime.phases[self._phase - 1]
+        self._config = config
+        self._phase_config = settings
+        self._correction_factors = {
+            "vac": settings.vac_factor,
+            **dict(zip(CHANNEL_NAMES[1:], settings.ct_factors.tolist())),
+            "bias": settings.bias_factor,
+        }
+        self._phaseshifts = dict(zip(CHANNEL_NAMES[1:], settings.shifts.tolist()))
+        self._ct_count = settings.ct_count
+        self._shifts = tuple(self._phaseshifts[name] for name in CHANNEL_NAMES[1 : 1 + self._ct_count])
+        self._shift_method = runtime.shift_method
+        self._cycle_align = runtime.cycle_align
+        self._power_method = runtime.power_method
+        self._fir_max_samples = runtime.fir_max_samples
+        self._nominal_rate = runtime.sample_rate
+        self._nominal_frequency = runtime.frequency
+        self._track_frequency = runtime.frequency_tracking
+        self._channel_map = build_channel_map(settings, self._correction_factors)
+        self._cutoffs = settings.cutoffs
+
+    def reconfigure(self, config: Box, runtime=None) -> None:
+        """Switches to the settings of {config} between two blocks, keeping the energy totals and the buffer
+
+        Args:
+            config (Box): Configuration with the same GENERAL.ADC_SAMPLES, see restart_settings()
+            runtime (RuntimeConfig): {config} compiled, compile_config() is called without
+        """
+        nominal = self._nominal_frequency
+        self._configure(config, runtime or compile_config(config))
+        if self._nominal_frequency != nominal:
+            # The estimate of the old grid frequency would be dropped as out of range forever
+            self._frequency = self._nominal_frequency
+            self._frequency_measured = False
+            self._sample_rate = self._nominal_rate
+
+    def set_timers(self, shift=None, power=None) -> None:
+        """Lets correct_and_calculate_power() add its durations to the Histograms {shift} and {power}
+
+        The frequency tracking and the cycle alignment count as shift. With POWER_METHOD spectral the correction
+        happens in the spectrum and counts as power.
+        """
+        self._timers = (shift, power) if shift is not None or power is not None else None
+
+    def resize(self, samples: int) -> None:
+        """(Re)allocates the buffer for blocks of {samples} samples"""
+        self._buffer = numpy.zeros((len(ROW_NAMES), samples))
+        self._samples = {name: self._buffer[i] for i, name in enumerate(ROW_NAMES)}
+        self._ramp = numpy.arange(samples, dtype=numpy.float64)
+        # Scratch arrays of shift_phase, allocated on first use
+        self._spectrum = None
+        self._spectra = None
+        self._padded = None
+        self._window = slice(None)
+
+    def __getstate__(self):
+        # The views into the buffer are rebuilt when unpickling
+        return {name: getattr(self, name) for name in self.__slots__ if name not in ("_samples", "_ramp")}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._samples = {name: self._buffer[i] for i, name in enumerate(ROW_NAMES)}
+        self._ramp = numpy.arange(self._buffer.shape[1], dtype=numpy.float64)
 
     @property
     def samples(self):
         return self._samples
 
     def set_samples(self, samples, name):
-        self._samples[name] = numpy.array(samples)
+        if name in ROW_NAMES:
+            self._samples[name][...] = samples
+        else:
+            self._samples[name] = numpy.array(samples)
+
+    def _set_corrected(self, value, name):
+        numpy.multiply(value, self._correction_factors[name], out=self._samples[name])
 
     @property
     def correction_factors(self):
@@ -73,6 +316,71 @@ class SAMPLES:
 
     def set_correction_factor(self, factor, name):
         self._correction_factors[name] = factor
+        self._channel_map = build_channel_map(self._phase_config, self._correction_factors)
+
+    @property
+    def channel_map(self):
+        return self._channel_map
+
+    @property
+    def channels(self):
+        """(7, samples) view of the buffer rows in CHANNEL_NAMES order, to be filled in place"""
+        return self._buffer[: len(CHANNEL_NAMES)]
+
+    def set_time(self, t_start: float, t_end: float, sample_rate=None) -> None:
+        """Spreads the sample times evenly between {t_start} and {t_end}
+
+        Args:
+            t_start (float): Time the block was started at
+            t_end (float): Time the block was finished at
+            sample_rate (float): Effective samples per second of the block as measured by the ADC, None if it does not
+                know
+        """
+        step = (t_end - t_start) / max(len(self._ramp) - 1, 1)
+        numpy.multiply(self._ramp, step, out=self._samples["t"])
+        self._samples["t"] += t_start
+        self._block_rate = float(sample_rate) if sample_rate else None
+
+    @property
+    def frequency(self):
+        """Grid frequency in Hz, estimated from the voltage with GENERAL.FREQUENCY_TRACKING"""
+        return self._frequency
+
+    @frequency.setter
+    def frequency(self, value):
+        # Estimated elsewhere, e.g. by the phase process of the multiprocess runtime
+        self._frequency = float(value)
+        self._frequency_measured = True
+
+    @property
+    def measured_frequency(self):
+        """Grid frequency in Hz estimated at a measured sample rate, None as long as there is none"""
+        return self._frequency if self._frequency_measured else None
+
+    @property
+    def sample_rate(self):
+        """Samples per second the frequency was estimated with"""
+        return self._sample_rate
+
+    def track_frequency(self):
+        """Estimates the grid frequency from the rising crossings of the voltage in the current block
+
+        The estimate and the sample rate of the block replace PHASES.FREQUENCY and GENERAL.ADC_SAMPLERATE in the
+        cycle alignment and the FIR phase correction. Estimates too far from PHASES.FREQUENCY are dropped, the
+        last good one is kept then. Without a sample rate measured by the ADC nothing is estimated, the error of
+        GENERAL.ADC_SAMPLERATE would end up in the estimate.
+
+        Returns:
+            float: Frequency in Hz
+        """
+        if self._block_rate is None:
+            return self._frequency
+        estimate = estimate_frequency(rising_crossings(self._samples["vac"]), self._block_rate, self._frequency)
+        if estimate is not None and abs(estimate / self._nominal_frequency - 1) <= FREQUENCY_RANGE:
+            self._frequency = round(estimate, FREQUENCY_DECIMALS)
+            self._frequency_measured = True
+            self._sample_rate = float(round(self._block_rate))
+        return self._frequency
 
     @property
     def phaseshifts(self):
@@ -80,6 +388,7 @@ class SAMPLES:
 
     def set_phaseshift(self, shift, ct):
         self._phaseshifts[ct] = shift
+        self._shifts = tuple(self._phaseshifts[name] for name in CHANNEL_NAMES[1 : 1 + self._ct_count])
 
     @property
     def t(self):
@@ -87,7 +396,7 @@ class SAMPLES:
 
     @t.setter
     def t(self, value):
-        self._samples["t"] = numpy.array(value)
+        self._samples["t"][...] = value
 
     @property
     def samples_vac(self):
@@ -95,7 +404,7 @@ class SAMPLES:
 
     @samples_vac.setter
     def samples_vac(self, value):
-        self._samples["vac"] = numpy.asarray(value) * self._correction_factors["vac"]
+        self._set_corrected(value, "vac")
 
     @property
     def samples_ct1(self):
@@ -103,7 +412,7 @@ class SAMPLES:
 
     @samples_ct1.setter
     def samples_ct1(self, value):
-        self._samples["ct1"] = numpy.asarray(value) * self._correction_factors["ct1"]
+        self._set_corrected(value, "ct1")
 
     @property
     def samples_ct2(self):
@@ -111,7 +420,7 @@ class SAMPLES:
 
     @samples_ct2.setter
     def samples_ct2(self, value):
-        self._samples["ct2"] = numpy.asarray(value) * self._correction_factors["ct2"]
+        self._set_corrected(value, "ct2")
 
     @property
     def samples_ct3(self):
@@ -119,7 +428,7 @@ class SAMPLES:
 
     @samples_ct3.setter
     def samples_ct3(self, value):
-        self._samples["ct3"] = numpy.asarray(value) * self._correction_factors["ct3"]
+        self._set_corrected(value, "ct3")
 
     @property
     def samples_ct4(self):
@@ -127,7 +436,7 @@ class SAMPLES:
 
     @samples_ct4.setter
     def samples_ct4(self, value):
-        self._samples["ct4"] = numpy.asarray(value) * self._correction_factors["ct4"]
+        self._set_corrected(value, "ct4")
 
     @property
     def samples_ct5(self):
@@ -135,7 +444,7 @@ class SAMPLES:
 
     @samples_ct5.setter
     def samples_ct5(self, value):
-        self._samples["ct5"] = numpy.asarray(value) * self._correction_factors["ct5"]
+        self._set_corrected(value, "ct5")
 
     @property
     def samples_ct6(self):
@@ -143,7 +452,7 @@ class SAMPLES:
 
     @samples_ct6.setter
     def samples_ct6(self, value):
-        self._samples["ct6"] = numpy.asarray(value) * self._correction_factors["ct6"]
+        self._set_corrected(value, "ct6")
 
     @property
     def samples_bias(self):
@@ -151,7 +460,7 @@ class SAMPLES:
 
     @samples_bias.setter
     def samples_bias(self, value):
-        self._samples["bias"] = numpy.asarray(value) * self._correction_factors["bias"]
+        self._set_corrected(value, "bias")
 
     @property
     def power(self):
@@ -183,13 +492,25 @@ class SAMPLES:
 
         return phase_shift
 
-    def shift_phase(self, ct, amount=None) -> None:
+    def shift_phase(self, ct=None, amount=None) -> None:
         """Shifts a given current transformers measurements by a given amount
 
+        Without {ct} the configured CTs of the phase are all shifted by their SHIFT at once, either by rotating
+        their spectrum or, with GENERAL.SHIFT_METHOD "fir" (or "auto" and blocks of up to SHIFT_FIR_MAX_SAMPLES),
+        by a short fractional delay filter.
+
         Args:
             ct (int): Current transformer of which the measurements should be shifted
             amount (int): Amount by which the measurements are shifted
         """
+        if ct is None:
+            rows = self._buffer[1 : 1 + self._ct_count, self._window]
+            if self._shift_method == "fir" or (self._shift_method == "auto" and rows.shape[1] <= self._fir_max_samples):
+                self._shift_fir(rows, self._shifts)
+            else:
+                self._shift_fft(rows, self._shifts)
+            return
+
         str_ct = "ct" + str(ct + 1)
         if amount is None:
             amount = self.phaseshifts[str_ct]
@@ -199,61 +520,179 @@ class SAMPLES:
         # Remove phase shift from signal2
         shiftedFFT = valuesFFT * cmath.rect(1.0, amount)
         # Reverse Fourier transform
-        shifted = numpy.fft.irfft(shiftedFFT)
+        shifted = numpy.fft.irfft(shiftedFFT, n=len(values))
 
         self.set_samples(shifted.real, str_ct)
 
-    def calculate_power(self, phase, config):
+    def _shift_fft(self, rows, shifts):
+        # One rfft/irfft pair over all CTs, written back into the buffer rows
+        samples = rows.shape[1]
+        factors = rotation_factors(shifts)
+        if not _FFT_OUT:
+            rows[...] = numpy.fft.irfft(numpy.fft.rfft(rows, axis=-1) * factors, n=samples, axis=-1)
+            return
+        # Sized for the whole block, windows of it use the front part
+        bins = self._buffer.shape[1] // 2 + 1
+        if self._spectrum is None or self._spectrum.shape != (len(shifts), bins):
+            self._spectrum = numpy.empty((len(shifts), bins), dtype=numpy.complex128)
+        spectrum = self._spectrum[:, : samples // 2 + 1]
+        numpy.fft.rfft(rows, axis=-1, out=spectrum)
+        spectrum *= factors
+        numpy.fft.irfft(spectrum, n=samples, axis=-1, out=rows)
+
+    def _shift_fir(self, rows, shifts):
+        # The block is extended periodically, as the FFT implicitly does, and correlated with the kernels
+        samples = rows.shape[1]
+        kernels = fir_kernels(shifts, self._sample_rate, self._frequency)
+        half = kernels.shape[1] // 2
+        if self._padded is None or self._padded.shape != (len(shifts), self._buffer.shape[1] + 2 * half):
+            self._padded = numpy.empty((len(shifts), self._buffer.shape[1] + 2 * half))
+        padded = self._padded[:, : samples + 2 * half]
+        padded[:, half : half + samples] = rows
+        padded[:, :half] = rows[:, samples - half :]
+        padded[:, half + samples :] = rows[:, :half]
+        windows = numpy.lib.stride_tricks.sliding_window_view(padded, kernels.shape[1], axis=-1)
+        numpy.einsum("cnk,ck->cn", windows, kernels, out=rows)
+
+    def calculate_power(self):
         """Calculates Power values for all saved Measurements
 
+        The CUTOFF of every CT is taken from the config the instance was created with.
+
         Returns:
-            dict: Power values, voltage values, power factor values for all 6 CT-Channels
+            numpy.ndarray: Power values, voltage values, power factor values for all 6 CT-Channels (POWER_DTYPE)
         """
+        self._power = compute_power(self.channels[None, :, self._window], self._cutoffs[None])[0]
+        return self.power
 
-        samples_v = self.samples_vac
-        for i in range(len(self._power)):
-            samples_ct = self.samples["ct" + str(i + 1)]
+    @property
+    def power_method(self):
+        return self._power_method
+
+    def integrate_energy(self, power, time_start: float, time_end: float) -> None:
+        """Adds the energy of one block to the totals of every CT
 
-            num_samples = len(samples_v)
+        A block counts from the end of the block integrated before until its own end, so the totals cover the
+        whole time even if there are gaps between the blocks. The first block counts from {time_start}.
 
-            sum_raw_voltage = numpy.sum(samples_v)
-            sum_raw_current = numpy.sum(samples_ct)
-            sum_squared_voltage = numpy.dot(samples_v, samples_v)
-            sum_squared_current = numpy.dot(samples_ct, samples_ct)
-            sum_inst_power = numpy.dot(samples_v, samples_ct)
+        Args:
+            power (numpy.ndarray): Power values of the block (POWER_DTYPE)
+            time_start (float): Time the block was started at
+            time_end (float): Time the block was finished at
+        """
+        previous = time_start if self._energy_time is None else self._energy_time
+        hours = (time_end - previous) / (60 * 60)
+        for ct in range(self._ct_count):
+            self._energy[ct]["Total"] += float(power[ct]["Watts"]) * hours / 1000
+        self._energy_time = time_end
+        self._sampled_time += time_end - time_start
+        self._covered_time += time_end - previous
 
-            avg_raw_voltage = sum_raw_voltage / num_samples
-            avg_raw_current = sum_raw_current / num_samples
+    def integrate_window(self, window) -> None:
+        """Adds the energy of a {window} of readings to the totals of every CT
 
-            real_power = (sum_inst_power / num_samples) - (avg_raw_current * avg_raw_voltage)
+        The mean real power of every CT is taken as consumed over the whole window, the way energy is integrated
+        unless GENERAL.CONTINUOUS integrates every block on its own.
+
+        Args:
+            window (Window): Mean, minimum and maximum of the readings, see Aggregator.take()
+        """
+        for ct in range(self._ct_count):
+            energy = (float(window.mean[ct]["Watts"]) * (window.time_end - window.time_start)) / (60 * 60 * 1000)
+            self._energy[ct]["Total"] += energy
 
-            mean_square_voltage = sum_squared_voltage / num_samples
-            mean_square_current = sum_squared_current / num_samples
+    def take_duty_cycle(self) -> float:
+        """Share of the time covered by integrate_energy() since the last call that was actually sampled"""
+        duty_cycle = self._sampled_time / self._covered_time if self._covered_time > 0 else 0.0
+        self._sampled_time = 0.0
+        self._covered_time = 0.0
+        return duty_cycle
 
-            rms_voltage = sqrt(abs(mean_square_voltage - (avg_raw_voltage**2)))
-            rms_current = sqrt(abs(mean_square_current - (avg_raw_current**2)))
-            # Ignore 100 mA as it is swinging around 0.
-            rms_current = 0.00 if (-0.10 < rms_current < 0.10) else rms_current
+    @property
+    def window(self):
+        """Part of the block the power values are calculated from"""
+        return self._window
 
-            # Power Factor
-            apparent_power = rms_voltage * rms_current
+    def align_to_cycles(self) -> slice:
+        """Selects the longest part of the block that holds a whole number of mains cycles
 
-            try:
-                power_factor = real_power / apparent_power
-            except ZeroDivisionError:
-                power_factor = 0.00
+        The part starts at the first rising zero crossing of the voltage and ends at the rising zero crossing that
+        comes closest to a whole number of cycles later. Without such a crossing it ends a whole number of cycles
+        after the start, blocks of less than a cycle are used as a whole.
 
-            # Cutoff handling
-            if (
-                config.CTS[str(phase)][str(i + 1)].CUTOFF != 0
-                and abs(real_power) < config.CTS[str(phase)][str(i + 1)].CUTOFF
-            ):
-                real_power = 0.00
-                power_factor = 0.00
+        Returns:
+            slice: Samples of the block the power values are calculated from, also kept in {window}
+        """
+        voltage = self._samples["vac"]
+        crossings = numpy.ceil(rising_crossings(voltage)).astype(numpy.intp)
+        period = self._sample_rate / self._frequency
+        self._window = slice(None)
+        if len(crossings) == 0:
+            return self._window
+
+        start = int(crossings[0])
+        cycles = int((len(voltage) - start) // period)
+        if cycles == 0:
+            return self._window
+        target = start + cycles * period
+        stop = int(crossings[numpy.abs(crossings - target).argmin()])
+        if abs(stop - target) > period / 4:
+            stop = int(round(target))
+        self._window = slice(start, stop)
+        return self._window
+
+    def correct_and_calculate_power(self):
+        """Applies the phase correction of every CT and calculates the power values in the configured POWER_METHOD
 
-            self._power[i]["Voltage"] = round(rms_voltage, 2)
-            self._power[i]["Current"] = round(rms_current, 2)
-            self._power[i]["Watts"] = round(real_power, 2)
-            self._power[i]["PF"] = round(power_factor, 2)
+        Returns:
+            numpy.ndarray: Power values, voltage values, power factor values for all 6 CT-Channels (POWER_DTYPE)
+        """
+        timers = self._timers
+        start = perf_counter() if timers is not None else 0.0
+        if self._track_frequency:
+            self.track_frequency()
+        if self._cycle_align:
+            self.align_to_cycles()
+        spectral = self._power_method == "spectral"
+        if not spectral:
+            self.shift_phase()
+        if timers is None:
+            return self.calculate_power_spectral() if spectral else self.calculate_power()
+
+        shift, power = timers
+        middle = perf_counter()
+        results = self.calculate_power_spectral() if spectral else self.calculate_power()
+        if shift is not None:
+            shift.add(middle - start)
+        if power is not None:
+            power.add(perf_counter() - middle)
+        return results
+
+    def calculate_power_spectral(self):
+        """Calculates the same values as shift_phase() followed by calculate_power(), without the inverse FFT
+
+        The configured SHIFT of every CT is applied as rotation of its spectrum, the samples are left unchanged.
 
+        Returns:
+            numpy.ndarray: Power values, voltage values, power factor values for all 6 CT-Channels (POWER_DTYPE)
+        """
+        channels = self.channels[:, self._window]
+        samples = channels.shape[1]
+        # Sized for the whole block, windows of it use the front part
+        bins = self._buffer.shape[1] // 2 + 1
+        if self._spectra is None or self._spectra.shape[1] != bins:
+            self._spectra = numpy.empty((len(CHANNEL_NAMES), bins), dtype=numpy.complex128)
+        spectra = self._spectra[:, : samples // 2 + 1]
+        if _FFT_OUT:
+            numpy.fft.rfft(channels, axis=-1, out=spectra)
+        else:
+            spectra[...] = numpy.fft.rfft(channels, axis=-1)
+
+        currents = spectra[1 : 1 + self._ct_count]
+        currents *= rotation_factors(self._shifts)
+        if samples % 2 == 0:
+            # irfft only keeps the real part of the Nyquist bin, so the time domain correction does too
+            currents[:, -1] = currents[:, -1].real
+
+        self._power = compute_power_spectral(spectra[None], samples, self._cutoffs[None])[0]
         return self.power
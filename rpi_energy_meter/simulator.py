@@ -0,0 +1,147 @@
+"""
+Module to simulate a MCP3008 ADC fed with synthetic mains voltage and CT current waves
+"""
+
+import time
+from math import pi, sqrt
+
+import numpy
+from box import Box
+
+from .config import compile_config
+from .mcp3008 import ALL_CHANNELS
+from .samples import CHANNEL_NAMES, build_channel_map
+
+
+class MCP3008_SIMULATOR:
+    """Drop-in replacement for MCP3008_2 generating the frames a board wired like {config} would deliver
+
+    The voltage channel carries PHASES.FREQUENCY at the phase's VOLTAGE, every CT channel a current with a
+    configurable rms value, lag, harmonics and load steps. The waves are scaled back through the channel map,
+    so a reading reproduces the configured values, and every CT is skewed by -SHIFT so that the phase
+    correction has something to correct. All settings are read from the optional [SIMULATOR] section:
+
+        SPEED: 1 runs in real time, N runs N times faster, 0 as fast as possible
+        SAMPLE_RATE: Samples per second and channel, defaults to GENERAL.ADC_SAMPLERATE
+        FREQUENCY: Mains frequency, defaults to PHASES.FREQUENCY
+        NOISE: Standard deviation of the noise in ADC counts
+        BIAS_OFFSET: Offset of the bias voltage from ADC_RESOLUTION / 2 in ADC counts
+        HARMONICS: List of [order, amplitude relative to the fundamental] added to every current
+        SEED: Seed of the noise generator
+        <phase>.CURRENT: List of the rms currents of ct1 - ct6 in A
+        <phase>.LAG: List of the lags of ct1 - ct6 behind the voltage in rad
+        <phase>.STEPS: List of [seconds after start, ct, rms current] load steps
+
+    Like the hardware backends it provides the {block_times} of the last block on its simulated clock, and the
+    {sample_rate} it samples at. Reads of some channels only, like the bias voltage, are taken at the current time and
+    leave the clock where it is.
+
+    Args:
+        config (Box): Configuration
+        device (int): SPI chip select, the simulated phase is device + 1
+    """
+
+    def __init__(self, config: Box, device=0):
+        self.device = device
+        phase = device + 1
+        simulator = config.SIMULATOR
+        phase_simulator = simulator.get(str(phase), {})
+
+        # The same channel map the measurement scales with, CTs that aren't connected included
+        settings = compile_config(config).phases[device]
+        factors = {"vac": settings.vac_factor, **dict(zip(CHANNEL_NAMES[1:], settings.ct_factors.tolist()))}
+        self._channel_map = build_channel_map(settings, factors)
+
+        self._rate = float(simulator.get("SAMPLE_RATE", config.GENERAL.ADC_SAMPLERATE))
+        self._speed = float(simulator.get("SPEED", 1.0))
+        self._noise = float(simulator.get("NOISE", 0.5))
+        self._bias = config.GENERAL.ADC_RESOLUTION / 2 + float(simulator.get("BIAS_OFFSET", 0.0))
+        self._max_count = config.GENERAL.ADC_RESOLUTION - 1
+        self._omega = 2 * pi * float(simulator.get("FREQUENCY", config.PHASES.FREQUENCY))
+        self._harmonics = [(int(order), float(amplitude)) for order, amplitude in simulator.get("HARMONICS", [])]
+        self._rng = numpy.random.default_rng(simulator.get("SEED", None))
+
+        self._voltage = sqrt(2) * config.PHASES[str(phase)].VOLTAGE
+        self._phase_offset = -2 * pi / 3 * device
+        self._currents = sqrt(2) * numpy.array(phase_simulator.get("CURRENT", [0.0] * 6), dtype=numpy.float64)
+        # Nothing flows through CTs that aren't connected, whatever the channel they fall back to carries
+        self._currents[settings.ct_count :] = 0.0
+        self._lags = numpy.array(phase_simulator.get("LAG", [0.0] * 6), dtype=numpy.float64)
+        self._lags += settings.shifts
+        self._steps = sorted(
+            (float(t), int(ct) - 1, sqrt(2) * float(a))
+            for t, ct, a in phase_simulator.get("STEPS", [])
+            if int(ct) <= settings.ct_count
+        )
+
+        self._sample_index = 0
+        self._time_start = time.time()
+        self.block_times = (self._time_start, self._time_start)
+        self.sample_rate = self._rate
+
+    def open(self):
+        """Nothing to open, present for compatibility with the other ADC backends"""
+
+    def close(self):
+        """Nothing to close, present for compatibility with the other ADC backends"""
+
+    def now(self) -> float:
+        """Simulated time after the last sample taken"""
+        return self._time_start + self._sample_index / self._rate
+
+    def waves(self, samples: int) -> numpy.ndarray:
+        """Generates the next {samples} values of every channel in CHANNEL_NAMES in volts/amperes
+
+        Returns:
+            numpy.ndarray: (7, samples) array, rows ordered like CHANNEL_NAMES
+        """
+        t = (self._sample_index + numpy.arange(samples)) / self._rate
+        wt = self._omega * t + self._phase_offset
+
+        amplitudes = numpy.repeat(self._currents[:, None], samples, axis=1)
+        for start, ct, amplitude in self._steps:
+            amplitudes[ct, t >= start] = amplitude
+
+        angle = wt[None, :] - self._lags[:, None]
+        currents = numpy.sin(angle)
+        for order, amplitude in self._harmonics:
+            currents += amplitude * numpy.sin(order * angle)
+
+        values = numpy.empty((len(CHANNEL_NAMES), samples))
+        values[0] = self._voltage * numpy.sin(wt)
+        values[1:] = amplitudes * currents
+        return values
+
+    def read(self, channels=ALL_CHANNELS, samples=200):
+        """Reads {samples} samples of {channels} as a list of lists, one list of channel values per sample"""
+        return self.read_block(samples=samples, channels=channels).tolist()
+
+    def read_block(self, samples=200, channels=ALL_CHANNELS) -> numpy.ndarray:
+        """Generates {samples} samples of {channels}
+
+        Returns:
+            numpy.ndarray: uint16 array of shape (samples, len(channels))
+        """
+        counts = numpy.full((samples, len(ALL_CHANNELS)), self._bias)
+        # Channels can be shared, e.g. by CTs that aren't connected, their waves add up
+        numpy.add.at(
+            counts,
+            (slice(None), self._channel_map.channels),
+            (self.waves(samples) / self._channel_map.scale[:, None]).T,
+        )
+        if self._noise > 0:
+            counts += self._rng.normal(0.0, self._noise, counts.shape)
+        block = numpy.clip(numpy.rint(counts), 0, self._max_count).astype(numpy.uint16)
+
+        channels = str(channels)
+        if channels != ALL_CHANNELS:
+            return block[:, [int(c) for c in channels]]
+
+        time_start = self.now()
+        self._sample_index += samples
+        self.block_times = (time_start, self.now())
+        if self._speed > 0:
+            delay = self._time_start + (self._sample_index / self._rate) / self._speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return block
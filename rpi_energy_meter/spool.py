@@ -0,0 +1,125 @@
+"""
+Module to keep the points on disk while InfluxDB can't be reached
+
+A Spool is a SQLite database in WAL mode that payloads of line protocol are only ever appended to and taken from in
+the order they came in. Every payload is stored zlib compressed together with its bucket, precision and number of
+lines. Once the spool holds more than {max_bytes}, the oldest payloads make room for the new ones.
+
+    id           INTEGER  order the payloads were spooled in
+    bucket       TEXT     bucket the payload is written to
+    precision    TEXT     precision of its timestamps
+    lines        INTEGER  points in the payload
+    size         INTEGER  bytes of the uncompressed payload
+    data         BLOB     zlib compressed line protocol
+"""
+
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+from typing import Union
+
+# Compressed bytes the spool holds before the oldest payloads are dropped
+DEFAULT_SPOOL_MAX_BYTES = 64 * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payloads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bucket TEXT NOT NULL,
+    precision TEXT NOT NULL,
+    lines INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL
+)
+"""
+
+
+class Spool:
+    """Append-only queue of line protocol payloads in a SQLite database
+
+    The spool is used from the thread of the InfluxDB client and the backfill thread, so every access holds a lock.
+
+    Args:
+        path (str|Path): SQLite database, created if it doesn't exist
+        max_bytes (int): Compressed bytes kept at most
+    """
+
+    def __init__(self, path: Union[str, Path], max_bytes: int = DEFAULT_SPOOL_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # A power cut may lose the last transactions, but never corrupts the database
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(_SCHEMA)
+        lines, size = self._db.execute(
+            "SELECT COALESCE(SUM(lines), 0), COALESCE(SUM(LENGTH(data)), 0) FROM payloads"
+        ).fetchone()
+        self.lines = lines
+        self.bytes = size
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return self.lines
+
+    def append(self, bucket: str, precision: str, payload: Union[str, bytes]) -> None:
+        """Appends {payload}, lines of line protocol, to be written to {bucket} with {precision}"""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        data = zlib.compress(payload)
+        lines = payload.count(b"\n") + 1
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO payloads (bucket, precision, lines, size, data) VALUES (?, ?, ?, ?, ?)",
+                (bucket, str(precision), lines, len(payload), data),
+            )
+            self.lines += lines
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                self._drop_oldest()
+
+    def _drop_oldest(self) -> None:
+        row_id, lines, size = self._db.execute(
+            "SELECT id, lines, LENGTH(data) FROM payloads ORDER BY id LIMIT 1"
+        ).fetchone()
+        self._db.execute("DELETE FROM payloads WHERE id = ?", (row_id,))
+        self.lines -= lines
+        self.bytes -= size
+        self.dropped += lines
+
+    def peek(self, max_size: int) -> tuple:
+        """Oldest payloads of the same bucket and precision, together up to {max_size} uncompressed bytes
+
+        Returns:
+            tuple: (id of the last payload, bucket, precision, lines, payload as bytes), None if the spool is empty
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, bucket, precision, lines, size, data FROM payloads ORDER BY id LIMIT 1000"
+            ).fetchall()
+        if not rows:
+            return None
+        _, bucket, precision, _, _, _ = rows[0]
+        last, lines, size, payloads = 0, 0, 0, []
+        for row_id, row_bucket, row_precision, row_lines, row_size, data in rows:
+            # A single payload goes even if it is larger
+            if (row_bucket, row_precision) != (bucket, precision) or (payloads and size + row_size > max_size):
+                break
+            last, lines, size = row_id, lines + row_lines, size + row_size
+            payloads.append(zlib.decompress(data))
+        return last, bucket, precision, lines, b"\n".join(payloads)
+
+    def remove(self, last: int) -> None:
+        """Removes the payloads up to and including the one with id {last}, once they were written"""
+        with self._lock:
+            lines, size = self._db.execute(
+                "SELECT COALESCE(SUM(lines), 0), COALESCE(SUM(LENGTH(data)), 0) FROM payloads WHERE id <= ?", (last,)
+            ).fetchone()
+            self._db.execute("DELETE FROM payloads WHERE id <= ?", (last,))
+            self.lines -= lines
+            self.bytes -= size
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
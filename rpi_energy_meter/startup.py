@@ -0,0 +1,182 @@
+"""
+Module to profile the cold start of the normal mode up to its first sample
+
+The normal mode is started in a fresh interpreter with -X importtime, so nothing is imported or cached yet, and
+timed step by step until the first block of phase 1 is calculated. Nothing gets written to InfluxDB, the state file
+is created in a temporary directory. The import time of every module is taken from the -X importtime report, the
+self time of third party modules is added up per package.
+
+Run as module it is the profiled interpreter:
+
+    python -X importtime -m rpi_energy_meter.startup <config> <results.json>
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# Seconds from starting the interpreter to the first sample, unless STARTUP.BUDGET_SECONDS says otherwise
+DEFAULT_STARTUP_BUDGET = 5.0
+# Modules listed in the report, the slowest first
+DEFAULT_TOP_MODULES = 15
+
+# Steps of the normal mode in the order they run, see _profile()
+STEPS = ("interpreter", "imports", "config", "adc", "state", "samples", "influx", "first_sample")
+
+
+def _profile(config_path: str, output: str) -> None:
+    # Runs in the profiled interpreter, every step is stamped with the time it ended at
+    marks = {"started": time.time()}
+    from .energy_meter import RpiEnergyMeter  # noqa: PLC0415
+
+    marks["imports"] = time.time()
+    meter = RpiEnergyMeter(config_path, False)
+    marks["config"] = time.time()
+
+    from .mcp3008 import create_adc  # noqa: PLC0415
+
+    adcs = [create_adc(meter.config, device=i) for i in range(meter.config.PHASES.COUNT)]
+    marks["adc"] = time.time()
+
+    from .state import StateStore  # noqa: PLC0415
+
+    with tempfile.TemporaryDirectory() as directory:
+        state = StateStore(os.path.join(directory, "energy.state"), meter.config)
+        totals = state.totals()
+        state.close()
+    marks["state"] = time.time()
+
+    from .samples import SAMPLES  # noqa: PLC0415
+
+    measurements = [
+        SAMPLES(meter.config, i + 1, totals=totals[i], runtime=meter.runtime) for i in range(meter.config.PHASES.COUNT)
+    ]
+    marks["samples"] = time.time()
+
+    from .influxv2_interface import infv2db  # noqa: PLC0415
+
+    db = infv2db(
+        token=meter.config.INFLUX.token,
+        organization=meter.config.INFLUX.organization,
+        bucket=meter.config.INFLUX.bucket,
+        host=meter.config.INFLUX.host,
+        port=meter.config.INFLUX.port,
+        gzip=meter.config.INFLUX.get("gzip", False),
+    )
+    marks["influx"] = time.time()
+
+    from .utils import collect_data2  # noqa: PLC0415
+
+    collect_data2(meter.config, 1, adcs[0], measurements[0], meter.config.GENERAL.ADC_SAMPLES)
+    measurements[0].correct_and_calculate_power()
+    marks["first_sample"] = time.time()
+
+    for adc in adcs:
+        adc.close()
+    db.close()
+    with open(output, "w") as f:
+        json.dump(marks, f)
+
+
+def parse_importtime(report: str) -> dict:
+    """Import time in ms per module of a -X importtime {report}
+
+    Modules of rpi_energy_meter are kept apart, the self time of all other modules is added up per top level
+    package.
+
+    Returns:
+        dict: Milliseconds per module or package, the slowest first
+    """
+    modules = {}
+    for line in report.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            # The header of the report
+            continue
+        name = name.strip()
+        key = name if name.startswith("rpi_energy_meter") else name.split(".")[0]
+        modules[key] = modules.get(key, 0.0) + int(self_us) / 1000
+    return dict(sorted(((key, round(ms, 2)) for key, ms in modules.items()), key=lambda item: -item[1]))
+
+
+def run_startup_profile(config_path, output=None) -> bool:
+    """Profiles the cold start of the normal mode with the config at {config_path}, see the module docstring
+
+    Args:
+        config_path (str): Path to config.toml
+        output (str): File the JSON results are written to, if given
+
+    Returns:
+        bool: The time to the first sample exceeded STARTUP.BUDGET_SECONDS
+    """
+    # Not imported at the top, the profiled interpreter runs this module before anything else
+    from prettytable import PrettyTable  # noqa: PLC0415
+
+    from .config import load_config  # noqa: PLC0415
+    from .logging import logger  # noqa: PLC0415
+
+    settings = load_config(config_path).STARTUP
+    budget = float(settings.get("BUDGET_SECONDS", DEFAULT_STARTUP_BUDGET))
+
+    with tempfile.TemporaryDirectory() as directory:
+        marks_file = os.path.join(directory, "marks.json")
+        spawned = time.time()
+        child = subprocess.run(
+            [sys.executable, "-X", "importtime", "-m", "rpi_energy_meter.startup", str(config_path), marks_file],
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        if child.returncode != 0:
+            logger.error(f"... The profiled start failed:\n{child.stdout}{child.stderr[-2000:]}")
+            return True
+        with open(marks_file) as f:
+            marks = json.load(f)
+
+    marks["interpreter"] = marks["started"]
+    steps = {}
+    previous = spawned
+    for step in STEPS:
+        steps[step] = round((marks[step] - previous) * 1000, 1)
+        previous = marks[step]
+    first_sample = round(marks["first_sample"] - spawned, 3)
+    modules = parse_importtime(child.stderr)
+
+    table = PrettyTable(["Step", "ms"])
+    for step, ms in steps.items():
+        table.add_row([step, ms])
+    logger.info("Time per step of the start\n" + table.get_string())
+    table = PrettyTable(["Module", "ms"])
+    for module, ms in list(modules.items())[: int(settings.get("TOP_MODULES", DEFAULT_TOP_MODULES))]:
+        table.add_row([module, ms])
+    logger.info("Slowest imports, self time\n" + table.get_string())
+
+    over = first_sample > budget
+    if over:
+        logger.error(f"... First sample after {first_sample} s, over the budget of {budget} s")
+    else:
+        logger.info(f"... First sample after {first_sample} s, within the budget of {budget} s")
+    if output is not None:
+        results = {
+            "created": time.time(),
+            "machine": platform.machine(),
+            "python": platform.python_version(),
+            "budget_s": budget,
+            "first_sample_s": first_sample,
+            "steps_ms": steps,
+            "modules_ms": modules,
+        }
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {output}")
+    return over
+
+
+if __name__ == "__main__":
+    _profile(sys.argv[1], sys.argv[2])
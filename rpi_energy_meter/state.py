@@ -0,0 +1,206 @@
+"""
+Module to keep the energy totals in a small binary state file instead of the config
+
+A state file has a fixed size: a header followed by two slots holding the totals. A save goes to the slot not holding
+the latest totals and ends with its checksum, so a power cut while saving leaves the other slot intact. The slot with
+the highest sequence number whose checksum matches is the one that counts. The file is memory-mapped, a save only
+touches the slot and syncs it to the SD card.
+
+    magic        8 bytes  b"RPEMSTA1"
+    phases       uint32   number of phases
+    cts          uint32   CTs per phase, always 6
+    slots                 2 slots of slot_dtype(phases)
+
+A slot:
+
+    seq          uint64   incremented with every save
+    saved        float64  time of the save
+    kwh          float64  energy total per phase and CT
+    reset        float64  time the total was reset per phase and CT, 0 if never
+    crc          uint32   zlib.crc32 of the slot up to here
+"""
+
+import time
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Union
+
+import numpy
+
+from .logging import logger
+
+MAGIC = b"RPEMSTA1"
+HEADER_DTYPE = numpy.dtype([("magic", "S8"), ("phases", "<u4"), ("cts", "<u4")])
+# Seconds between saves to the SD card, unless STATE.FLUSH_SECONDS says otherwise
+DEFAULT_FLUSH_SECONDS = 60.0
+# RESET_UTC of a total that was never reset
+NEVER_RESET = "1970-1-1 00:00:00.000000"
+
+
+def slot_dtype(phases: int) -> numpy.dtype:
+    """Layout of one slot holding the totals of {phases} phases"""
+    return numpy.dtype(
+        [
+            ("seq", "<u8"),
+            ("saved", "<f8"),
+            ("kwh", "<f8", (phases, 6)),
+            ("reset", "<f8", (phases, 6)),
+            ("crc", "<u4"),
+            ("reserved", "<u4"),
+        ]
+    )
+
+
+def energy_totals(measurements) -> numpy.ndarray:
+    """Copy of the energy totals of every phase and CT of {measurements}, for save_totals()"""
+    return numpy.array([[float(energy["Total"]) for energy in samples._energy] for samples in measurements])
+
+
+def _crc(slot) -> int:
+    return zlib.crc32(slot.tobytes()[: slot.dtype.fields["crc"][1]])
+
+
+def _reset_time(value) -> float:
+    # RESET_UTC as stored in the config by older versions, 0.0 for never reset
+    if not value or value == NEVER_RESET:
+        return 0.0
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        logger.warning(f"... Invalid RESET_UTC {value!r}, the total is taken as never reset")
+        return 0.0
+
+
+class StateStore:
+    """Energy totals of every phase and CT in a state file, see the module docstring for its layout
+
+    A missing or unreadable state file is created from the KWH and RESET_UTC values in the config, which is never
+    written to afterwards.
+
+    Args:
+        path (str|Path): State file
+        config (Box): Configuration, the totals are taken from it when there is no state file yet
+        flush (float): Seconds between saves, see save()
+    """
+
+    def __init__(self, path: Union[str, Path], config, flush: float = DEFAULT_FLUSH_SECONDS):
+        self.path = Path(path)
+        self.flush = flush
+        self._config = config
+        phases = config.PHASES.COUNT
+        self._dtype = slot_dtype(phases)
+        self._seq = 0
+        self.last_save = 0.0
+
+        self._kwh, self._reset, current = self._read(phases)
+        if self._kwh is None:
+            logger.info(f"... Creating {self.path} with the energy totals of the config")
+            self._kwh, self._reset = self._from_config(phases)
+        if current is None:
+            self._create(phases)
+        self._slots = numpy.memmap(self.path, dtype=self._dtype, mode="r+", offset=HEADER_DTYPE.itemsize, shape=(2,))
+        if current is None:
+            # The totals go to the first slot
+            self._current = 1
+            self._write(time.time())
+        else:
+            self._current = current
+
+    def _read(self, phases: int) -> tuple:
+        # Totals of the latest valid slot and its index, None as index if the file has to be created anew. Those of a
+        # state file of fewer phases are taken over as far as they go.
+        if not self.path.is_file():
+            return None, None, None
+        try:
+            header = numpy.fromfile(self.path, dtype=HEADER_DTYPE, count=1)
+            if len(header) != 1 or header[0]["magic"] != MAGIC:
+                raise ValueError("not a state file")
+            stored = int(header[0]["phases"])
+            slots = numpy.fromfile(self.path, dtype=slot_dtype(stored), count=2, offset=HEADER_DTYPE.itemsize)
+        except (OSError, ValueError) as error:
+            logger.warning(f"... {self.path} can't be read ({error})")
+            return None, None, None
+        valid = [index for index, slot in enumerate(slots) if slot["crc"] == _crc(slot)]
+        if not valid:
+            logger.warning(f"... {self.path} holds no valid totals")
+            return None, None, None
+        current = max(valid, key=lambda index: int(slots[index]["seq"]))
+        kwh, reset = self._from_config(phases)
+        common = min(phases, stored)
+        kwh[:common] = slots[current]["kwh"][:common]
+        reset[:common] = slots[current]["reset"][:common]
+        self._seq = int(slots[current]["seq"])
+        return kwh, reset, current if stored == phases else None
+
+    def _from_config(self, phases: int) -> tuple:
+        kwh = numpy.zeros((phases, 6))
+        reset = numpy.zeros((phases, 6))
+        for phase in range(phases):
+            cts = self._config.CTS.get(str(phase + 1))
+            for ct in range(cts.COUNT):
+                kwh[phase, ct] = float(cts.get(str(ct + 1)).get("KWH", 0.0))
+                reset[phase, ct] = _reset_time(cts.get(str(ct + 1)).get("RESET_UTC"))
+        return kwh, reset
+
+    def _create(self, phases: int) -> None:
+        # Writes an empty file of the current layout, the totals are written to it right after
+        header = numpy.zeros(1, dtype=HEADER_DTYPE)
+        header["magic"], header["phases"], header["cts"] = MAGIC, phases, 6
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(header.tobytes() + numpy.zeros(2, dtype=self._dtype).tobytes())
+        tmp.replace(self.path)
+
+    def totals(self) -> list:
+        """Energy totals per phase, in the format SAMPLES takes them"""
+        return [[{"Total": float(value)} for value in phase] for phase in self._kwh]
+
+    def reset_utc(self, phase: int, ct: int) -> str:
+        """Time the total of {ct} on {phase} (both 0 based) was reset, like RESET_UTC in the config"""
+        reset = self._reset[phase, ct]
+        return str(datetime.fromtimestamp(reset, timezone.utc)) if reset else NEVER_RESET
+
+    def save(self, measurements, now=None, force: bool = False) -> bool:
+        """Saves the energy totals of {measurements}, see save_totals()"""
+        return self.save_totals(energy_totals(measurements), now=now, force=force)
+
+    def save_totals(self, totals: numpy.ndarray, now=None, force: bool = False) -> bool:
+        """Saves the energy {totals} per phase and CT, at most every {flush} seconds unless {force} is set
+
+        Taking the totals with energy_totals() lets another thread save them while the measurement goes on. A total
+        that is smaller than the one saved before got reset, its reset time is set to {now} (time.time() if None).
+
+        Returns:
+            bool: The totals were saved
+        """
+        now = time.time() if now is None else now
+        if not force and now - self.last_save < self.flush:
+            return False
+        for phase in range(len(totals)):
+            for ct in range(self._config.CTS.get(str(phase + 1)).COUNT):
+                total = float(totals[phase, ct])
+                if not self._reset[phase, ct] or self._kwh[phase, ct] > total:
+                    self._reset[phase, ct] = now
+                self._kwh[phase, ct] = total
+
+        self._write(now)
+        self.last_save = now
+        return True
+
+    def _write(self, now: float) -> None:
+        # Writes the totals to the slot not holding the latest ones
+        slot = self._slots[1 - self._current]
+        self._seq += 1
+        slot["seq"] = self._seq
+        slot["saved"] = now
+        slot["kwh"] = self._kwh
+        slot["reset"] = self._reset
+        # The checksum goes last, a slot only counts once it is complete
+        slot["crc"] = _crc(slot)
+        self._slots.flush()
+        self._current = 1 - self._current
+
+    def close(self) -> None:
+        self._slots.flush()
+        del self._slots
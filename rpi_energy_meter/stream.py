@@ -0,0 +1,123 @@
+"""
+Module to sample an ADC continuously
+
+A BlockStream reads blocks from its ADC back-to-back in a thread of its own and keeps them in a preallocated ring
+of blocks, so the ADC keeps sampling while the blocks before are being calculated. It only stops sampling when all
+slots of the ring hold blocks that were not handed out yet, which shows as a gap in the block times.
+"""
+
+import threading
+import time
+
+import numpy
+
+from .mcp3008 import ALL_CHANNELS
+
+# Blocks the ring holds
+DEFAULT_STREAM_SLOTS = 8
+
+
+class BlockStream:
+    """Drop-in replacement for an ADC handing out the blocks its thread read from {adc} back-to-back
+
+    Args:
+        adc: ADC to read from (MCP3008_2, MCP3008_SPIDEV, MCP3008_SIMULATOR or MCP3008_REPLAY)
+        samples (int): Samples per block
+        slots (int): Blocks the ring holds
+    """
+
+    def __init__(self, adc, samples: int, slots: int = DEFAULT_STREAM_SLOTS):
+        self.adc = adc
+        self.device = adc.device
+        self.samples = samples
+        self._blocks = numpy.zeros((slots, samples, len(ALL_CHANNELS)), dtype=numpy.uint16)
+        # Start, end and effective sample rate (0 if unknown) of every block
+        self._times = numpy.zeros((slots, 3))
+        self._block = numpy.zeros((samples, len(ALL_CHANNELS)), dtype=numpy.uint16)
+        self._written = 0
+        self._read = 0
+        self._error = None
+        self._stopped = False
+        self._condition = threading.Condition()
+        # Until the first block is handed out, the stream starts now
+        now = getattr(adc, "now", time.time)()
+        self.block_times = (now, now)
+        self.sample_rate = None
+        self._thread = threading.Thread(target=self._run, name=f"stream-{self.device + 1}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        clock = getattr(self.adc, "now", time.time)
+        slots = len(self._blocks)
+        try:
+            while True:
+                with self._condition:
+                    while self._written - self._read >= slots and not self._stopped:
+                        self._condition.wait()
+                    if self._stopped:
+                        return
+                slot = self._written % slots
+                time_start = clock()
+                self._blocks[slot] = self.adc.read_block(samples=self.samples)
+                # Backends that time their blocks themselves know better
+                self._times[slot, :2] = getattr(self.adc, "block_times", (time_start, clock()))
+                self._times[slot, 2] = getattr(self.adc, "sample_rate", None) or 0.0
+                with self._condition:
+                    self._written += 1
+                    self._condition.notify_all()
+        except Exception as error:
+            # Handed to the reader, EOFError of a replay included
+            with self._condition:
+                self._error = error
+                self._condition.notify_all()
+
+    def open(self):
+        """The ADC gets opened by the thread on its first read"""
+
+    def stop(self) -> None:
+        """Stops the thread after the block it is reading"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def close(self) -> None:
+        """Stops the thread and closes the ADC"""
+        self.stop()
+        self.adc.close()
+
+    def now(self) -> float:
+        """Time the last block handed out ended at"""
+        return self.block_times[1]
+
+    def read(self, channels=ALL_CHANNELS, samples=200):
+        """Reads {samples} samples of {channels} as a list of lists, one list of channel values per sample"""
+        return self.read_block(samples=samples, channels=channels).tolist()
+
+    def read_block(self, samples=200, channels=ALL_CHANNELS) -> numpy.ndarray:
+        """Hands out the oldest block not handed out yet, waiting for it if needed
+
+        Reads of single channels (the bias voltage) are answered from the last block instead of consuming one.
+        The times the block was sampled between are in {block_times} afterwards, its effective samples per second
+        in {sample_rate}.
+
+        Returns:
+            numpy.ndarray: uint16 array of shape (samples, len(channels)), valid until the next read
+        """
+        channels = str(channels)
+        if channels != ALL_CHANNELS:
+            return self._block[:samples, [int(c) for c in channels]]
+        if samples != self.samples:
+            raise ValueError(f"Stream reads blocks of {self.samples} samples, {samples} were requested")
+        with self._condition:
+            while self._read >= self._written:
+                if self._error is not None:
+                    raise self._error
+                self._condition.wait()
+            slot = self._read % len(self._blocks)
+            self._block[...] = self._blocks[slot]
+            self.block_times = (float(self._times[slot, 0]), float(self._times[slot, 1]))
+            self.sample_rate = float(self._times[slot, 2]) or None
+            self._read += 1
+            self._condition.notify_all()
+        return self._block
@@ -3,18 +3,31 @@ This module contains functions that are used in both, the main RpiEnergyMeter co
 """
 
 import csv
+import functools
+import math
 import time
 from datetime import datetime
 from socket import AF_INET, SOCK_DGRAM, getfqdn, socket
 
 import numpy
-from influxdb_client import Point
-from prettytable import PrettyTable
 
 from .logging import logger
+from .power import POWER_DTYPE
 
-# Cache hostname — getfqdn() does a DNS lookup, no need to call it per point
-_HOSTNAME = getfqdn()
+# Escaping of line protocol, as done by influxdb_client
+_ESCAPE_MEASUREMENT = str.maketrans({",": r"\,", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"})
+_ESCAPE_KEY = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"})
+_ESCAPE_STRING = str.maketrans({'"': r"\"", "\\": r"\\"})
+# Measurement and tags of a line by (name, phase, suffix), they repeat every window
+_LINE_PREFIXES = {}
+# Escaped field keys
+_LINE_KEYS = {}
+
+
+@functools.cache
+def hostname() -> str:
+    """Host tag of the points, looked up on first use: getfqdn() does a DNS lookup that is slow without a network"""
+    return getfqdn()
 
 
 def get_bias_voltage2(config, phase, adc, numMeasurements=10) -> dict:
@@ -27,52 +40,43 @@ def get_bias_voltage2(config, phase, adc, numMeasurements=10) -> dict:
         dict: time = time of the measurement; value = bias voltage
     """
     zeit = time.time()
-    _samples = adc.read(channels=config.VOLTMETER.get(str(phase)).BIAS.CHANNEL, samples=numMeasurements)
+    _samples = adc.read_block(samples=numMeasurements, channels=config.VOLTMETER.get(str(phase)).BIAS.CHANNEL)
 
-    values = [sample[0] for sample in _samples]
-    avg_reading = sum(values) / len(values)
-    voltage = (avg_reading / config.GENERAL.ADC_RESOLUTION) * config.GENERAL.VREF
+    return {"time": zeit, "value": bias_voltage(config, _samples[:, 0])}
 
-    return {"time": zeit, "value": voltage}
 
+def bias_voltage(config, values: numpy.ndarray) -> float:
+    """Mean Bias_V voltage of the raw ADC {values} of a bias channel"""
+    return (float(values.mean()) / config.GENERAL.ADC_RESOLUTION) * config.GENERAL.VREF
 
-def collect_data2(config, phase, adc, measurements, numSamples) -> None:
+
+def collect_data2(config, phase, adc, measurements, numSamples, stages=None) -> None:
     """Collects {numSamples} of raw data for every ADC channel and fills {measurements} as a dict with the values from {adc}
 
     Args:
         adc (MCP3008_2): Instance of MCP3008_2 to take values from
         measurements (SAMPLES): Instance of SAMPLES to be filled
         numSamples (int): Number of samples to take
+        stages (Stages): Times the adc_read and scale stages, if given
     """
 
-    # Initialize variables
-    ct1_data = numpy.zeros(numSamples)
-    ct2_data = numpy.zeros(numSamples)
-    ct3_data = numpy.zeros(numSamples)
-    v_data = numpy.zeros(numSamples)
-    ct4_data = numpy.zeros(numSamples)
-    ct5_data = numpy.zeros(numSamples)
-    ct6_data = numpy.zeros(numSamples)
-
-    t = numpy.zeros(numSamples)
-
+    read_timer = stages.get("adc_read") if stages is not None else None
     # Get time of reading for execution time
     time_start = time.time()
+    read_start = time.perf_counter()
     # Start the gathering
-    _data = adc.read(samples=numSamples)
-    for i in range(len(_data)):
-        bias_data = _data[i][config.VOLTMETER[str(phase)].BIAS.CHANNEL]
-
-        ct1_data[i] = _data[i][config.CTS[str(phase)]["1"].CHANNEL] - bias_data
-        ct2_data[i] = _data[i][config.CTS[str(phase)]["2"].CHANNEL] - bias_data
-        ct3_data[i] = _data[i][config.CTS[str(phase)]["3"].CHANNEL] - bias_data
-
-        v_data[i] = _data[i][config.VOLTMETER[str(phase)].VAC.CHANNEL] - bias_data
-        t[i] = time.time()
-
-        ct4_data[i] = _data[i][config.CTS[str(phase)]["4"].CHANNEL] - bias_data
-        ct5_data[i] = _data[i][config.CTS[str(phase)]["5"].CHANNEL] - bias_data
-        ct6_data[i] = _data[i][config.CTS[str(phase)]["6"].CHANNEL] - bias_data
+    _data = adc.read_block(samples=numSamples)
+    time_end = time.time()
+    if read_timer is not None:
+        read_timer.add(time.perf_counter() - read_start)
+    # The ADC knows when the block was actually sampled
+    fill_samples(
+        measurements,
+        _data,
+        *getattr(adc, "block_times", (time_start, time_end)),
+        getattr(adc, "sample_rate", None),
+        timer=stages.get("scale") if stages is not None else None,
+    )
 
     # Some info
     took = time.time() - time_start
@@ -80,34 +84,135 @@ def collect_data2(config, phase, adc, measurements, numSamples) -> None:
     logger.debug(f"... that evaluates to {8 * numSamples / took} samples / second")
     logger.debug(f"... that evaluates to {8 * numSamples / took / 1000} samples / milli second")
 
-    adc_factor_ct = (config.GENERAL.VREF / config.GENERAL.ADC_RESOLUTION) / (
-        config.CTS.BURDEN_RESISTANCE / config.CTS.WINDING_RATIO
-    )
-    adc_factor_vac = (config.GENERAL.VREF / config.GENERAL.ADC_RESOLUTION) * (
-        config.PHASES[str(phase)].VOLTAGE
-        / (config.PHASES[str(phase)].TRANSFORMER_OUTPUT_VOLTAGE / config.PHASES.TRANSFORMER_VDIVIDER)
-    )
 
-    ct1_data *= adc_factor_ct
-    ct2_data *= adc_factor_ct
-    ct3_data *= adc_factor_ct
-    v_data *= adc_factor_vac
-    ct4_data *= adc_factor_ct
-    ct5_data *= adc_factor_ct
-    ct6_data *= adc_factor_ct
-
-    # Fill given instance with data
-    measurements.samples_ct1 = ct1_data
-    measurements.samples_ct2 = ct2_data
-    measurements.samples_ct3 = ct3_data
-    measurements.samples_vac = v_data
-    measurements.t = t
-    measurements.samples_ct4 = ct4_data
-    measurements.samples_ct5 = ct5_data
-    measurements.samples_ct6 = ct6_data
-
-
-def to_point(phase: int, measurements, amount: int, name: str, time: int):
+def fill_samples(measurements, data, time_start: float, time_end: float, sample_rate=None, timer=None) -> None:
+    """Fills {measurements} with a (samples, 8) block of raw ADC values taken between {time_start} and {time_end}
+
+    Args:
+        measurements (SAMPLES): Instance of SAMPLES to be filled
+        data (numpy.ndarray): Block as returned by read_block() of the ADC
+        time_start (float): Time the block was started at
+        time_end (float): Time the block was finished at
+        sample_rate (float): Effective samples per second of the block as measured by the ADC, None if unknown
+        timer (Histogram): Gets the duration added to, if given
+    """
+    start = time.perf_counter()
+    channel_map = measurements.channel_map
+    if len(measurements.t) != len(data):
+        measurements.resize(len(data))
+
+    # Copy the channels of this phase straight into the sample buffer, then remove the bias and scale them in place
+    values = measurements.channels
+    for row, channel in zip(values, channel_map.channels):
+        numpy.copyto(row, data[:, channel])
+    values -= data[:, channel_map.bias]
+    values *= channel_map.scale[:, None]
+    measurements.set_time(time_start, time_end, sample_rate)
+    if timer is not None:
+        timer.add(time.perf_counter() - start)
+
+
+def readings_to_points(config, phase: int, measurements, window):
+    """Turns the {window} of readings of {phase} into InfluxDBv2 Points
+
+    The energy totals are written as they are, the energy of the window has to be integrated before. In continuous
+    mode (GENERAL.CONTINUOUS) the share of the time actually sampled is added as duty cycle point. With
+    GENERAL.FREQUENCY_TRACKING the grid frequency last estimated is added as frequency point, once the ADC measured
+    the sample rate to estimate it with.
+
+    With INFLUX.line_protocol (the default) the points are formatted straight to line protocol by to_line(), one
+    payload of lines per window, instead of being built as Points that the client serializes.
+
+    Args:
+        phase (int): Phase on which the readings were taken
+        measurements (SAMPLES): Instance of SAMPLES holding the energy totals of the phase
+        window (Window): Mean, minimum and maximum of the readings, see Aggregator.take()
+
+    Returns:
+        str|list: Line protocol, or influxdb_client.Point, for the voltage, the frequency, and the total energy and
+            currents of every CT
+    """
+    point = to_line if config.INFLUX.get("line_protocol", True) else to_point
+    timestamp = int(window.time_start * 1000)  # Miliseconds timestamp as integer
+    timestamp = int(timestamp + ((window.time_end * 1000 - timestamp) / 2))
+    continuous = config.GENERAL.get("CONTINUOUS", False)
+    # Tuples of the POWER_DTYPE values per CT, much faster to pick from than the structured arrays
+    values = (window.mean.tolist(), window.minimum.tolist(), window.maximum.tolist())
+    points = [point(phase, _fields(values, 0, {"Voltage": "voltage"}), 1, "voltage", timestamp)]
+    frequency = measurements.measured_frequency
+    if config.GENERAL.get("FREQUENCY_TRACKING", True) and frequency is not None:
+        points.append(point(phase, frequency, 1, "frequency", timestamp))
+    if continuous:
+        points.append(point(phase, measurements.take_duty_cycle(), 1, "dutycycle", timestamp))
+    for ct in range(config.CTS.get(str(phase)).COUNT):
+        points.append(point(phase, measurements._energy[ct]["Total"], 1, "total_" + str(ct + 1), timestamp))
+        points.append(point(phase, _fields(values, ct, _CT_FIELDS), 1, "current_" + str(ct + 1), timestamp))
+    return "\n".join(points) if point is to_line else points
+
+
+def rollup_points(config, phase: int, tier, window, energy) -> list:
+    """Turns the {window} of a rollup {tier} of {phase} into InfluxDBv2 Points
+
+    The measurements are named like the ones of readings_to_points() with the suffix of the tier appended, and
+    stamped with the start of the window.
+
+    Args:
+        phase (int): Phase on which the readings were taken
+        tier (RollupTier): Tier the window belongs to
+        window (Window): Mean, minimum and maximum of the readings, see Rollups.add()
+        energy (numpy.ndarray): Energy in kWh every CT consumed during the window
+
+    Returns:
+        str|list: Line protocol, or influxdb_client.Point, for the voltage, and the energy and currents of every CT
+    """
+    point = to_line if config.INFLUX.get("line_protocol", True) else to_point
+    timestamp = int(window.time_start * 1000)
+    values = (window.mean.tolist(), window.minimum.tolist(), window.maximum.tolist())
+    points = [point(phase, _fields(values, 0, {"Voltage": "voltage"}), 1, "voltage", timestamp, tier.suffix)]
+    for ct in range(config.CTS.get(str(phase)).COUNT):
+        points.append(point(phase, {"energy": float(energy[ct])}, 1, "energy_" + str(ct + 1), timestamp, tier.suffix))
+        points.append(
+            point(phase, _fields(values, ct, _CT_FIELDS), 1, "current_" + str(ct + 1), timestamp, tier.suffix)
+        )
+    return "\n".join(points) if point is to_line else points
+
+
+def stage_points(config, summary: dict, timestamp: int):
+    """Turns the {summary} of the stage histograms, see Stages.take(), into InfluxDBv2 Points
+
+    Every stage gets a point of its own, named like the stage with "stage_" in front. As they cover all phases,
+    they are tagged as phase 0.
+
+    Args:
+        summary (dict): Count, mean and percentiles in us per stage
+        timestamp (int): Time since epoch in ms
+
+    Returns:
+        str|list: Line protocol, or influxdb_client.Point, one per stage
+    """
+    point = to_line if config.INFLUX.get("line_protocol", True) else to_point
+    points = [point(0, values, 1, "stage", timestamp, "_" + stage) for stage, values in summary.items()]
+    return "\n".join(points) if point is to_line else points
+
+
+# Field names of the POWER_DTYPE values written per CT, and the position of every value in a POWER_DTYPE tuple
+_CT_FIELDS = {"Watts": "power", "PF": "pf", "Current": "current"}
+_INDEX = {name: i for i, name in enumerate(POWER_DTYPE.names)}
+
+
+def _fields(values, ct: int, names: dict) -> dict:
+    # Mean of every value under its field name, the minimum and maximum with _min / _max appended
+    mean, minimum, maximum = values[0][ct], values[1][ct], values[2][ct]
+    fields = {}
+    for value, name in names.items():
+        index = _INDEX[value]
+        fields[name] = mean[index]
+        fields[name + "_min"] = minimum[index]
+        fields[name + "_max"] = maximum[index]
+    return fields
+
+
+def to_point(phase: int, measurements, amount: int, name: str, time: int, suffix: str = ""):
     """Transforms SAMPLES measurements to a single InfluxDBv2 Point
 
     Args:
@@ -116,6 +221,7 @@ def to_point(phase: int, measurements, amount: int, name: str, time: int):
         amount (int): We will take the average over this integer (sum(measurements)/amount)
         name (str): Name of the measurement (_measurement in InfluxDBv2)
         time (int): Time since epoch in ms (usually time.time())
+        suffix (str): Appended to the name of the measurement, e.g. the one of a rollup tier
 
     Returns:
         influxdb_client.Point: InfluxDBv2 client API Point instance
@@ -128,9 +234,11 @@ def to_point(phase: int, measurements, amount: int, name: str, time: int):
         else:
             _measurements = sum(_measurements) / amount
 
-    _point = Point(name.split("_", maxsplit=1)[0])
+    from influxdb_client import Point  # noqa: PLC0415 — only used without INFLUX.line_protocol
+
+    _point = Point(name.split("_", maxsplit=1)[0] + suffix)
 
-    tags = {"host": _HOSTNAME, "phase": phase}
+    tags = {"host": hostname(), "phase": phase}
     if "_" in name:
         tags["sensor"] = int(name.split("_")[1])
 
@@ -148,6 +256,75 @@ def to_point(phase: int, measurements, amount: int, name: str, time: int):
     return _point
 
 
+def to_line(phase: int, measurements, amount: int, name: str, time: int, suffix: str = "") -> str:
+    """Formats the same line protocol as to_point(...).to_line_protocol(), without building a Point
+
+    The measurement and tags of a line are formatted once per {name}, {phase} and {suffix} and cached.
+
+    Args:
+        phase (int): Phase on which the measurements were taken
+        measurements (dict|list|float): Dictionary of samples, a list of measurements or a single value
+        amount (int): We will take the average over this integer (sum(measurements)/amount)
+        name (str): Name of the measurement, "<measurement>_<sensor>" for the values of a CT
+        time (int): Time since epoch in ms
+        suffix (str): Appended to the name of the measurement, e.g. the one of a rollup tier
+
+    Returns:
+        str: One line of line protocol, with ms precision
+    """
+    prefix = _LINE_PREFIXES.get((name, phase, suffix))
+    if prefix is None:
+        tags = {"host": hostname(), "phase": phase}
+        if "_" in name:
+            tags["sensor"] = int(name.split("_")[1])
+        measurement = (name.split("_", maxsplit=1)[0] + suffix).translate(_ESCAPE_MEASUREMENT)
+        prefix = measurement + "".join(
+            f",{_escape_tag(key)}={_escape_tag(value)}" for key, value in sorted(tags.items())
+        )
+        _LINE_PREFIXES[(name, phase, suffix)] = prefix
+
+    if isinstance(measurements, dict):
+        fields = {key: sum(value) / amount for key, value in measurements.items()} if amount > 1 else measurements
+    else:
+        value = sum(measurements) / amount if amount > 1 else measurements
+        fields = {name if amount > 1 else name.split("_", maxsplit=1)[0]: value}
+
+    formatted = []
+    for field, value in sorted(fields.items()):
+        key = _LINE_KEYS.get(field)
+        if key is None:
+            key = _LINE_KEYS[field] = str(field).translate(_ESCAPE_KEY)
+        # Floats are by far the most, formatted like influxdb_client does: without a trailing ".0", none if not finite
+        if isinstance(value, float):
+            if math.isfinite(value):
+                text = str(value)
+                formatted.append(f"{key}={text[:-2] if text.endswith('.0') else text}")
+        elif value is not None:
+            text = _field_value(value)
+            if text is not None:
+                formatted.append(f"{key}={text}")
+    return f"{prefix} {','.join(formatted)} {int(time)}"
+
+
+def _field_value(value):
+    # What is left of the floats, e.g. numpy.float32
+    if isinstance(value, numpy.floating):
+        if not numpy.isfinite(value):
+            return None
+        text = str(value)
+        return text[:-2] if text.endswith(".0") else text
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (int, numpy.integer)):
+        return f"{value}i"
+    return '"' + str(value).translate(_ESCAPE_STRING) + '"'
+
+
+def _escape_tag(value) -> str:
+    escaped = str(value).translate(_ESCAPE_KEY)
+    return escaped + " " if escaped.endswith("\\") else escaped
+
+
 def dump_data(phase, samples):
     now = datetime.now().strftime("%m-%d-%Y-%H-%M")
     filename = f"data-dump-phase{phase}-{now}.csv"
@@ -169,12 +346,18 @@ def dump_data(phase, samples):
     logger.info(f"... CSV written to {filename}.")
 
 
-def print_results(config, phase: int, adc, results: dict):
+def print_results(config, phase: int, adc, results: dict, bias=None):
     """Output a Table to the debugging console
 
     Args:
         results (dict): Dictionary containing all the results for ct1-ct6 + voltage
+        bias (float): Bias voltage taken along with the results, measured with {adc} if None. Has to be given when
+            {adc} is busy in another thread or process
     """
+    if bias is None:
+        bias = get_bias_voltage2(config, phase, adc)["value"]
+    from prettytable import PrettyTable  # noqa: PLC0415 — only used for debug output
+
     t = PrettyTable(["PHASE " + str(phase), "ct1", "ct2", "ct3", "ct4", "ct5", "ct6"])
     t.add_row(
         [
@@ -213,7 +396,7 @@ def print_results(config, phase: int, adc, results: dict):
     t.add_row(
         [
             "Bias_V",
-            round(get_bias_voltage2(config, phase, adc)["value"] * config.VOLTMETER[str(phase)].BIAS.FACTOR, 3),
+            round(bias * config.VOLTMETER[str(phase)].BIAS.FACTOR, 3),
             "",
             "",
             "",